@@ -17,8 +17,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import json
+import hashlib
 import re
 import sys
+import mmap
 import copy
 import glob
 import shutil
@@ -29,23 +32,23 @@ import itertools
 import numpy as np
 import multiprocessing as mp
 from time import sleep
-from ete3 import Tree
-from Bio import SeqIO, AlignIO, Align
-from Bio.Seq import Seq
+from Bio import SeqIO
 from Bio.Alphabet import IUPAC
 from Bio.SeqRecord import SeqRecord
-from Bio.Graphics import GenomeDiagram
 from Bio.SeqFeature import FeatureLocation
-from Bio.Graphics.GenomeDiagram import CrossLink
-from reportlab.lib import colors
-from reportlab.lib.units import cm
 from datetime import datetime
 from string import ascii_uppercase
-from scipy.stats import gaussian_kde
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
 from MetaCHIP.MetaCHIP_config import config_dict
+from MetaCHIP.blast_hit_store import blast_hit_store_is_current, build_blast_hit_store, load_blast_hit_store, get_gene_id, get_genome_group_code, get_row_fingerprint
+from MetaCHIP.msa_column_filter import remove_low_cov_and_consensus_columns
+from MetaCHIP.dated_dtl import get_dated_species_tree, dated_dtl_reconciliation
+from MetaCHIP.run_profiler import start_profiling, record_profile_step, profiled_system, profiled_pool_map, end_profiling
+from MetaCHIP.worker_context import worker_context_dict, get_worker_context_pool
+
+
+# ete3, scipy, matplotlib, reportlab and Bio.Graphics take seconds to import, they are imported by the functions
+# that use them, so that the command line interface and forked workers only pay for what they run.
+
 # from PIL import Image
 
 
@@ -66,6 +69,8 @@ def report_and_log(message_for_report, log_file, keep_quiet):
     if keep_quiet is False:
         print('%s %s' % ((datetime.now().strftime(time_format)), message_for_report))
 
+    record_profile_step(message_for_report)
+
 
 def force_create_folder(folder_to_create):
     if os.path.isdir(folder_to_create):
@@ -233,37 +238,155 @@ def uniq_list(input_list):
     return output_list
 
 
-def get_qualigied_blast_hits(pwd_blast_results, align_len_cutoff, cover_cutoff, genome_name_list, pwd_qual_iden_file):
+identity_bin_number = 100001
+
+
+def get_qualified_hit_mask(blast_hit_store, row_start, row_end, align_len_cutoff, cover_cutoff):
+
+    # rank independent filters of hits between row_start and row_end: alignment length, remove within genome hits,
+    # then coverage cutoff
+    align_len = blast_hit_store['align_len'][row_start:row_end].astype(np.float64)
+    query_genome = blast_hit_store['gene_genome'][blast_hit_store['query'][row_start:row_end]]
+    subject_genome = blast_hit_store['gene_genome'][blast_hit_store['subject'][row_start:row_end]]
+    coverage_q = align_len * 100 / blast_hit_store['qlen'][row_start:row_end]
+    coverage_s = align_len * 100 / blast_hit_store['slen'][row_start:row_end]
+
+    qualified_mask = (align_len >= int(align_len_cutoff)) & (query_genome != subject_genome)
+    qualified_mask &= (coverage_q >= int(cover_cutoff)) & (coverage_s >= int(cover_cutoff))
+
+    return qualified_mask
+
+
+def get_qualigied_blast_hits(blast_hit_store, row_start, row_end, align_len_cutoff, cover_cutoff, genome_group_code, qualified_hit_mask=None):
+
+    # return index of qualified hits between row_start and row_end of the blast hit store, qualified_hit_mask of the
+    # same rows from get_qualified_hit_mask can be provided to reuse it for multiple ranks
+    if qualified_hit_mask is None:
+        qualified_hit_mask = get_qualified_hit_mask(blast_hit_store, row_start, row_end, align_len_cutoff, cover_cutoff)
+
+    # only work on genomes with clear taxonomic classification
+    query_genome = blast_hit_store['gene_genome'][blast_hit_store['query'][row_start:row_end]]
+    subject_genome = blast_hit_store['gene_genome'][blast_hit_store['subject'][row_start:row_end]]
+    qualified_mask = qualified_hit_mask & (genome_group_code[query_genome] >= 0) & (genome_group_code[subject_genome] >= 0)
+
+    return np.flatnonzero(qualified_mask) + row_start
+
+
+def get_g2g_identity_histograms(blast_hit_store, qualified_rows, genome_group_code, group_list):
+
+    # blastn identities have 3 decimals, so identities of each group pair are counted into 100,001 bins of 0.001
+    # group pair named by groups sorted by alphabet order, group_list is sorted, so is the group code
+    query_group_code = genome_group_code[blast_hit_store['gene_genome'][blast_hit_store['query'][qualified_rows]]]
+    subject_group_code = genome_group_code[blast_hit_store['gene_genome'][blast_hit_store['subject'][qualified_rows]]]
+    group_pair_code = np.minimum(query_group_code, subject_group_code) * len(group_list) + np.maximum(query_group_code, subject_group_code)
+    identity_bins = np.rint(blast_hit_store['identity'][qualified_rows] * 1000).astype(np.int64)
+
+    group_pair_identity_histogram_dict = {}
+    for each_group_pair_code in np.unique(group_pair_code):
+        g_g = '%s_%s' % (group_list[each_group_pair_code // len(group_list)], group_list[each_group_pair_code % len(group_list)])
+        group_pair_identity_histogram_dict[g_g] = np.bincount(identity_bins[group_pair_code == each_group_pair_code], minlength=identity_bin_number).astype(np.uint32)
+
+    return group_pair_identity_histogram_dict
+
+
+def get_sparse_identity_histogram(identity_histogram):
+
+    # non-zero bins and their counts
+    identity_bin_index = np.flatnonzero(identity_histogram)
+
+    return identity_bin_index, identity_histogram[identity_bin_index]
+
+
+def merge_identity_histograms(sparse_histogram_dict_list):
 
-    out_temp = open(pwd_qual_iden_file, 'w')
-    for match in open(pwd_blast_results):
-        match_split = match.strip().split('\t')
-        query = match_split[0]
-        subject = match_split[1]
-        align_len = int(match_split[3])
-        query_len = int(match_split[12])
-        subject_len = int(match_split[13])
-        query_bin_name = '_'.join(query.split('_')[:-1])
-        subject_bin_name = '_'.join(subject.split('_')[:-1])
-        coverage_q = float(align_len) * 100 / float(query_len)
-        coverage_s = float(align_len) * 100 / float(subject_len)
+    # add up sparse histograms of each group pair, only one dense histogram per group pair is kept in memory
+    group_pair_identity_histogram_dict = {}
+    for sparse_histogram_dict in sparse_histogram_dict_list:
+        for g_g, (identity_bin_index, identity_bin_count) in sparse_histogram_dict.items():
+            if g_g not in group_pair_identity_histogram_dict:
+                group_pair_identity_histogram_dict[g_g] = np.zeros(identity_bin_number, dtype=np.uint64)
+            np.add.at(group_pair_identity_histogram_dict[g_g], np.asarray(identity_bin_index, dtype=np.int64), np.asarray(identity_bin_count, dtype=np.uint64))
 
-        # first filter with alignment length
-        if align_len >= int(align_len_cutoff):
+    return group_pair_identity_histogram_dict
 
-            # then remove within genome hits
-            if query_bin_name != subject_bin_name:
 
-                # then coverage cutoff
-                if (coverage_q >= int(cover_cutoff)) and (coverage_s >= int(cover_cutoff)):
+def reduce_BM_stream_results(BM_stream_results):
 
-                    # only work on genomes with clear taxonomic classification
-                    if (query_bin_name in genome_name_list) and (subject_bin_name in genome_name_list):
-                        out_temp.write(match)
-    out_temp.close()
+    # merge histograms of all blast result files into one sparse histogram per group pair, best-match lists and
+    # status are kept per blast result file
+    group_pair_identity_histogram_dict = merge_identity_histograms([each_BM_stream_result[0] for each_BM_stream_result in BM_stream_results])
+    group_pair_sparse_histogram_dict = {g_g: get_sparse_identity_histogram(identity_histogram) for g_g, identity_histogram in group_pair_identity_histogram_dict.items()}
+    best_match_list_list = [each_BM_stream_result[1] for each_BM_stream_result in BM_stream_results]
+    BM_stream_status_list = [each_BM_stream_result[2] for each_BM_stream_result in BM_stream_results]
+
+    return group_pair_sparse_histogram_dict, best_match_list_list, BM_stream_status_list
+
+
+def get_percentile_from_histogram(identity_histogram, percentile):
+
+    # exactly the same as np.percentile (linear interpolation) on the identities counted in identity_histogram
+    cumulative_count = np.cumsum(identity_histogram)
+    identity_number = int(cumulative_count[-1])
+    virtual_index = (identity_number - 1) * (percentile / 100)
+    previous_index = int(np.floor(virtual_index))
+    next_index = min(previous_index + 1, identity_number - 1)
+    gamma = virtual_index - previous_index
+
+    previous_identity = np.searchsorted(cumulative_count, previous_index, side='right') / 1000
+    next_identity = np.searchsorted(cumulative_count, next_index, side='right') / 1000
+    identity_diff = next_identity - previous_identity
+    if gamma >= 0.5:
+        return next_identity - identity_diff * (1 - gamma)
+    else:
+        return previous_identity + identity_diff * gamma
+
+
+def get_identity_list_from_histogram(identity_histogram):
+
+    identity_bin_index = np.flatnonzero(identity_histogram)
+
+    return np.repeat(identity_bin_index / 1000, identity_histogram[identity_bin_index]).tolist()
+
+
+def get_query_subjects(blast_hit_store, qualified_rows, genome_group_number_list):
+
+    # yield query (group|gene) and its sorted and de-replicated subjects (group|gene|identity), gene ids were
+    # assigned in sorted order, so queries come out in the same order as sorting genes by name
+    if len(qualified_rows) == 0:
+        return
+
+    gene_names = blast_hit_store['gene_names']
+    gene_genome = blast_hit_store['gene_genome']
+    qualified_rows = qualified_rows[np.argsort(blast_hit_store['query'][qualified_rows], kind='stable')]
+    query_ids = blast_hit_store['query'][qualified_rows]
+    subject_ids = blast_hit_store['subject'][qualified_rows]
+    identities = blast_hit_store['identity'][qualified_rows].tolist()
+    query_start_list = [0] + (np.flatnonzero(np.diff(query_ids)) + 1).tolist() + [len(query_ids)]
+
+    for n in range(len(query_start_list) - 1):
+        query_id = query_ids[query_start_list[n]]
+        query_with_group = '%s|%s' % (genome_group_number_list[gene_genome[query_id]], gene_names[query_id].decode())
+        subjects = set()
+        for m in range(query_start_list[n], query_start_list[n + 1]):
+            subject_id = subject_ids[m]
+            subjects.add('%s|%s|%s' % (genome_group_number_list[gene_genome[subject_id]], gene_names[subject_id].decode(), str(identities[m])))
+        yield query_with_group, sorted(subjects)
+
+
+def import_pyplot():
+
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
 
 
 def plot_identity_list(identity_list, identity_cut_off, title, output_foler):
+
+    from scipy.stats import gaussian_kde
+    plt = import_pyplot()
+
     identity_list = sorted(identity_list)
 
     # get statistics
@@ -322,192 +445,107 @@ def plot_identity_list(identity_list, identity_cut_off, title, output_foler):
     plt.close()
 
 
-def get_hits_group(input_file_name, output_file_name):
-    matches_2 = open(input_file_name)
-    output_2_file = open(output_file_name, 'w')
-    current_gene = ''
-    group_member = []
-    for match in matches_2:
-        match_split = match.strip().split('\t')
-        query_2 = match_split[0]
-        target_2 = match_split[1]
-        if current_gene == '':
-            current_gene = query_2
-            group_member.append(target_2)
+def get_best_match_donor(query, subjects_list):
+
+    # query: group|gene, subjects_list: [group|gene|identity, ...], return the candidate donor or None
+    query_split = query.split('|')
+    query_sg = query_split[0]
+    query_g = query_sg.split('_')[0]
+
+    # if only one non-self subject was found, no matter which group it comes from, ignored
+    if len(subjects_list) <= 1:
+        return None
+
+    # get the number of subjects from self-group and non_self_group
+    self_group_subject_list = []
+    non_self_group_subject_list = []
+    for each_subject in subjects_list:
+        each_subject_g = each_subject.split('|')[0].split('_')[0]
+        if each_subject_g == query_g:
+            self_group_subject_list.append(each_subject)
         else:
-            if query_2 == current_gene:
-                if target_2 not in group_member:
-                    group_member.append(target_2)
-                else:
-                    pass
-            else:
-                output_2_file.write('%s\t%s' % (current_gene, '\t'.join(group_member)) + '\n')
-                current_gene = query_2
-                group_member = []
-                group_member.append(target_2)
-    output_2_file.write('%s\t%s' % (current_gene, '\t'.join(group_member)) + '\n')
-    output_2_file.close()
-
-
-def get_candidates(targets_group_file, gene_with_g_file_name, gene_only_name_file_name, group_pair_iden_cutoff_dict):
-
-    output_1 = open(gene_with_g_file_name, 'w')
-    output_2 = open(gene_only_name_file_name, 'w')
-
-    for group in open(targets_group_file):
-        group_split = group.strip().split('\t')
-        query = group_split[0]
-        query_split = query.split('|')
-        query_gene_name = query_split[1]
-        query_sg = query_split[0]
-        query_g = query_sg.split('_')[0]
-        subjects_list = group_split[1:]
-
-        # if only one non-self subject was found, no matter which group it comes from, ignored
-        if len(subjects_list) == 1:
-            pass
-
-        # if more than 1 non-self subject was found:
-        elif len(subjects_list) > 1:
-            # get the number of subjects from self-group and non_self_group
-            self_group_subject_list = []
-            non_self_group_subject_list = []
-            #print(non_self_group_subject_list)
-            for each_subject in subjects_list:
-
-                #print(each_subject)
-                #each_subject_g = each_subject[0]
-                each_subject_g = each_subject.split('|')[0].split('_')[0]
-                if each_subject_g == query_g:
-                    self_group_subject_list.append(each_subject)
-                else:
-                    non_self_group_subject_list.append(each_subject)
-
-
-            # if only the self-match was found in self-group, all matched from other groups, if any, will be ignored
-            if len(self_group_subject_list) == 0:
-                pass
-
-            # if no non-self-group subjects was found, ignored
-            elif (len(self_group_subject_list) > 0) and (len(non_self_group_subject_list) == 0):
-                pass
-
-            # if both non-self self-group subjects and non-self-group subject exist:
-            elif (len(self_group_subject_list) > 0) and (len(non_self_group_subject_list) > 0):
-                # get the number the groups
-                non_self_group_subject_list_uniq = []
-                for each_g in non_self_group_subject_list:
-                    each_g_group = each_g.split('|')[0].split('_')[0]
-                    if each_g_group not in non_self_group_subject_list_uniq:
-                        non_self_group_subject_list_uniq.append(each_g_group)
-
-                # if all non-self-group subjects come from the same group
-                if len(non_self_group_subject_list_uniq) == 1:
-
-                    # get the maximum and average identity from self-group
-                    sg_maximum = 0
-                    sg_sum = 0
-                    sg_subject_number = 0
-                    for each_sg_subject in self_group_subject_list:
-                        each_sg_subject_iden = float(each_sg_subject.split('|')[2])
-                        if each_sg_subject_iden > sg_maximum:
-                            sg_maximum = each_sg_subject_iden
-                        sg_sum += each_sg_subject_iden
-                        sg_subject_number += 1
-                    sg_average = sg_sum/sg_subject_number
-
-                    # get the maximum and average identity from non-self-group
-                    nsg_maximum = 0
-                    nsg_maximum_gene = ''
-                    nsg_sum = 0
-                    nsg_subject_number = 0
-                    for each_nsg_subject in non_self_group_subject_list:
-                        each_nsg_subject_iden = float(each_nsg_subject.split('|')[2])
-                        if each_nsg_subject_iden > nsg_maximum:
-                            nsg_maximum = each_nsg_subject_iden
-                            nsg_maximum_gene = each_nsg_subject
-                        nsg_sum += each_nsg_subject_iden
-                        nsg_subject_number += 1
-                    nsg_average = nsg_sum/nsg_subject_number
-
-                    # if the average non-self-group identity > average self-group identity,
-                    # Subject with maximum identity from this group will be considered as a HGT donor.
-                    if nsg_average > sg_average:
-                        # filter with obtained identity cut-off:
-                        candidate_g = nsg_maximum_gene.split('|')[0].split('_')[0]
-                        candidate_iden = float(nsg_maximum_gene.split('|')[2])
-                        qg_sg = '%s_%s' % (query_g, candidate_g)
-                        qg_sg_iden_cutoff = group_pair_iden_cutoff_dict[qg_sg]
-                        if candidate_iden >= qg_sg_iden_cutoff:
-                            output_1.write('%s\t%s\n' % (query, nsg_maximum_gene))
-                            output_2.write('%s\t%s\n' % (query_gene_name, nsg_maximum_gene.split('|')[1]))
-
-                # if non-self-group subjects come from different groups
-                elif len(non_self_group_subject_list_uniq) > 1:
-                    # get average/maximum for self-group
-                    sg_maximum = 0
-                    sg_sum = 0
-                    sg_subject_number = 0
-                    for each_sg_subject in self_group_subject_list:
-                        each_sg_subject_iden = float(each_sg_subject.split('|')[2])
-                        if each_sg_subject_iden > sg_maximum:
-                            sg_maximum = each_sg_subject_iden
-                        sg_sum += each_sg_subject_iden
-                        sg_subject_number += 1
-                    sg_average = sg_sum/sg_subject_number
-
-                    # get average/maximum for each non-self-group
-                    nsg_average_dict = {}
-                    nsg_maximum_dict = {}
-                    nsg_maximum_gene_name_dict = {}
-                    for each_nsg in non_self_group_subject_list_uniq:
-                        nsg_maximum = 0
-                        nsg_maximum_gene = ''
-                        nsg_sum = 0
-                        nsg_subject_number = 0
-                        for each_nsg_subject in non_self_group_subject_list:
-                            #print(non_self_group_subject_list)
-                            each_nsg_subject_iden = float(each_nsg_subject.split('|')[2])
-                            #print(each_nsg_subject)
-                            #print(each_nsg_subject[0])
-                            each_nsg_subject_group = each_nsg_subject.split('|')[0].split('_')[0]
-                            if each_nsg_subject_group == each_nsg:
-                                if each_nsg_subject_iden > nsg_maximum:
-                                    nsg_maximum = each_nsg_subject_iden
-                                    nsg_maximum_gene = each_nsg_subject
-                                nsg_sum += each_nsg_subject_iden
-                                nsg_subject_number += 1
-                        nsg_average = nsg_sum / nsg_subject_number
-                        nsg_average_dict[each_nsg] = nsg_average
-                        nsg_maximum_dict[each_nsg] = nsg_maximum
-                        nsg_maximum_gene_name_dict[each_nsg] = nsg_maximum_gene
-
-                    # get the group with maximum average group identity
-                    maximum_average = sg_average
-                    maximum_average_g = group[0]
-                    for each_g in nsg_average_dict:
-                        if nsg_average_dict[each_g] > maximum_average:
-                            maximum_average = nsg_average_dict[each_g]
-                            maximum_average_g = each_g
-
-                    # if the maximum average identity group is the self-group, ignored
-                    if maximum_average_g == group[0]:
-                        pass
-
-                    # if self-group average identity is not the maximum,
-                    # Group with maximum average identity will be considered as the candidate donor group,
-                    # Subject with maximum identity from the candidate donor group will be considered as a HGT donor.
-                    elif maximum_average_g != group[0]:
-                        # filter with obtained identity cut-off:
-                        candidate_g = nsg_maximum_gene_name_dict[maximum_average_g].split('|')[0].split('_')[0]
-                        candidate_iden = float(nsg_maximum_gene_name_dict[maximum_average_g].split('|')[2])
-                        qg_sg = '%s_%s' % (query_g, candidate_g)
-                        qg_sg_iden_cutoff = group_pair_iden_cutoff_dict[qg_sg]
-                        if candidate_iden >= qg_sg_iden_cutoff:
-                            output_1.write('%s\t%s\n' % (query, nsg_maximum_gene_name_dict[maximum_average_g]))
-                            output_2.write('%s\t%s\n' % (query_gene_name, nsg_maximum_gene_name_dict[maximum_average_g].split('|')[1]))
-    output_1.close()
-    output_2.close()
+            non_self_group_subject_list.append(each_subject)
+
+    # if only the self-match was found in self-group, all matched from other groups, if any, will be ignored
+    # if no non-self-group subjects was found, ignored
+    if (len(self_group_subject_list) == 0) or (len(non_self_group_subject_list) == 0):
+        return None
+
+    # get the number the groups
+    non_self_group_subject_list_uniq = []
+    for each_g in non_self_group_subject_list:
+        each_g_group = each_g.split('|')[0].split('_')[0]
+        if each_g_group not in non_self_group_subject_list_uniq:
+            non_self_group_subject_list_uniq.append(each_g_group)
+
+    # get the maximum and average identity from self-group
+    sg_sum = 0
+    sg_subject_number = 0
+    for each_sg_subject in self_group_subject_list:
+        sg_sum += float(each_sg_subject.split('|')[2])
+        sg_subject_number += 1
+    sg_average = sg_sum/sg_subject_number
+
+    # if all non-self-group subjects come from the same group
+    if len(non_self_group_subject_list_uniq) == 1:
+
+        # get the maximum and average identity from non-self-group
+        nsg_maximum = 0
+        nsg_maximum_gene = ''
+        nsg_sum = 0
+        nsg_subject_number = 0
+        for each_nsg_subject in non_self_group_subject_list:
+            each_nsg_subject_iden = float(each_nsg_subject.split('|')[2])
+            if each_nsg_subject_iden > nsg_maximum:
+                nsg_maximum = each_nsg_subject_iden
+                nsg_maximum_gene = each_nsg_subject
+            nsg_sum += each_nsg_subject_iden
+            nsg_subject_number += 1
+        nsg_average = nsg_sum/nsg_subject_number
+
+        # if the average non-self-group identity > average self-group identity,
+        # Subject with maximum identity from this group will be considered as a HGT donor.
+        if nsg_average > sg_average:
+            return nsg_maximum_gene
+
+    # if non-self-group subjects come from different groups
+    else:
+
+        # get average/maximum for each non-self-group
+        nsg_average_dict = {}
+        nsg_maximum_gene_name_dict = {}
+        for each_nsg in non_self_group_subject_list_uniq:
+            nsg_maximum = 0
+            nsg_maximum_gene = ''
+            nsg_sum = 0
+            nsg_subject_number = 0
+            for each_nsg_subject in non_self_group_subject_list:
+                each_nsg_subject_iden = float(each_nsg_subject.split('|')[2])
+                each_nsg_subject_group = each_nsg_subject.split('|')[0].split('_')[0]
+                if each_nsg_subject_group == each_nsg:
+                    if each_nsg_subject_iden > nsg_maximum:
+                        nsg_maximum = each_nsg_subject_iden
+                        nsg_maximum_gene = each_nsg_subject
+                    nsg_sum += each_nsg_subject_iden
+                    nsg_subject_number += 1
+            nsg_average_dict[each_nsg] = nsg_sum / nsg_subject_number
+            nsg_maximum_gene_name_dict[each_nsg] = nsg_maximum_gene
+
+        # get the group with maximum average group identity
+        maximum_average = sg_average
+        maximum_average_g = query[0]
+        for each_g in nsg_average_dict:
+            if nsg_average_dict[each_g] > maximum_average:
+                maximum_average = nsg_average_dict[each_g]
+                maximum_average_g = each_g
+
+        # if self-group average identity is not the maximum,
+        # Group with maximum average identity will be considered as the candidate donor group,
+        # Subject with maximum identity from the candidate donor group will be considered as a HGT donor.
+        if maximum_average_g != query[0]:
+            return nsg_maximum_gene_name_dict[maximum_average_g]
+
+    return None
 
 
 def check_match_direction(blast_hit_splitted):
@@ -688,6 +726,9 @@ def check_full_lenght_and_end_match(qualified_ctg_match_list, identity_cutoff):
 
 
 def set_contig_track_features(gene_contig, name_group_dict, candidate_list, HGT_iden, feature_set):
+
+    from reportlab.lib import colors
+
     # add features to feature set
     for feature in gene_contig.features:
         if feature.type == "CDS":
@@ -729,231 +770,327 @@ def set_contig_track_features(gene_contig, name_group_dict, candidate_list, HGT_
                                     label_position="middle")
 
 
-def get_flanking_region(input_gbk_file, HGT_candidate, flanking_length):
+# annotation index of genomes, kept across candidates in each worker process. Candidates are processed in batches of
+# the same genome pair, so only the most recently used genomes are kept, the least recently used one is removed first
+genome_annotation_index_max = 4
+genome_annotation_index_dict = {}
 
-    wd, gbk_file = os.path.split(input_gbk_file)
-    new_gbk_file = '%s/%s_%sbp_temp.gbk' % (wd, HGT_candidate, flanking_length)
-    new_gbk_final_file = '%s/%s_%sbp.gbk' % (wd, HGT_candidate, flanking_length)
-    new_fasta_final_file = '%s/%s_%sbp.fasta' % (wd, HGT_candidate, flanking_length)
 
-    # get flanking range of candidate
-    input_gbk = SeqIO.parse(input_gbk_file, "genbank")
-    new_start = 0
-    new_end = 0
-    contig_length = 0
-    for record in input_gbk:
-        contig_length = len(record.seq)
-        for gene in record.features:
-            # get contig length
-            if gene.type == 'source':
-                pass
-            # get new start and end points
-            elif 'locus_tag' in gene.qualifiers:
-                if gene.qualifiers['locus_tag'][0] == HGT_candidate:
-                    # get new start point
-                    new_start = gene.location.start - flanking_length
-                    if new_start < 0:
-                        new_start = 0
-                    # get new end point
-                    new_end = gene.location.end + flanking_length
-                    if new_end > contig_length:
-                        new_end = contig_length
-
-    # get genes within flanking region
-    keep_gene_list = []
-    input_gbk = SeqIO.parse(input_gbk_file, "genbank")
-    for record in input_gbk:
-        for gene in record.features:
-            if 'locus_tag' in gene.qualifiers:
-                if (gene.location.start < new_start) and (gene.location.end >= new_start):
-                    keep_gene_list.append(gene.qualifiers['locus_tag'][0])
-                    new_start = gene.location.start
-                elif (gene.location.start > new_start) and (gene.location.end < new_end):
-                    keep_gene_list.append(gene.qualifiers['locus_tag'][0])
-                elif (gene.location.start <= new_end) and (gene.location.end > new_end):
-                    keep_gene_list.append(gene.qualifiers['locus_tag'][0])
-                    new_end = gene.location.end
-
-    # remove genes not in flanking region from gbk file
-    input_gbk = SeqIO.parse(input_gbk_file, "genbank")
-    new_gbk = open(new_gbk_file, 'w')
-    for record in input_gbk:
-        new_record_features = []
-        for gene in record.features:
-            if gene.type == 'source':
-                new_record_features.append(gene)
-            elif 'locus_tag' in gene.qualifiers:
-                if gene.qualifiers['locus_tag'][0] in keep_gene_list:
-                    new_record_features.append(gene)
-        record.features = new_record_features
-        SeqIO.write(record, new_gbk, 'genbank')
-    new_gbk.close()
-
-    # remove sequences not in flanking region
-    new_gbk_full_length = SeqIO.parse(new_gbk_file, "genbank")
-    new_gbk_final = open(new_gbk_final_file, 'w')
-    new_fasta_final = open(new_fasta_final_file, 'w')
-    for record in new_gbk_full_length:
-        # get new sequence
-        new_seq = record.seq[new_start:new_end]
-        new_contig_length = len(new_seq)
-        new_record = SeqRecord(new_seq,
-                               id=record.id,
-                               name=record.name,
-                               description=record.description,
-                               annotations=record.annotations)
-
-        # get new location
-        new_record_features_2 = []
-        for gene in record.features:
-            if gene.type == 'source':
-                gene_location_new = ''
-                if gene.location.strand == 1:
-                    gene_location_new = FeatureLocation(0, new_contig_length, strand=+1)
-                if gene.location.strand == -1:
-                    gene_location_new = FeatureLocation(0, new_contig_length, strand=-1)
-                gene.location = gene_location_new
-                new_record_features_2.append(gene)
-            elif 'locus_tag' in gene.qualifiers:
-                gene_location_new = ''
-                if gene.location.strand == 1:
-                    if gene.location.start - new_start < 0:
-                        gene_location_new = FeatureLocation(0,
-                                                            gene.location.end - new_start,
-                                                            strand=+1)
-                    else:
-                        gene_location_new = FeatureLocation(gene.location.start - new_start,
-                                                            gene.location.end - new_start,
-                                                            strand=+1)
-                if gene.location.strand == -1:
-                    if gene.location.start - new_start < 0:
-                        gene_location_new = FeatureLocation(0,
-                                                            gene.location.end - new_start,
-                                                            strand=-1)
-                    else:
-                        gene_location_new = FeatureLocation(gene.location.start - new_start,
-                                                            gene.location.end - new_start,
-                                                            strand=-1)
-                gene.location = gene_location_new
-                new_record_features_2.append(gene)
-        new_record.features = new_record_features_2
-        SeqIO.write(new_record, new_gbk_final, 'genbank')
-        SeqIO.write(new_record, new_fasta_final, 'fasta')
-
-    new_gbk_final.close()
-    new_fasta_final.close()
-    os.system('rm %s' % new_gbk_file)
+def get_genome_annotation_index(pwd_gbk_file):
 
+    # move the genome to the end of the dict (most recently used)
+    if pwd_gbk_file in genome_annotation_index_dict:
+        genome_annotation_index_dict[pwd_gbk_file] = genome_annotation_index_dict.pop(pwd_gbk_file)
+        return genome_annotation_index_dict[pwd_gbk_file]
 
-def get_gbk_blast_act2(arguments_list):
+    # contigs are parsed once, sequences of contigs and flanking regions are sliced from them. CDS intervals (in the
+    # same order as in gbk file) of each contig and locus_tag to location dict are used to find genes in flanking regions
+    contig_record_list = []
+    contig_cds_list = []
+    locus_tag_to_location_dict = {}
+    for contig_index, contig_record in enumerate(SeqIO.parse(pwd_gbk_file, 'genbank')):
+        source_feature_list = []
+        cds_feature_list = []
+        for feature in contig_record.features:
+            if feature.type == 'source':
+                source_feature_list.append(feature)
+            elif 'locus_tag' in feature.qualifiers:
+                cds_feature_list.append(feature)
+                locus_tag_to_location_dict[feature.qualifiers['locus_tag'][0]] = (contig_index, int(feature.location.start), int(feature.location.end), feature.location.strand)
 
-    match = arguments_list[0]
-    pwd_gbk_folder = arguments_list[1]
-    flanking_length = arguments_list[2]
-    aln_len_cutoff = arguments_list[3]
-    name_to_group_number_dict = arguments_list[4]
-    path_to_output_act_folder = arguments_list[5]
-    pwd_normal_plot_folder = arguments_list[6]
-    pwd_at_ends_plot_folder = arguments_list[7]
-    pwd_full_contig_match_plot_folder = arguments_list[8]
-    pwd_blastn_exe = arguments_list[9]
-    keep_temp = arguments_list[10]
-    candidates_2_contig_match_category_dict = arguments_list[11]
-    end_match_iden_cutoff = arguments_list[12]
-    No_Eb_Check = arguments_list[13]
-    flk_plot_fmt = 'SVG'
+        cds_start_array = np.array([int(feature.location.start) for feature in cds_feature_list], dtype=np.int64)
+        cds_end_array = np.array([int(feature.location.end) for feature in cds_feature_list], dtype=np.int64)
+        contig_cds_list.append({'start':    cds_start_array,
+                                'end':      cds_end_array,
+                                'sorted':   bool(np.all(cds_start_array[1:] >= cds_start_array[:-1])),
+                                'max_len':  int(np.max(cds_end_array - cds_start_array)) if len(cds_feature_list) > 0 else 0,
+                                'source':   source_feature_list,
+                                'features': cds_feature_list})
+        contig_record_list.append(contig_record)
 
-    genes = match.strip().split('\t')[:-1]
-    current_HGT_iden = float("{0:.1f}".format(float(match.strip().split('\t')[-1])))
-    folder_name = '___'.join(genes)
-    os.mkdir('%s/%s' % (path_to_output_act_folder, folder_name))
-
-    gene_1 = genes[0]
-    gene_2 = genes[1]
-    genome_1 = '_'.join(gene_1.split('_')[:-1])
-    genome_2 = '_'.join(gene_2.split('_')[:-1])
-    pwd_genome_1_gbk = '%s/%s.gbk' % (pwd_gbk_folder, genome_1)
-    pwd_genome_2_gbk = '%s/%s.gbk' % (pwd_gbk_folder, genome_2)
-
-    dict_value_list = []
-    # Extract gbk and fasta files for gene 1
-    for genome_1_record in SeqIO.parse(pwd_genome_1_gbk, 'genbank'):
-        for gene_1_f in genome_1_record.features:
-            if 'locus_tag' in gene_1_f.qualifiers:
-                if gene_1 in gene_1_f.qualifiers["locus_tag"]:
-                    dict_value_list.append([gene_1, int(gene_1_f.location.start), int(gene_1_f.location.end), gene_1_f.location.strand, len(genome_1_record.seq)])
-                    pwd_gene_1_gbk_file = '%s/%s/%s.gbk' % (path_to_output_act_folder, folder_name, gene_1)
-                    pwd_gene_1_fasta_file = '%s/%s/%s.fasta' % (path_to_output_act_folder, folder_name, gene_1)
-                    SeqIO.write(genome_1_record, pwd_gene_1_gbk_file, 'genbank')
-                    SeqIO.write(genome_1_record, pwd_gene_1_fasta_file, 'fasta')
-                    # get flanking regions
-                    get_flanking_region(pwd_gene_1_gbk_file, gene_1, flanking_length)
-
-    # Extract gbk and fasta files for gene 2
-    for genome_2_record in SeqIO.parse(pwd_genome_2_gbk, 'genbank'):
-        for gene_2_f in genome_2_record.features:
-            if 'locus_tag' in gene_2_f.qualifiers:
-                if gene_2 in gene_2_f.qualifiers["locus_tag"]:
-                    dict_value_list.append([gene_2, int(gene_2_f.location.start), int(gene_2_f.location.end), gene_2_f.location.strand, len(genome_2_record.seq)])
-                    pwd_gene_2_gbk_file = '%s/%s/%s.gbk' % (path_to_output_act_folder, folder_name, gene_2)
-                    pwd_gene_2_fasta_file = '%s/%s/%s.fasta' % (path_to_output_act_folder, folder_name, gene_2)
-                    SeqIO.write(genome_2_record, pwd_gene_2_gbk_file, 'genbank')
-                    SeqIO.write(genome_2_record, pwd_gene_2_fasta_file, 'fasta')
-                    # get flanking regions
-                    get_flanking_region(pwd_gene_2_gbk_file, gene_2, flanking_length)
-
-    # Run Blast
-    prefix_c =              '%s/%s'                 % (path_to_output_act_folder, folder_name)
-    query_c =               '%s/%s_%sbp.fasta'      % (prefix_c, gene_1, flanking_length)
-    query_c_full_len =      '%s/%s.fasta'           % (prefix_c, gene_1)
-    subject_c =             '%s/%s_%sbp.fasta'      % (prefix_c, gene_2, flanking_length)
-    subject_c_full_len =    '%s/%s.fasta'           % (prefix_c, gene_2)
-    output_c =              '%s/%s.txt'             % (prefix_c, folder_name)
-    output_c_full_len =     '%s/%s_full_length.txt' % (prefix_c, folder_name)
-
-    parameters_c_n =          '-evalue 1e-5 -outfmt 6 -task blastn'
-    parameters_c_n_full_len = '-evalue 1e-5 -outfmt "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen" -task blastn'
-    command_blast =           '%s -query %s -subject %s -out %s %s' % (pwd_blastn_exe, query_c, subject_c, output_c, parameters_c_n)
-    command_blast_full_len =  '%s -query %s -subject %s -out %s %s' % (pwd_blastn_exe, query_c_full_len, subject_c_full_len, output_c_full_len, parameters_c_n_full_len)
+    while len(genome_annotation_index_dict) >= genome_annotation_index_max:
+        genome_annotation_index_dict.pop(next(iter(genome_annotation_index_dict)))
 
-    os.system(command_blast)
+    genome_annotation_index_dict[pwd_gbk_file] = {'gbk':                   pwd_gbk_file,
+                                                  'contig_records':        contig_record_list,
+                                                  'contig_cds':            contig_cds_list,
+                                                  'locus_tag_to_location': locus_tag_to_location_dict}
 
-    if No_Eb_Check is False:
-        os.system(command_blast_full_len)
+    return genome_annotation_index_dict[pwd_gbk_file]
 
-    ############################## check whether full length or end match ##############################
 
-    # get match category
-    if No_Eb_Check is True:
-        match_category = 'normal'
-    else:
-        # get qualified_ctg_match_list
-        min_ctg_match_aln_len = 100
-        qualified_ctg_match_list = []
-        for blast_hit in open(output_c_full_len):
-            blast_hit_split = blast_hit.strip().split('\t')
-            align_len = int(blast_hit_split[3])
-            if align_len >= min_ctg_match_aln_len:
-                qualified_ctg_match_list.append(blast_hit_split)
-
-        if len(qualified_ctg_match_list) == 0:
-            match_category = 'normal'
-        else:
-            match_category = check_full_lenght_and_end_match(qualified_ctg_match_list, end_match_iden_cutoff)
+def get_genome_contig(genome_annotation_index, contig_index):
+
+    # contig records are shared by all candidates on the contig, they should not be changed
+    return genome_annotation_index['contig_records'][contig_index]
+
+
+def get_relocated_feature(feature, feature_location_new):
+
+    # copy of feature with a new location, qualifiers are copied as gene names are changed for plotting
+    feature_new = copy.copy(feature)
+    feature_new.qualifiers = copy.deepcopy(feature.qualifiers)
+    feature_new.location = feature_location_new
+
+    return feature_new
+
+
+def get_flanking_region(genome_annotation_index, HGT_candidate, flanking_length):
+
+    # return the contig where HGT_candidate located and its flanking region
+    contig_index, gene_start, gene_end, gene_strand = genome_annotation_index['locus_tag_to_location'][HGT_candidate]
+    contig_record = get_genome_contig(genome_annotation_index, contig_index)
+    contig_cds = genome_annotation_index['contig_cds'][contig_index]
+    cds_start_array = contig_cds['start']
+    cds_end_array = contig_cds['end']
 
-    candidates_2_contig_match_category_dict[folder_name] = match_category
+    # get flanking range of candidate
+    contig_length = len(contig_record.seq)
+    new_start = gene_start - flanking_length
+    if new_start < 0:
+        new_start = 0
+    new_end = gene_end + flanking_length
+    if new_end > contig_length:
+        new_end = contig_length
+
+    # get genes within flanking region, flanking range will be extended to include genes located on its boundaries.
+    # If genes were sorted by start position, genes end before (new_start - the longest gene length) and
+    # genes start after new_end will not be checked
+    first_cds = 0
+    if contig_cds['sorted'] is True:
+        first_cds = int(np.searchsorted(cds_start_array, new_start - contig_cds['max_len'], side='left'))
+    keep_cds_index_set = set()
+    for cds_index in range(first_cds, len(cds_start_array)):
+        cds_start = cds_start_array[cds_index]
+        cds_end = cds_end_array[cds_index]
+        if (contig_cds['sorted'] is True) and (cds_start > new_end):
+            break
+        if (cds_start < new_start) and (cds_end >= new_start):
+            keep_cds_index_set.add(cds_index)
+            new_start = int(cds_start)
+        elif (cds_start > new_start) and (cds_end < new_end):
+            keep_cds_index_set.add(cds_index)
+        elif (cds_start <= new_end) and (cds_end > new_end):
+            keep_cds_index_set.add(cds_index)
+            new_end = int(cds_end)
+
+    # get new sequence
+    new_seq = contig_record.seq[new_start:new_end]
+    new_contig_length = len(new_seq)
+    flanking_record = SeqRecord(new_seq,
+                                id=contig_record.id,
+                                name=contig_record.name,
+                                description=contig_record.description,
+                                annotations=copy.copy(contig_record.annotations))
+
+    # get new location
+    flanking_record_features = []
+    for feature in contig_cds['source']:
+        feature_location_new = ''
+        if feature.location.strand in [1, -1]:
+            feature_location_new = FeatureLocation(0, new_contig_length, strand=feature.location.strand)
+        flanking_record_features.append(get_relocated_feature(feature, feature_location_new))
+    for cds_index in sorted(keep_cds_index_set):
+        feature = contig_cds['features'][cds_index]
+        feature_location_new = ''
+        if feature.location.strand in [1, -1]:
+            feature_location_new = FeatureLocation(max(feature.location.start - new_start, 0), feature.location.end - new_start, strand=feature.location.strand)
+        flanking_record_features.append(get_relocated_feature(feature, feature_location_new))
+    flanking_record.features = flanking_record_features
+
+    return contig_record, flanking_record
+
+
+def blastn_record_pairs(record_pair_list, pwd_blastn_exe, blastn_parameters, pwd_batch_prefix, max_query_per_batch, keep_temp):
+
+    # record_pair_list: [query key, query record, subject key, subject record], records with the same key are the
+    # same sequence. Pairs are grouped by query and up to max_query_per_batch queries are compared with the subjects
+    # of all of them in a single blastn run (bl2seq mode, statistics of each query-subject pair are computed
+    # separately), hits of pairs not in record_pair_list are discarded. Identical pairs are compared only once.
+    # return {(query key, subject key): [blastn output lines, with sequence ids of the records]}
+    query_to_subject_dict = {}
+    key_to_record_dict = {}
+    for query_key, query_record, subject_key, subject_record in record_pair_list:
+        if query_key not in query_to_subject_dict:
+            query_to_subject_dict[query_key] = []
+        if subject_key not in query_to_subject_dict[query_key]:
+            query_to_subject_dict[query_key].append(subject_key)
+        key_to_record_dict[('q', query_key)] = query_record
+        key_to_record_dict[('s', subject_key)] = subject_record
+
+    record_pair_to_hit_dict = {(query_key, subject_key): [] for query_key in query_to_subject_dict for subject_key in query_to_subject_dict[query_key]}
+    query_key_list = list(query_to_subject_dict)
+    for batch_index, batch_start in enumerate(range(0, len(query_key_list), max_query_per_batch)):
+        batch_query_key_list = query_key_list[batch_start:(batch_start + max_query_per_batch)]
+        batch_subject_key_list = []
+        for query_key in batch_query_key_list:
+            batch_subject_key_list += [i for i in query_to_subject_dict[query_key] if i not in batch_subject_key_list]
+
+        # sequences are renamed in batch files, as records from different genomes may share the same id
+        pwd_batch_query =   '%s_%s_query.fasta'   % (pwd_batch_prefix, batch_index + 1)
+        pwd_batch_subject = '%s_%s_subject.fasta' % (pwd_batch_prefix, batch_index + 1)
+        pwd_batch_output =  '%s_%s_blastn.txt'    % (pwd_batch_prefix, batch_index + 1)
+        with open(pwd_batch_query, 'w') as batch_query_handle:
+            batch_query_handle.write(''.join(['>q%s\n%s\n' % (i, str(key_to_record_dict[('q', query_key)].seq)) for i, query_key in enumerate(batch_query_key_list)]))
+        with open(pwd_batch_subject, 'w') as batch_subject_handle:
+            batch_subject_handle.write(''.join(['>s%s\n%s\n' % (i, str(key_to_record_dict[('s', subject_key)].seq)) for i, subject_key in enumerate(batch_subject_key_list)]))
+
+        profiled_system('%s -query %s -subject %s -out %s %s' % (pwd_blastn_exe, pwd_batch_query, pwd_batch_subject, pwd_batch_output, blastn_parameters), 'blastn')
+
+        # split hits back to record pairs
+        if os.path.isfile(pwd_batch_output):
+            for blast_hit in open(pwd_batch_output):
+                blast_hit_split = blast_hit.split('\t')
+                query_key = batch_query_key_list[int(blast_hit_split[0][1:])]
+                subject_key = batch_subject_key_list[int(blast_hit_split[1][1:])]
+                if (query_key, subject_key) in record_pair_to_hit_dict:
+                    blast_hit_split[0] = key_to_record_dict[('q', query_key)].id
+                    blast_hit_split[1] = key_to_record_dict[('s', subject_key)].id
+                    record_pair_to_hit_dict[(query_key, subject_key)].append('\t'.join(blast_hit_split))
+
+        if keep_temp == 0:
+            for pwd_batch_file in [pwd_batch_query, pwd_batch_subject, pwd_batch_output]:
+                if os.path.isfile(pwd_batch_file):
+                    os.remove(pwd_batch_file)
+
+    return record_pair_to_hit_dict
+
+
+def get_contig_match_category(contig_hit_list, end_match_iden_cutoff):
+
+    # contig_hit_list: blastn output lines of the contigs of both genes
+    min_ctg_match_aln_len = 100
+    qualified_ctg_match_list = []
+    for blast_hit in contig_hit_list:
+        blast_hit_split = blast_hit.strip().split('\t')
+        align_len = int(blast_hit_split[3])
+        if align_len >= min_ctg_match_aln_len:
+            qualified_ctg_match_list.append(blast_hit_split)
+
+    if len(qualified_ctg_match_list) == 0:
+        return 'normal'
+
+    return check_full_lenght_and_end_match(qualified_ctg_match_list, end_match_iden_cutoff)
+
+
+def contig_match_worker(arguments_list):
+
+    match_list = arguments_list[0]
+    pwd_gbk_folder = arguments_list[1]
+    path_to_output_act_folder = arguments_list[2]
+    pwd_blastn_exe = arguments_list[3]
+    keep_temp = arguments_list[4]
+    end_match_iden_cutoff = arguments_list[5]
+
+    # match_list: candidates between the same pair of genomes, return [folder name, match category] of each
+    # candidate, contigs are compared one query at a time as they can be long, candidates on the same pair of
+    # contigs share the same comparison
+    contig_pair_list = []
+    candidate_list = []
+    for match in match_list:
+        genes = match.strip().split('\t')[:-1]
+        folder_name = '___'.join(genes)
+        if keep_temp != 0:
+            os.mkdir('%s/%s' % (path_to_output_act_folder, folder_name))
+
+        contig_key_list = []
+        contig_record_list = []
+        for each_gene in genes:
+            pwd_genome_gbk = '%s/%s.gbk' % (pwd_gbk_folder, '_'.join(each_gene.split('_')[:-1]))
+            genome_annotation_index = get_genome_annotation_index(pwd_genome_gbk)
+            contig_index = genome_annotation_index['locus_tag_to_location'][each_gene][0]
+            contig_record = get_genome_contig(genome_annotation_index, contig_index)
+            contig_key_list.append((pwd_genome_gbk, contig_index))
+            contig_record_list.append(contig_record)
+            if keep_temp != 0:
+                SeqIO.write(contig_record, '%s/%s/%s.fasta' % (path_to_output_act_folder, folder_name, each_gene), 'fasta')
+
+        contig_pair_list.append([contig_key_list[0], contig_record_list[0], contig_key_list[1], contig_record_list[1]])
+        candidate_list.append([folder_name, contig_key_list])
+
+    # batch files are named by the first candidate
+    parameters_c_n_full_len = '-evalue 1e-5 -outfmt "6 qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore qlen slen" -task blastn'
+    contig_pair_to_hit_dict = blastn_record_pairs(contig_pair_list, pwd_blastn_exe, parameters_c_n_full_len, '%s/%s_batch_contig' % (path_to_output_act_folder, candidate_list[0][0]), 1, keep_temp)
+
+    match_category_list = []
+    for folder_name, contig_key_list in candidate_list:
+        contig_hit_list = contig_pair_to_hit_dict[(contig_key_list[0], contig_key_list[1])]
+        if keep_temp != 0:
+            with open('%s/%s/%s_full_length.txt' % (path_to_output_act_folder, folder_name, folder_name), 'w') as output_c_full_len_handle:
+                output_c_full_len_handle.write(''.join(contig_hit_list))
+        match_category_list.append([folder_name, get_contig_match_category(contig_hit_list, end_match_iden_cutoff)])
+
+    return match_category_list
 
 
+def get_gbk_blast_act2(arguments_list):
+
+    match_list = arguments_list[0]
+    pwd_gbk_folder = arguments_list[1]
+    flanking_length = arguments_list[2]
+    path_to_output_act_folder = arguments_list[3]
+    pwd_normal_plot_folder = arguments_list[4]
+    pwd_at_ends_plot_folder = arguments_list[5]
+    pwd_full_contig_match_plot_folder = arguments_list[6]
+    pwd_blastn_exe = arguments_list[7]
+    keep_temp = arguments_list[8]
+    candidates_2_contig_match_category_dict = arguments_list[9]
+
+    # match_list: candidates between the same pair of genomes, their flanking regions are compared with batched
+    # blastn runs, then each candidate is plotted into the folder of its contig match category
+    flanking_pair_list = []
+    candidate_list = []
+    for match in match_list:
+        genes = match.strip().split('\t')[:-1]
+        current_HGT_iden = float("{0:.1f}".format(float(match.strip().split('\t')[-1])))
+        folder_name = '___'.join(genes)
+        if not os.path.isdir('%s/%s' % (path_to_output_act_folder, folder_name)):
+            os.mkdir('%s/%s' % (path_to_output_act_folder, folder_name))
+
+        # extract contig and flanking region sequences of both genes, from annotation index of their genomes
+        dict_value_list = []
+        flanking_record_list = []
+        for each_gene in genes:
+            pwd_genome_gbk = '%s/%s.gbk' % (pwd_gbk_folder, '_'.join(each_gene.split('_')[:-1]))
+            genome_annotation_index = get_genome_annotation_index(pwd_genome_gbk)
+            contig_record, flanking_record = get_flanking_region(genome_annotation_index, each_gene, flanking_length)
+            gene_location = genome_annotation_index['locus_tag_to_location'][each_gene]
+            dict_value_list.append([each_gene, gene_location[1], gene_location[2], gene_location[3], len(contig_record.seq)])
+            flanking_record_list.append(flanking_record)
+            if keep_temp != 0:
+                SeqIO.write(flanking_record, '%s/%s/%s_%sbp.fasta' % (path_to_output_act_folder, folder_name, each_gene, flanking_length), 'fasta')
+                SeqIO.write(flanking_record, '%s/%s/%s_%sbp.gbk' % (path_to_output_act_folder, folder_name, each_gene, flanking_length), 'genbank')
+
+        flanking_pair_list.append([genes[0], flanking_record_list[0], genes[1], flanking_record_list[1]])
+        candidate_list.append([genes, current_HGT_iden, folder_name, dict_value_list, flanking_record_list])
+
+    # Run Blast, batch files are named by the first candidate
+    parameters_c_n = '-evalue 1e-5 -outfmt 6 -task blastn'
+    flanking_pair_to_hit_dict = blastn_record_pairs(flanking_pair_list, pwd_blastn_exe, parameters_c_n, '%s/%s_batch_flanking' % (path_to_output_act_folder, candidate_list[0][2]), 10, keep_temp)
+
+    for genes, current_HGT_iden, folder_name, dict_value_list, flanking_record_list in candidate_list:
+        with open('%s/%s/%s.txt' % (path_to_output_act_folder, folder_name, folder_name), 'w') as output_c_handle:
+            output_c_handle.write(''.join(flanking_pair_to_hit_dict[(genes[0], genes[1])]))
+
+        plot_flanking_region(genes, current_HGT_iden, folder_name, dict_value_list, flanking_record_list, path_to_output_act_folder, pwd_normal_plot_folder,
+                             pwd_at_ends_plot_folder, pwd_full_contig_match_plot_folder, keep_temp, candidates_2_contig_match_category_dict[folder_name])
+
+
+def plot_flanking_region(genes, current_HGT_iden, folder_name, dict_value_list, flanking_record_list, path_to_output_act_folder, pwd_normal_plot_folder,
+                         pwd_at_ends_plot_folder, pwd_full_contig_match_plot_folder, keep_temp, match_category):
+
+    from Bio.Graphics import GenomeDiagram
+    from Bio.Graphics.GenomeDiagram import CrossLink
+    from reportlab.lib import colors
+    from reportlab.lib.units import cm
+
+    name_to_group_number_dict = worker_context_dict['name_to_group_number_dict']
+    flk_plot_fmt = 'SVG'
+
     ############################## prepare for flanking plot ##############################
 
-    # read in gbk files
-    matche_pair_list = []
-    for each_gene in genes:
-        path_to_gbk_file = '%s/%s/%s_%sbp.gbk' % (path_to_output_act_folder, folder_name, each_gene, flanking_length)
-        gene_contig = SeqIO.read(path_to_gbk_file, "genbank")
-        matche_pair_list.append(gene_contig)
     bin_record_list = []
-    bin_record_list.append(matche_pair_list)
+    bin_record_list.append(flanking_record_list)
 
     # get the distance of the gene to contig ends
     gene_1_left_len = dict_value_list[0][1]
@@ -1079,45 +1216,70 @@ def get_gbk_blast_act2(arguments_list):
             shutil.rmtree('%s/%s' % (path_to_output_act_folder, folder_name), ignore_errors=True)
 
 
+def get_genome_pair_match_batches(match_list, num_threads):
+
+    # candidates are grouped by genome pair, large groups are split to keep all cores busy
+    genome_pair_to_match_dict = {}
+    for match in match_list:
+        genome_pair = tuple(['_'.join(i.split('_')[:-1]) for i in match.strip().split('\t')[:2]])
+        if genome_pair not in genome_pair_to_match_dict:
+            genome_pair_to_match_dict[genome_pair] = []
+        genome_pair_to_match_dict[genome_pair].append(match)
+    max_match_per_batch = max(1, min(20, -(-len(match_list) // num_threads)))
+
+    match_batch_list = []
+    for genome_pair, genome_pair_match_list in genome_pair_to_match_dict.items():
+        for match_index in range(0, len(genome_pair_match_list), max_match_per_batch):
+            match_batch_list.append(genome_pair_match_list[match_index:(match_index + max_match_per_batch)])
+
+    return match_batch_list
+
+
+def plot_flanking_regions(match_list, candidates_2_contig_match_category_dict, name_to_group_number_dict, pwd_gbk_folder, flanking_length, pwd_op_act_folder,
+                          pwd_normal_folder, pwd_end_match_folder, pwd_full_length_match_folder, pwd_blastn_exe, keep_temp, num_threads):
+
+    # match_list: "gene_1\tgene_2\tidentity" lines of candidates to plot
+    list_for_multiple_arguments_flanking_regions = []
+    for match_batch in get_genome_pair_match_batches(match_list, num_threads):
+        match_batch_folder_name_list = ['___'.join(i.strip().split('\t')[:2]) for i in match_batch]
+        match_batch_category_dict = {i: candidates_2_contig_match_category_dict[i] for i in match_batch_folder_name_list}
+        list_for_multiple_arguments_flanking_regions.append([match_batch, pwd_gbk_folder, flanking_length, pwd_op_act_folder, pwd_normal_folder, pwd_end_match_folder,
+                                                             pwd_full_length_match_folder, pwd_blastn_exe, keep_temp, match_batch_category_dict])
+
+    pool_flanking_regions = get_worker_context_pool(num_threads, {'name_to_group_number_dict': name_to_group_number_dict})
+    profiled_pool_map(pool_flanking_regions, get_gbk_blast_act2, list_for_multiple_arguments_flanking_regions)
+    pool_flanking_regions.close()
+    pool_flanking_regions.join()
+
+
 def remove_bidirection(input_file, candidate2identity_dict, output_file):
-    input = open(input_file)
-    output = open(output_file, 'w')
 
-    # get overall list
-    overall = []
-    for each in input:
-        overall.append(each.strip())
+    # candidates are (recipient, donor) tuples, the input file is read twice instead of being kept in memory,
+    # candidates found in both directions are written after the others, in input order
 
     # get overlap list
-    tmp_list = []
+    candidate_set = set()
+    overlap_set = set()
     overlap_list = []
-    for each in overall:
-        each_split = each.split('\t')
-        each_reverse = '%s\t%s' % (each_split[1], each_split[0])
-        tmp_list.append(each)
-        if each_reverse in tmp_list:
-            overlap_list.append(each)
-
-    # get non-overlap list
-    non_overlap_list = []
-    for each in overall:
-        each_split = each.split('\t')
-        each_reverse = '%s\t%s' % (each_split[1], each_split[0])
-        if (each not in overlap_list) and (each_reverse not in overlap_list):
-            non_overlap_list.append(each)
-
-    # get output
-    for each in non_overlap_list:
-        each_split = each.split('\t')
-        each_concatenated = '%s___%s' % (each_split[0], each_split[1])
-        output.write('%s\t%s\n' % (each, candidate2identity_dict[each_concatenated]))
-    for each in overlap_list:
-        each_concatenated = '%s___%s' % (each.split('\t')[0], each.split('\t')[1])
-        output.write('%s\t%s\n' % (each, candidate2identity_dict[each_concatenated]))
+    for each in open(input_file):
+        each_candidate = tuple(each.strip().split('\t'))
+        candidate_set.add(each_candidate)
+        if (each_candidate[1], each_candidate[0]) in candidate_set:
+            overlap_set.add(each_candidate)
+            overlap_list.append(each_candidate)
+
+    # write non-overlap candidates, then overlap candidates
+    output = open(output_file, 'w')
+    for each in open(input_file):
+        each_candidate = tuple(each.strip().split('\t'))
+        if (each_candidate not in overlap_set) and ((each_candidate[1], each_candidate[0]) not in overlap_set):
+            output.write('%s\t%s\n' % ('\t'.join(each_candidate), candidate2identity_dict['%s___%s' % (each_candidate[0], each_candidate[1])]))
+    for each_candidate in overlap_list:
+        output.write('%s\t%s\n' % ('\t'.join(each_candidate), candidate2identity_dict['%s___%s' % (each_candidate[0], each_candidate[1])]))
     output.close()
 
 
-def export_HGT_query_to_subjects(pwd_BM_HGTs, pwd_blast_subjects_in_one_line, pwd_query_to_subjects_file):
+def export_HGT_query_to_subjects(pwd_BM_HGTs, blast_hit_store, align_len_cutoff, cover_cutoff, genome_group_number_list, genome_group_code, pwd_query_to_subjects_file):
 
     HGT_candidates = set()
     for HGT_pair in open(pwd_BM_HGTs):
@@ -1127,102 +1289,160 @@ def export_HGT_query_to_subjects(pwd_BM_HGTs, pwd_blast_subjects_in_one_line, pw
         HGT_candidates.add(gene_1)
         HGT_candidates.add(gene_2)
 
-    query_subjects_dict = {}
-    for each_gene in open(pwd_blast_subjects_in_one_line):
-        each_gene_split = each_gene.strip().split('\t')
-        query = each_gene_split[0].split('|')[1]
-        subjects = [i.split('|')[1] for i in each_gene_split[1:]]
-        if query in HGT_candidates:
-            query_subjects_dict[query] = subjects
+    # get qualified hits with HGT candidates as query
+    HGT_candidate_ids = get_gene_id(blast_hit_store, sorted(HGT_candidates))
+    qualified_rows = get_qualigied_blast_hits(blast_hit_store, 0, len(blast_hit_store['query']), align_len_cutoff, cover_cutoff, genome_group_code)
+    qualified_rows = qualified_rows[np.isin(blast_hit_store['query'][qualified_rows], HGT_candidate_ids[HGT_candidate_ids >= 0])]
 
     pwd_query_to_subjects_file_handle = open(pwd_query_to_subjects_file, 'w')
-    for each in query_subjects_dict:
-        for_out = '%s\t%s\n' % (each, ','.join(query_subjects_dict[each]))
+    for query_with_group, subjects_list in get_query_subjects(blast_hit_store, qualified_rows, genome_group_number_list):
+        for_out = '%s\t%s\n' % (query_with_group.split('|')[1], ','.join([i.split('|')[1] for i in subjects_list]))
         pwd_query_to_subjects_file_handle.write(for_out)
     pwd_query_to_subjects_file_handle.close()
 
 
-def filter_blast_results_worker(argument_list):
-    pwd_blast_results = argument_list[0]
-    align_len_cutoff = argument_list[1]
-    cover_cutoff = argument_list[2]
-    genome_name_list = argument_list[3]
-    pwd_qualified_iden_file = argument_list[4]
-
-    get_qualigied_blast_hits(pwd_blast_results, align_len_cutoff, cover_cutoff, genome_name_list, pwd_qualified_iden_file)
-
-
-def get_g2g_identities_worker(argument_list):
-    pwd_qualified_iden_file = argument_list[0]
-    name_to_group_number_dict = argument_list[1]
-    pwd_qualified_iden_file_g2g = argument_list[2]
-
-    qualified_identities_g_g = open(pwd_qualified_iden_file_g2g, 'w')
-    for each_identity in open(pwd_qualified_iden_file):
-        each_identity_split = each_identity.strip().split('\t')
-        query = each_identity_split[0]
-        subject = each_identity_split[1]
-        identity = float(each_identity_split[2])
-        query_genome_name = '_'.join(query.split('_')[:-1])
-        subject_genome_name = '_'.join(subject.split('_')[:-1])
-        query_group = name_to_group_number_dict[query_genome_name].split('_')[0]
-        subject_group = name_to_group_number_dict[subject_genome_name].split('_')[0]
-        paired_group_list = [query_group, subject_group]
-
-        # query and subjects name sorted by alphabet order here
-        paired_group_list_sorted = sorted(paired_group_list)
-        g_g = '%s_%s' % (paired_group_list_sorted[0], paired_group_list_sorted[1])
-        qualified_identities_g_g.write('%s\t%s\n' % (g_g, identity))
-
-    qualified_identities_g_g.close()
-
-
-def get_HGT_worker(argument_list):
-    pwd_qualified_iden_file = argument_list[0]
-    name_to_group_number_dict = argument_list[1]
-    pwd_qual_idens_with_group = argument_list[2]
-    pwd_qual_idens_subjects_in_one_line = argument_list[3]
-    pwd_hgt_candidates_with_group = argument_list[4]
-    pwd_hgt_candidates_only_gene = argument_list[5]
-    group_pair_iden_cutoff_dict = argument_list[6]
-
-
-    file_path, file_basename, file_extension = sep_path_basename_ext(pwd_qual_idens_with_group)
-    pwd_qual_idens_with_group_tmp = '%s/%s_tmp.%s' % (file_path, file_basename, file_extension)
-
-    qualified_matches_with_group = open(pwd_qual_idens_with_group_tmp, 'w')
-    for qualified_identity in open(pwd_qualified_iden_file):
-        qualified_identity_split = qualified_identity.strip().split('\t')
-        query = qualified_identity_split[0]
-        query_split = query.split('_')
-        query_bin = '_'.join(query_split[:-1])
-        subject = qualified_identity_split[1]
-        subject_split = subject.split('_')
-        subject_bin = '_'.join(subject_split[:-1])
-        identity = float(qualified_identity_split[2])
-        file_write = '%s|%s\t%s|%s|%s\n' % (
-            name_to_group_number_dict[query_bin], query, name_to_group_number_dict[subject_bin], subject, str(identity))
-        qualified_matches_with_group.write(file_write)
-    qualified_matches_with_group.close()
-
-    # sort
-    os.system('cat %s | sort > %s' % (pwd_qual_idens_with_group_tmp, pwd_qual_idens_with_group))
-    os.system('rm %s' % pwd_qual_idens_with_group_tmp)
-
-    # put subjects in one line
-    get_hits_group(pwd_qual_idens_with_group, pwd_qual_idens_subjects_in_one_line)
-
-    # get HGT candidates
-    get_candidates(pwd_qual_idens_subjects_in_one_line,
-                   pwd_hgt_candidates_with_group,
-                   pwd_hgt_candidates_only_gene,
-                   group_pair_iden_cutoff_dict)
-
-
-def subset_tree(tree_file_in, leaf_node_list, tree_file_out):
-    tree_in = Tree(tree_file_in, format=0)
-    tree_in.prune(leaf_node_list, preserve_branch_length=True)
-    tree_in.write(format=0, outfile=tree_file_out)
+def get_involved_genome_groups(blast_hit_store, row_start, row_end, genome_group_number_list):
+
+    # group number (e.g. A_1) of query and subject genomes of hits between row_start and row_end, '' if not grouped
+    gene_genome = blast_hit_store['gene_genome']
+    involved_genomes = np.union1d(gene_genome[blast_hit_store['query'][row_start:row_end]], gene_genome[blast_hit_store['subject'][row_start:row_end]])
+
+    return {blast_hit_store['genome_names'][genome_id].decode(): genome_group_number_list[genome_id] for genome_id in involved_genomes}
+
+
+def read_BM_stream_cache(pwd_BM_stream_cache_file, blast_hit_store, row_start, row_end, BM_parameters, genome_group_number_list):
+
+    # cached results are valid for the hits they were obtained from, if cutoffs, the hits and the group number of
+    # involved genomes did not change, hits appended to the blast result file since then are not in the cache
+    if not os.path.isfile(pwd_BM_stream_cache_file):
+        return None
+
+    with open(pwd_BM_stream_cache_file) as BM_stream_cache_handle:
+        BM_stream_cache = json.load(BM_stream_cache_handle)
+
+    cached_row_end = row_start + BM_stream_cache['rows']
+    if (BM_stream_cache['parameters'] != BM_parameters) or (cached_row_end > row_end):
+        return None
+    if get_row_fingerprint(blast_hit_store, row_start, cached_row_end) != BM_stream_cache['fingerprint']:
+        return None
+    if get_involved_genome_groups(blast_hit_store, row_start, cached_row_end, genome_group_number_list) != BM_stream_cache['genome_groups']:
+        return None
+
+    return BM_stream_cache
+
+
+def write_BM_stream_cache(pwd_BM_stream_cache_file, blast_hit_store, row_start, row_end, BM_parameters, genome_group_number_list, group_pair_identity_histogram_dict, best_match_dict):
+
+    # histograms are saved as non-zero bins and their counts
+    BM_stream_cache = {'parameters':    BM_parameters,
+                       'rows':          row_end - row_start,
+                       'fingerprint':   get_row_fingerprint(blast_hit_store, row_start, row_end),
+                       'genome_groups': get_involved_genome_groups(blast_hit_store, row_start, row_end, genome_group_number_list),
+                       'histograms':    {g_g: [i.tolist() for i in get_sparse_identity_histogram(identity_histogram)] for g_g, identity_histogram in group_pair_identity_histogram_dict.items()},
+                       'best_matches':  best_match_dict}
+
+    with open('%s.tmp' % pwd_BM_stream_cache_file, 'w') as BM_stream_cache_handle:
+        json.dump(BM_stream_cache, BM_stream_cache_handle)
+    os.replace('%s.tmp' % pwd_BM_stream_cache_file, pwd_BM_stream_cache_file)
+
+
+def BM_stream_rank(blast_hit_store, row_start, row_end, qualified_hit_mask, align_len_cutoff, cover_cutoff, group_list, genome_group_number_list, genome_group_code, pwd_BM_stream_cache_file, incremental):
+
+    # hits of a genome are filtered, grouped into group-to-group identities and best-match donors of a rank in a
+    # single pass through the memory-mapped blast hit store, qualified_hit_mask covers rows between row_start and row_end
+    BM_parameters = 'al%s_c%s' % (align_len_cutoff, cover_cutoff)
+
+    # in incremental mode, results of hits analysed in previous run are reused, only hits appended to the blast
+    # result file since then are filtered and only queries with new qualified hits get their best-match again
+    BM_stream_cache = None
+    if incremental is True:
+        BM_stream_cache = read_BM_stream_cache(pwd_BM_stream_cache_file, blast_hit_store, row_start, row_end, BM_parameters, genome_group_number_list)
+
+    group_pair_identity_histogram_dict = {}
+    best_match_dict = {}
+    cached_row_end = row_start
+    BM_stream_status = 'computed'
+    if BM_stream_cache is not None:
+        for g_g, (identity_bin_index, identity_bin_count) in BM_stream_cache['histograms'].items():
+            group_pair_identity_histogram_dict[g_g] = np.zeros(identity_bin_number, dtype=np.uint32)
+            group_pair_identity_histogram_dict[g_g][identity_bin_index] = identity_bin_count
+        best_match_dict = BM_stream_cache['best_matches']
+        cached_row_end = row_start + BM_stream_cache['rows']
+        BM_stream_status = 'reused' if cached_row_end == row_end else 'updated'
+
+    qualified_rows = get_qualigied_blast_hits(blast_hit_store, cached_row_end, row_end, align_len_cutoff, cover_cutoff, genome_group_code, qualified_hit_mask[(cached_row_end - row_start):])
+    new_group_pair_identity_histogram_dict = get_g2g_identity_histograms(blast_hit_store, qualified_rows, genome_group_code, group_list)
+    for g_g in new_group_pair_identity_histogram_dict:
+        if g_g not in group_pair_identity_histogram_dict:
+            group_pair_identity_histogram_dict[g_g] = np.zeros(identity_bin_number, dtype=np.uint32)
+        group_pair_identity_histogram_dict[g_g] += new_group_pair_identity_histogram_dict[g_g]
+
+    # queries with new hits are analysed with all their qualified hits
+    if (BM_stream_cache is not None) and (len(qualified_rows) > 0):
+        updated_query_ids = np.unique(blast_hit_store['query'][qualified_rows])
+        qualified_rows = get_qualigied_blast_hits(blast_hit_store, row_start, row_end, align_len_cutoff, cover_cutoff, genome_group_code, qualified_hit_mask)
+        qualified_rows = qualified_rows[np.isin(blast_hit_store['query'][qualified_rows], updated_query_ids)]
+
+    # get best-match donors, identity cutoff will be applied after identities from all genomes were collected
+    for query_with_group, subjects_list in get_query_subjects(blast_hit_store, qualified_rows, genome_group_number_list):
+        donor = get_best_match_donor(query_with_group, subjects_list)
+        if donor is not None:
+            best_match_dict[query_with_group] = donor
+        else:
+            best_match_dict.pop(query_with_group, None)
+
+    if BM_stream_status != 'reused':
+        write_BM_stream_cache(pwd_BM_stream_cache_file, blast_hit_store, row_start, row_end, BM_parameters, genome_group_number_list, group_pair_identity_histogram_dict, best_match_dict)
+
+    best_match_list = sorted([[query_with_group, donor] for query_with_group, donor in best_match_dict.items()])
+
+    # histograms are returned as non-zero bins and their counts to keep results sent to the main process small
+    group_pair_sparse_histogram_dict = {g_g: get_sparse_identity_histogram(identity_histogram) for g_g, identity_histogram in group_pair_identity_histogram_dict.items()}
+
+    return group_pair_sparse_histogram_dict, best_match_list, BM_stream_status
+
+
+def BM_stream_worker(argument_list):
+
+    pwd_blast_hit_store_folder = argument_list[0]
+    row_start =                  argument_list[1]
+    row_end =                    argument_list[2]
+    align_len_cutoff =           argument_list[3]
+    cover_cutoff =               argument_list[4]
+    pwd_BM_stream_cache_file =   argument_list[5]
+    incremental =                argument_list[6]
+    group_list =                 worker_context_dict['group_list']
+    genome_group_number_list =   worker_context_dict['genome_group_number_list']
+    genome_group_code =          worker_context_dict['genome_group_code']
+
+    blast_hit_store = load_blast_hit_store(pwd_blast_hit_store_folder)
+    qualified_hit_mask = get_qualified_hit_mask(blast_hit_store, row_start, row_end, align_len_cutoff, cover_cutoff)
+
+    return BM_stream_rank(blast_hit_store, row_start, row_end, qualified_hit_mask, align_len_cutoff, cover_cutoff, group_list, genome_group_number_list, genome_group_code, pwd_BM_stream_cache_file, incremental)
+
+
+def BM_multi_rank_stream_worker(argument_list):
+
+    pwd_blast_hit_store_folder = argument_list[0]
+    row_start =                  argument_list[1]
+    row_end =                    argument_list[2]
+    align_len_cutoff =           argument_list[3]
+    cover_cutoff =               argument_list[4]
+    rank_grouping_list =         argument_list[5]
+    incremental =                argument_list[6]
+
+    # hits of a genome are read and filtered with rank independent criteria once, then evaluated for each rank,
+    # rank_grouping_list: [rank, cache file] of ranks in which the genome was grouped, group_list,
+    # genome_group_number_list and genome_group_code of each rank are in the worker context
+    blast_hit_store = load_blast_hit_store(pwd_blast_hit_store_folder)
+    qualified_hit_mask = get_qualified_hit_mask(blast_hit_store, row_start, row_end, align_len_cutoff, cover_cutoff)
+
+    rank_to_BM_stream_result_dict = {}
+    for rank, pwd_BM_stream_cache_file in rank_grouping_list:
+        group_list, genome_group_number_list, genome_group_code = worker_context_dict['rank_group_code_dict'][rank]
+        rank_to_BM_stream_result_dict[rank] = BM_stream_rank(blast_hit_store, row_start, row_end, qualified_hit_mask, align_len_cutoff, cover_cutoff, group_list, genome_group_number_list, genome_group_code, pwd_BM_stream_cache_file, incremental)
+
+    return rank_to_BM_stream_result_dict
 
 
 def get_species_tree_alignment(tmp_folder, path_to_prokka, path_to_hmm, pwd_hmmsearch_exe, pwd_mafft_exe):
@@ -1343,153 +1563,10 @@ def get_species_tree_newick(tmp_folder, each_subset, pwd_fasttree_exe, tree_fold
     #Phylo.draw_ascii(species_tree)
 
 
-def remove_low_cov_and_consensus_columns(alignment_file_in, minimal_cov, min_consensus, alignment_file_out):
-
-    def list_to_segments(list_in):
-
-        segments_out = []
-        current_element = None
-        current_segment = [None, None]
-        for each_element in list_in:
-
-            # for the first ellment
-            if current_element == None:
-                current_element = each_element
-                current_segment = [each_element, each_element]
-
-            elif each_element == current_element + 1:
-                current_segment[1] = each_element
-                current_element = each_element
-
-            elif each_element != current_element + 1:
-
-                # add segment to list
-                segments_out.append(current_segment)
-
-                # resetting segment
-                current_segment = [each_element, each_element]
-                current_element = each_element
-
-        # add segment to list
-        segments_out.append(current_segment)
-
-        return segments_out
-
-    def remove_columns_from_msa(alignment_in, cols_to_remove):
-
-        # get 0 based index of all wanted columns
-        cols_to_remove_0_base = [(i - 1) for i in cols_to_remove]
-        aln_cols_index_all = list(range(alignment_in.get_alignment_length()))
-        aln_cols_index_wanted = []
-        for i in aln_cols_index_all:
-            if i not in cols_to_remove_0_base:
-                aln_cols_index_wanted.append(i)
-
-        # get wanted alignment segments
-        wanted_segments = list_to_segments(aln_cols_index_wanted)
-
-        # create an empty Alignment object
-        alignment_new = Align.MultipleSeqAlignment([])
-        for sequence in alignment_in:
-            new_seq_object = Seq('')
-            new_seq_record = SeqRecord(new_seq_object)
-            new_seq_record.id = sequence.id
-            new_seq_record.description = sequence.description
-            alignment_new.append(new_seq_record)
-
-        # add wanted columns to empty Alignment object
-        for segment in wanted_segments:
-
-            # for single column segment
-            if segment[0] == segment[1]:
-                segment_value = alignment_in[:, segment[0]]
-
-                m = 0
-                for each_seq in alignment_new:
-                    each_seq.seq = Seq(str(each_seq.seq) + segment_value[m])
-                    m += 1
-
-            # for multiple columns segment
-            else:
-                segment_value = alignment_in[:, (segment[0]):(segment[1] + 1)]
-                alignment_new += segment_value
-
-        return alignment_new
-
-    def remove_low_cov_columns(alignment_in, min_cov_cutoff):
-
-        # get columns with low coverage
-        sequence_number = len(alignment_in)
-        total_col_num = alignment_in.get_alignment_length()
-        low_cov_columns = []
-        n = 0
-        while n < total_col_num:
-            current_column = alignment_in[:, n]
-            dash_number = current_column.count('-')
-            gap_percent = (dash_number / sequence_number) * 100
-
-            if gap_percent > min_cov_cutoff:
-                low_cov_columns.append(n + 1)
-
-            n += 1
-
-        # remove identified columns
-        alignment_new = remove_columns_from_msa(alignment_in, low_cov_columns)
-
-        return alignment_new
-
-    def remove_low_consensus_columns(alignment_in, min_css_cutoff):
-
-        # get columns with low coverage
-        sequence_number = len(alignment_in)
-        total_col_num = alignment_in.get_alignment_length()
-        low_css_columns = []
-        n = 0
-        while n < total_col_num:
-            current_column = alignment_in[:, n]
-
-            # get all aa in current column
-            aa_list = set()
-            for aa in current_column:
-                aa_list.add(aa)
-
-            # get maximum aa percent
-            most_abundant_aa_percent = 0
-            for each_aa in aa_list:
-                each_aa_percent = (current_column.count(each_aa) / sequence_number) * 100
-                if each_aa_percent > most_abundant_aa_percent:
-                    most_abundant_aa_percent = each_aa_percent
-
-            # if maximum percent lower than provided cutoff, add current column to low consensus column list
-            if most_abundant_aa_percent < min_css_cutoff:
-                low_css_columns.append(n + 1)
-
-            n += 1
-
-        # remove identified columns
-        alignment_new = remove_columns_from_msa(alignment_in, low_css_columns)
-
-        return alignment_new
-
-    # read in alignment
-    alignment = AlignIO.read(alignment_file_in, "fasta")
-
-    # remove_low_cov_columns
-    alignment_cov = remove_low_cov_columns(alignment, minimal_cov)
-
-    # remove_low_consensus_columns
-    alignment_cov_css = remove_low_consensus_columns(alignment_cov, min_consensus)
-
-    # write filtered alignment
-    alignment_file_out_handle = open(alignment_file_out, 'w')
-    for each_seq in alignment_cov_css:
-        alignment_file_out_handle.write('>%s\n' % str(each_seq.id))
-        alignment_file_out_handle.write('%s\n' % str(each_seq.seq))
-    alignment_file_out_handle.close()
-
-
 def get_ctg_match_cate_and_identity_distribution_plot(pwd_candidates_file_ET, pwd_plot_ctg_match_cate, pwd_iden_distribution_plot_BM, pwd_iden_distribution_plot_PG):
 
+    plt = import_pyplot()
+
     # read in prediction results
     HGT_num_BM_normal = 0
     HGT_num_BM_at_end = 0
@@ -1601,18 +1678,63 @@ def get_ctg_match_cate_and_identity_distribution_plot(pwd_candidates_file_ET, pw
     plt.clf()
 
 
+def get_fasta_offset_index(pwd_fasta_file, seq_id_set=None):
+
+    # faidx-style index: sequence id -> (byte offset of sequence, byte length of sequence lines),
+    # only sequences in seq_id_set will be indexed if provided
+    fasta_offset_index_dict = {}
+    current_seq_id = None
+    current_seq_offset = 0
+    current_offset = 0
+    with open(pwd_fasta_file, 'rb') as fasta_handle:
+        for each_line in fasta_handle:
+            if each_line.startswith(b'>'):
+                if current_seq_id is not None:
+                    fasta_offset_index_dict[current_seq_id] = (current_seq_offset, current_offset - current_seq_offset)
+                seq_title = each_line[1:].decode().strip()
+                current_seq_id = seq_title.split(None, 1)[0] if seq_title != '' else ''
+                if (seq_id_set is not None) and (current_seq_id not in seq_id_set):
+                    current_seq_id = None
+                current_seq_offset = current_offset + len(each_line)
+            current_offset += len(each_line)
+    if current_seq_id is not None:
+        fasta_offset_index_dict[current_seq_id] = (current_seq_offset, current_offset - current_seq_offset)
+
+    return fasta_offset_index_dict
+
+
+def get_fasta_seq_by_offset(pwd_fasta_file, fasta_offset_index_dict, seq_id_list):
+
+    # return [[seq_id, seq], ...] in the same order as in fasta file, sequences not in the index are ignored
+    seq_id_list_indexed = sorted([i for i in set(seq_id_list) if i in fasta_offset_index_dict], key=lambda x: fasta_offset_index_dict[x][0])
+    if len(seq_id_list_indexed) == 0:
+        return []
+
+    seq_list = []
+    with open(pwd_fasta_file, 'rb') as fasta_handle:
+        fasta_mmap = mmap.mmap(fasta_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        for seq_id in seq_id_list_indexed:
+            seq_offset, seq_length = fasta_offset_index_dict[seq_id]
+            seq = fasta_mmap[seq_offset:(seq_offset + seq_length)].decode()
+            seq_list.append([seq_id, ''.join(seq.split())])
+        fasta_mmap.close()
+
+    return seq_list
+
+
 def extract_gene_tree_seq_worker(argument_list):
 
-    each_to_process =               argument_list[0]
-    pwd_tree_folder =               argument_list[1]
-    pwd_combined_faa_file_subset =  argument_list[2]
-    pwd_blastp_exe =                argument_list[3]
-    pwd_mafft_exe =                 argument_list[4]
-    pwd_fasttree_exe =              argument_list[5]
-    genome_to_group_dict =          argument_list[6]
-    genome_name_list =              argument_list[7]
-    HGT_query_to_subjects_dict =    argument_list[8]
-    pwd_SCG_tree_all =              argument_list[9]
+    each_to_process =                argument_list[0]
+    pwd_tree_folder =                argument_list[1]
+    pwd_combined_faa_file =          argument_list[2]
+    pwd_blastp_exe =                 argument_list[3]
+    genome_to_group_dict =           worker_context_dict['name_to_group_dict']
+    genome_name_set =                worker_context_dict['genome_name_set']
+    HGT_query_to_subjects_dict =     worker_context_dict['HGT_query_to_subjects_dict']
+    combined_faa_offset_index_dict = worker_context_dict['combined_faa_offset_index_dict']
+
+    # return [each_to_process, gene members, sequence file of gene members] of the gene tree,
+    # gene trees will be built once for each unique gene family with gene_tree_worker
 
     gene_1 = each_to_process[0]
     gene_2 = each_to_process[1]
@@ -1621,17 +1743,12 @@ def extract_gene_tree_seq_worker(argument_list):
     paired_groups = [genome_to_group_dict[HGT_genome_1], genome_to_group_dict[HGT_genome_2]]
 
 
-    each_to_process_concate = '___'.join(each_to_process)
     blast_output =            '%s/%s___%s_gene_tree_blast.tab'        % (pwd_tree_folder, gene_1, gene_2)
     blast_output_sorted =     '%s/%s___%s_gene_tree_blast_sorted.tab' % (pwd_tree_folder, gene_1, gene_2)
     gene_tree_seq =           '%s/%s___%s_gene_tree.seq'              % (pwd_tree_folder, gene_1, gene_2)
     gene_tree_seq_uniq =      '%s/%s___%s_gene_tree_uniq.seq'         % (pwd_tree_folder, gene_1, gene_2)
     self_seq =                '%s/%s___%s_gene_tree_selfseq.seq'      % (pwd_tree_folder, gene_1, gene_2)
     non_self_seq =            '%s/%s___%s_gene_tree_nonselfseq.seq'   % (pwd_tree_folder, gene_1, gene_2)
-    pwd_seq_file_1st_aln =    '%s/%s___%s_gene_tree.1.aln'            % (pwd_tree_folder, gene_1, gene_2)
-    pwd_seq_file_2nd_aln =    '%s/%s___%s_gene_tree.2.aln'            % (pwd_tree_folder, gene_1, gene_2)
-    pwd_gene_tree_newick =    '%s/%s___%s_gene_tree.newick'           % (pwd_tree_folder, gene_1, gene_2)
-    pwd_species_tree_newick = '%s/%s_species_tree.newick'             % (pwd_tree_folder, each_to_process_concate)
 
     ################################################## Get gene tree ###################################################
 
@@ -1649,7 +1766,7 @@ def extract_gene_tree_seq_worker(argument_list):
     current_gene_member_grouped = []
     for gene_member in current_gene_member_BM:
         gene_member_genome = '_'.join(gene_member.split('_')[:-1])
-        if gene_member_genome in genome_name_list:
+        if gene_member_genome in genome_name_set:
             current_gene_member_grouped.append(gene_member)
 
     current_gene_member_grouped_from_paired_group = []
@@ -1666,35 +1783,33 @@ def extract_gene_tree_seq_worker(argument_list):
         genes_to_extract_list = current_gene_member_grouped_from_paired_group
 
     # get sequences of othorlog group to build gene tree
+    gene_tree_seq_list = get_fasta_seq_by_offset(pwd_combined_faa_file, combined_faa_offset_index_dict, genes_to_extract_list)
     output_handle = open(gene_tree_seq, "w")
     extracted_gene_set = set()
-    for seq_record in SeqIO.parse(pwd_combined_faa_file_subset, 'fasta'):
-        # if seq_record.id in current_gene_member:
-        if seq_record.id in genes_to_extract_list:
-            output_handle.write('>%s\n' % seq_record.id)
-            output_handle.write('%s\n' % str(seq_record.seq))
-            extracted_gene_set.add(seq_record.id)
+    for seq_id, seq in gene_tree_seq_list:
+        output_handle.write('>%s\n' % seq_id)
+        output_handle.write('%s\n' % seq)
+        extracted_gene_set.add(seq_id)
     output_handle.close()
 
     if (gene_1 in extracted_gene_set) and (gene_2 in extracted_gene_set):
         self_seq_handle = open(self_seq, 'w')
         non_self_seq_handle = open(non_self_seq, 'w')
         non_self_seq_num = 0
-        for each_seq in SeqIO.parse(gene_tree_seq, 'fasta'):
-            each_seq_genome_id = '_'.join(each_seq.id.split('_')[:-1])
-            if each_seq.id in each_to_process:
-                SeqIO.write(each_seq, self_seq_handle, 'fasta')
+        for seq_id, seq in gene_tree_seq_list:
+            each_seq_genome_id = '_'.join(seq_id.split('_')[:-1])
+            if seq_id in each_to_process:
+                self_seq_handle.write('>%s\n%s\n' % (seq_id, seq))
             elif each_seq_genome_id not in [HGT_genome_1, HGT_genome_2]:
-                SeqIO.write(each_seq, non_self_seq_handle, 'fasta')
+                non_self_seq_handle.write('>%s\n%s\n' % (seq_id, seq))
                 non_self_seq_num += 1
         self_seq_handle.close()
         non_self_seq_handle.close()
 
 
         # run blast
-        genome_subset = set()
         if non_self_seq_num > 0:
-            os.system('%s -query %s -subject %s -outfmt 6 -out %s' % (pwd_blastp_exe, self_seq, non_self_seq, blast_output))
+            profiled_system('%s -query %s -subject %s -outfmt 6 -out %s' % (pwd_blastp_exe, self_seq, non_self_seq, blast_output), 'blastp')
             os.system('cat %s | sort > %s' % (blast_output, blast_output_sorted))
 
             # get best match from each genome
@@ -1726,46 +1841,161 @@ def extract_gene_tree_seq_worker(argument_list):
 
             # export sequences
             gene_tree_seq_all = best_match_list + each_to_process
+            gene_tree_member_list = []
             gene_tree_seq_uniq_handle = open(gene_tree_seq_uniq, 'w')
-            for each_seq2 in SeqIO.parse(gene_tree_seq, 'fasta'):
-                if each_seq2.id in gene_tree_seq_all:
-                    gene_tree_seq_uniq_handle.write('>%s\n' % each_seq2.id)
-                    gene_tree_seq_uniq_handle.write('%s\n' % str(each_seq2.seq))
+            for seq_id, seq in gene_tree_seq_list:
+                if seq_id in gene_tree_seq_all:
+                    gene_tree_seq_uniq_handle.write('>%s\n' % seq_id)
+                    gene_tree_seq_uniq_handle.write('%s\n' % seq)
+                    gene_tree_member_list.append(seq_id)
             gene_tree_seq_uniq_handle.close()
 
-            cmd_mafft = '%s --quiet %s > %s' % (pwd_mafft_exe, gene_tree_seq_uniq, pwd_seq_file_1st_aln)
-            for each_gene in SeqIO.parse(gene_tree_seq_uniq, 'fasta'):
-                each_gene_genome = '_'.join(str(each_gene.id).split('_')[:-1])
-                genome_subset.add(each_gene_genome)
+            # remove temp files
+            os.remove(self_seq)
+            os.remove(non_self_seq)
+            os.remove(blast_output)
+            os.remove(blast_output_sorted)
+            os.remove(gene_tree_seq)
+
+            return [each_to_process, gene_tree_member_list, gene_tree_seq_uniq]
+
         else:
-            cmd_mafft = '%s --quiet %s > %s' % (pwd_mafft_exe, gene_tree_seq, pwd_seq_file_1st_aln)
-            for each_gene in SeqIO.parse(gene_tree_seq, 'fasta'):
-                each_gene_genome = '_'.join(str(each_gene.id).split('_')[:-1])
-                genome_subset.add(each_gene_genome)
+            os.remove(self_seq)
+            os.remove(non_self_seq)
+
+            return [each_to_process, [seq_id for seq_id, seq in gene_tree_seq_list], gene_tree_seq]
+
+    os.remove(gene_tree_seq)
 
+    return None
+
+
+def plan_PG_candidates(pwd_candidates_file, reportable_only):
+
+    # BM candidates with end match or full length contig match are not reported in the combined output of multiple
+    # level detection, so gene trees and reconciliations for them can not affect it. If reportable_only is True, they
+    # are left out of PG (their direction will be NA). Return [gene_1, gene_2] of candidates to run PG for and
+    # [gene_1, gene_2, contig match category] of skipped candidates
+    candidates_list = []
+    skipped_candidates_list = []
+    for match_group in open(pwd_candidates_file):
+        if not match_group.startswith('Gene_1'):
+            match_group_split = match_group.strip().split('\t')
+            end_match = match_group_split[5]
+            full_length_match = match_group_split[6]
+            if (reportable_only is True) and (end_match == 'yes'):
+                skipped_candidates_list.append(match_group_split[:2] + ['end_match'])
+            elif (reportable_only is True) and (full_length_match == 'yes'):
+                skipped_candidates_list.append(match_group_split[:2] + ['full_length_match'])
+            else:
+                candidates_list.append(match_group_split[:2])
+
+    return candidates_list, skipped_candidates_list
+
+
+def get_gene_family_key(gene_member_list, gene_tree_parameters):
+
+    # gene families with the same members and tree building parameters share the same key
+    gene_family_string = '%s\n%s' % (gene_tree_parameters, '\n'.join(sorted(gene_member_list)))
+
+    return hashlib.sha1(gene_family_string.encode()).hexdigest()
+
+
+def get_gene_tree_cache_key(pwd_gene_tree_seq, gene_family_key):
+
+    # gene trees can be reused as long as gene family members and their sequences are the same
+    gene_tree_seq_list = sorted(['%s\t%s' % (each_seq.id, str(each_seq.seq)) for each_seq in SeqIO.parse(pwd_gene_tree_seq, 'fasta')])
+    gene_tree_cache_string = '%s\n%s' % (gene_family_key, '\n'.join(gene_tree_seq_list))
+
+    return hashlib.sha1(gene_tree_cache_string.encode()).hexdigest()
+
+
+def gene_tree_worker(argument_list):
+
+    from MetaCHIP.species_tree_index import subset_tree_by_index
+
+    pwd_gene_tree_seq =          argument_list[0]
+    pwd_gene_family_folder =     argument_list[1]
+    gene_family_key =            argument_list[2]
+    genome_subset =              argument_list[3]
+    pwd_mafft_exe =              argument_list[4]
+    pwd_fasttree_exe =           argument_list[5]
+    pwd_SCG_tree_all =           argument_list[6]
+    pwd_gene_tree_cache_folder = argument_list[7]
+    incremental =                argument_list[8]
+
+    gene_tree_cache_key = get_gene_tree_cache_key(pwd_gene_tree_seq, gene_family_key)
+
+    pwd_seq_file_1st_aln =       '%s/%s_gene_tree.1.aln'         % (pwd_gene_family_folder, gene_family_key)
+    pwd_seq_file_2nd_aln =       '%s/%s_gene_tree.2.aln'         % (pwd_gene_family_folder, gene_family_key)
+    pwd_gene_tree_newick =       '%s/%s_gene_tree.newick'        % (pwd_gene_family_folder, gene_family_key)
+    pwd_species_tree_newick =    '%s/%s_species_tree.newick'     % (pwd_gene_family_folder, gene_family_key)
+    pwd_gene_tree_cache_newick = '%s/%s_gene_tree.newick'        % (pwd_gene_tree_cache_folder, gene_tree_cache_key)
+
+    # in incremental mode, use gene tree built in previous run
+    gene_tree_reused = False
+    if (incremental is True) and os.path.isfile(pwd_gene_tree_cache_newick):
+        shutil.copyfile(pwd_gene_tree_cache_newick, pwd_gene_tree_newick)
+        gene_tree_reused = True
+
+    else:
         # run mafft
-        os.system(cmd_mafft)
+        profiled_system('%s --quiet %s > %s' % (pwd_mafft_exe, pwd_gene_tree_seq, pwd_seq_file_1st_aln), 'mafft')
 
         # remove columns in alignment
         remove_low_cov_and_consensus_columns(pwd_seq_file_1st_aln, 50, 50, pwd_seq_file_2nd_aln)
 
         # run fasttree
-        cmd_fasttree = '%s -quiet -wag %s > %s' % (pwd_fasttree_exe, pwd_seq_file_2nd_aln, pwd_gene_tree_newick)
-        os.system(cmd_fasttree)
+        profiled_system('%s -quiet -wag %s > %s' % (pwd_fasttree_exe, pwd_seq_file_2nd_aln, pwd_gene_tree_newick), 'FastTree')
 
-        # Get species tree
-        subset_tree(pwd_SCG_tree_all, genome_subset, pwd_species_tree_newick)
+        # keep a copy for incremental runs
+        if os.path.isfile(pwd_gene_tree_newick) and (os.path.getsize(pwd_gene_tree_newick) > 0):
+            shutil.copyfile(pwd_gene_tree_newick, pwd_gene_tree_cache_newick)
 
         # remove temp files
-        os.remove(self_seq)
-        os.remove(gene_tree_seq)
         os.remove(pwd_seq_file_1st_aln)
         os.remove(pwd_seq_file_2nd_aln)
-        if non_self_seq_num > 0:
-            os.remove(non_self_seq)
-            os.remove(blast_output)
-            os.remove(blast_output_sorted)
-            os.remove(gene_tree_seq_uniq)
+
+    # Get species tree, the SCG tree changes with input genomes, so it is not cached
+    subset_tree_by_index(pwd_SCG_tree_all, genome_subset, pwd_species_tree_newick)
+
+    return gene_tree_cache_key, gene_tree_reused
+
+
+def get_ranger_trees(pwd_gene_tree_newick, pwd_SCG_tree_all):
+
+    from ete3 import Tree
+    from MetaCHIP.species_tree_index import get_ranger_species_tree
+
+    # read in gene tree
+    gene_tree = Tree(pwd_gene_tree_newick, format=0)
+    gene_tree.resolve_polytomy(recursive=True)  # solving multifurcations
+
+    # get species tree (resolved, ultrametric and with leaves renamed for Ranger-DTL2) of genomes in gene tree,
+    # it is the same for candidates with the same genome subset and only prepared once per process
+    genome_subset = {'_'.join(each_gt_leaf.name.split('_')[:-1]) for each_gt_leaf in gene_tree}
+    species_tree_ranger = get_ranger_species_tree(pwd_SCG_tree_all, genome_subset)
+
+    # change gene tree leaf name for Ranger-DTL2, replace "_" with "XXXXX", then, replace "." with "SSSSS"
+    for each_gt_leaf in gene_tree:
+        each_gt_leaf_name = each_gt_leaf.name
+
+        # replace '-' with 'XXXXX'
+        if '_' in each_gt_leaf_name:
+            each_gt_leaf_name_no_Underline = 'XXXXX'.join(each_gt_leaf_name.split('_')[:-1])
+        else:
+            each_gt_leaf_name_no_Underline = each_gt_leaf_name
+
+        # replace '.' with 'SSSSS'
+        if '.' in each_gt_leaf_name_no_Underline:
+            each_gt_leaf_name_no_Underline_no_dot = 'SSSSS'.join(each_gt_leaf_name_no_Underline.split('.'))
+        else:
+            each_gt_leaf_name_no_Underline_no_dot = each_gt_leaf_name_no_Underline
+
+        # rename gene tree leaf name
+        each_gt_leaf.name = each_gt_leaf_name_no_Underline_no_dot
+
+    return species_tree_ranger, gene_tree
 
 
 def Ranger_worker(argument_list):
@@ -1774,6 +2004,7 @@ def Ranger_worker(argument_list):
     pwd_tree_folder = argument_list[2]
     pwd_ranger_exe = argument_list[3]
     pwd_ranger_outputs_folder = argument_list[4]
+    pwd_SCG_tree_all = argument_list[5]
 
     # define Ranger-DTL input file name
     each_paired_tree_concate = '___'.join(each_paired_tree)
@@ -1793,62 +2024,14 @@ def Ranger_worker(argument_list):
 
         # pwd_current_ranger_outputs_folder = '%s/%s' % (pwd_ranger_outputs_folder, each_paired_tree_concate_short)
 
-        # read in species tree
-        species_tree = Tree(pwd_species_tree_newick, format=0)
-        species_tree.resolve_polytomy(recursive=True)  # solving multifurcations
-        species_tree.convert_to_ultrametric()  # for dated mode
-
-        # read in gene tree
-        gene_tree = Tree(pwd_gene_tree_newick, format=0)
-        gene_tree.resolve_polytomy(recursive=True)  # solving multifurcations
-
-        ################################################################################################################
-
-        # change species tree leaf name for Ranger-DTL2, replace "_" with "XXXXX", then, replace "." with "SSSSS"
-        for each_st_leaf in species_tree:
-            each_st_leaf_name = each_st_leaf.name
-
-            # replace '-' with 'XXXXX'
-            if '_' in each_st_leaf_name:
-                each_st_leaf_name_no_Underline = 'XXXXX'.join(each_st_leaf_name.split('_'))
-            else:
-                each_st_leaf_name_no_Underline = each_st_leaf_name
-
-            # replace '.' with 'SSSSS'
-            if '.' in each_st_leaf_name_no_Underline:
-                each_st_leaf_name_no_Underline_no_dot = 'SSSSS'.join(each_st_leaf_name_no_Underline.split('.'))
-            else:
-                each_st_leaf_name_no_Underline_no_dot = each_st_leaf_name_no_Underline
-
-            # rename species tree leaf name
-            each_st_leaf.name = each_st_leaf_name_no_Underline_no_dot
-
-        # change gene tree leaf name for Ranger-DTL2, replace "_" with "XXXXX", then, replace "." with "SSSSS"
-        for each_gt_leaf in gene_tree:
-            each_gt_leaf_name = each_gt_leaf.name
-
-            # replace '-' with 'XXXXX'
-            if '_' in each_gt_leaf_name:
-                each_gt_leaf_name_no_Underline = 'XXXXX'.join(each_gt_leaf_name.split('_')[:-1])
-            else:
-                each_gt_leaf_name_no_Underline = each_gt_leaf_name
-
-            # replace '.' with 'SSSSS'
-            if '.' in each_gt_leaf_name_no_Underline:
-                each_gt_leaf_name_no_Underline_no_dot = 'SSSSS'.join(each_gt_leaf_name_no_Underline.split('.'))
-            else:
-                each_gt_leaf_name_no_Underline_no_dot = each_gt_leaf_name_no_Underline
-
-            # rename gene tree leaf name
-            each_gt_leaf.name = each_gt_leaf_name_no_Underline_no_dot
-
-        ################################################################################################################
+        # get species tree and gene tree for Ranger-DTL2
+        species_tree_ranger, gene_tree = get_ranger_trees(pwd_gene_tree_newick, pwd_SCG_tree_all)
 
         # write species tree and gene tree to Ranger-DTL input file
         ranger_inputs_file = open(pwd_ranger_inputs, 'w')
 
         # dated mode
-        ranger_inputs_file.write('%s\n%s\n' % (species_tree.write(format=5), gene_tree.write(format=5)))
+        ranger_inputs_file.write('%s\n%s\n' % (species_tree_ranger, gene_tree.write(format=5)))
         ranger_inputs_file.close()
 
         # create ranger_outputs_folder
@@ -1857,7 +2040,7 @@ def Ranger_worker(argument_list):
         # run Ranger-DTL
         ranger_parameters = '-q -D 2 -T 3 -L 1'
         ranger_cmd = '%s %s -i %s -o %s' % (pwd_ranger_exe, ranger_parameters, pwd_ranger_inputs, pwd_ranger_outputs)
-        os.system(ranger_cmd)
+        profiled_system(ranger_cmd, 'Ranger-DTL')
 
     # # run ranger with 100 bootstrap
     # ranger_bootstrap = 1
@@ -1877,11 +2060,153 @@ def Ranger_worker(argument_list):
     # os.chdir(current_wd)
 
 
-def BM(args, config_dict):
+dated_species_tree_dict = {}
+
+
+def dated_dtl_worker(argument_list):
+
+    from ete3 import Tree
+
+    each_paired_tree = argument_list[0]
+    pwd_tree_folder = argument_list[1]
+    pwd_SCG_tree_all = argument_list[2]
+
+    each_paired_tree_concate = '___'.join(each_paired_tree)
+    pwd_species_tree_newick = '%s/%s_species_tree.newick' % (pwd_tree_folder, each_paired_tree_concate)
+    pwd_gene_tree_newick = '%s/%s_gene_tree.newick' % (pwd_tree_folder, each_paired_tree_concate)
+
+    if (os.path.isfile(pwd_species_tree_newick) is False) or (os.path.isfile(pwd_gene_tree_newick) is False):
+        return None
+
+    # same trees as provided to Ranger-DTL2, dated species trees are memoised by their newick string
+    species_tree_ranger, gene_tree = get_ranger_trees(pwd_gene_tree_newick, pwd_SCG_tree_all)
+    if species_tree_ranger not in dated_species_tree_dict:
+        dated_species_tree_dict[species_tree_ranger] = get_dated_species_tree(Tree(species_tree_ranger, format=5))
+
+    # reconcile with Ranger-DTL2 costs (-D 2 -T 3 -L 1)
+    reconciliation = dated_dtl_reconciliation(dated_species_tree_dict[species_tree_ranger], gene_tree, duplication_cost=2, transfer_cost=3, loss_cost=1)
+
+    predicted_transfers = []
+    for gene_node, event, mapping, recipient in reconciliation['events']:
+        if event == 'Transfer':
+            donor_p = '.'.join('_'.join(mapping.split('XXXXX')).split('SSSSS'))
+            recipient_p = '.'.join('_'.join(recipient.split('XXXXX')).split('SSSSS'))
+            predicted_transfers.append(donor_p + '-->' + recipient_p)
+
+    return predicted_transfers
+
+
+def get_name_to_group_number_dict(pwd_grouping_file):
+
+    # the same group numbers (e.g. A_1) as index_grouping_file
+    name_to_group_number_dict = {}
+    current_group = ''
+    current_index = 1
+    for each_genome in open(pwd_grouping_file):
+        each_genome_split = each_genome.strip().split(',')
+        group_id = each_genome_split[0]
+        if group_id == current_group:
+            current_index += 1
+        else:
+            current_group = group_id
+            current_index = 1
+        name_to_group_number_dict[each_genome_split[1]] = '%s_%s' % (group_id, current_index)
+
+    return name_to_group_number_dict
+
+
+def BM_multi_rank_stream(args, config_dict):
+
+    # filter blastn results and get group-to-group identities and best-match donors of all ranks in args['r'] in a
+    # single pass, return {rank: BM_stream_results}, which will be provided to BM of each rank. BM_stream_results of a
+    # rank are merged sparse histograms of each group pair, best-match lists and status of each blast result file.
+    # Ranks without a unique grouping file are not included, BM of these ranks will report the problem.
+    output_prefix =             args['p']
+    detection_ranks =           args['r']
+    grouping_file =             args['g']
+    cover_cutoff =              args['cov']
+    align_len_cutoff =          args['al']
+    num_threads =               args['t']
+    keep_quiet =                args['quiet']
+    incremental =               args['incremental']
+
+    MetaCHIP_wd =                '%s_MetaCHIP_wd'                  % output_prefix
+    pwd_log_folder =             '%s/%s_log_files'                 % (MetaCHIP_wd, output_prefix)
+    pwd_log_file =               '%s/%s_%s_BM_stream_%s.log'       % (pwd_log_folder, output_prefix, detection_ranks, datetime.now().strftime('%Y-%m-%d_%Hh-%Mm-%Ss_%f'))
+    pwd_blast_result_folder =    '%s/%s_all_blastn_results'        % (MetaCHIP_wd, output_prefix)
+    pwd_blast_hit_store_folder = '%s/%s_all_blastn_results_store'  % (MetaCHIP_wd, output_prefix)
+
+    # grouping of each rank
+    rank_to_grouping_dict = {}
+    for grouping_level in detection_ranks:
+        if grouping_file is None:
+            grouping_file_list = glob.glob('%s/%s_%s*_grouping.txt' % (MetaCHIP_wd, output_prefix, grouping_level))
+            if len(grouping_file_list) != 1:
+                continue
+            rank_to_grouping_dict[grouping_level] = get_name_to_group_number_dict(grouping_file_list[0])
+        else:
+            rank_to_grouping_dict[grouping_level] = get_name_to_group_number_dict(grouping_file)
+
+    if len(glob.glob('%s/*_blastn.tab' % pwd_blast_result_folder)) == 0:
+        return {}
+
+    start_profiling('BM_stream', pwd_log_file)
+    report_and_log(('Analyzing Blast hits to get group-to-group identities and HGT candidates at %s levels in a single pass with %s cores' % (len(rank_to_grouping_dict), num_threads)), pwd_log_file, keep_quiet)
+
+    # index blast results if it was not done in PI (e.g. blastn run with -noblast or -qsub) or blast results changed
+    if blast_hit_store_is_current(pwd_blast_result_folder, pwd_blast_hit_store_folder) is False:
+        report_and_log(('Indexing blast results into %s_all_blastn_results_store' % output_prefix), pwd_log_file, keep_quiet)
+        build_blast_hit_store(pwd_blast_result_folder, pwd_blast_hit_store_folder)
+    blast_hit_store = load_blast_hit_store(pwd_blast_hit_store_folder)
+
+    # group code and BM stream cache folder of each rank
+    rank_group_code_dict = {}
+    rank_to_BM_stream_cache_folder_dict = {}
+    for grouping_level in rank_to_grouping_dict:
+        pwd_BM_stream_cache_folder = '%s/%s_%s_BM_stream_cache' % (MetaCHIP_wd, output_prefix, grouping_level)
+        if (incremental is False) or (os.path.isdir(pwd_BM_stream_cache_folder) is False):
+            force_create_folder(pwd_BM_stream_cache_folder)
+        rank_group_code_dict[grouping_level] = list(get_genome_group_code(blast_hit_store, rank_to_grouping_dict[grouping_level]))
+        rank_to_BM_stream_cache_folder_dict[grouping_level] = pwd_BM_stream_cache_folder
+
+    list_for_multiple_arguments_BM_stream = []
+    blast_file_offsets = blast_hit_store['blast_file_offsets']
+    for blast_file_index, blast_file_genome in enumerate(blast_hit_store['blast_file_genomes']):
+        rank_grouping_list = []
+        for grouping_level in rank_group_code_dict:
+            if blast_file_genome.decode() in rank_to_grouping_dict[grouping_level]:
+                pwd_BM_stream_cache_file = '%s/%s.json' % (rank_to_BM_stream_cache_folder_dict[grouping_level], blast_file_genome.decode())
+                rank_grouping_list.append([grouping_level, pwd_BM_stream_cache_file])
+        if len(rank_grouping_list) > 0:
+            list_for_multiple_arguments_BM_stream.append([pwd_blast_hit_store_folder, int(blast_file_offsets[blast_file_index]), int(blast_file_offsets[blast_file_index + 1]),
+                                                          align_len_cutoff, cover_cutoff, rank_grouping_list, incremental])
+
+    # group code of all ranks are installed once per worker
+    pool = get_worker_context_pool(num_threads, {'rank_group_code_dict': rank_group_code_dict})
+    BM_multi_rank_stream_results = profiled_pool_map(pool, BM_multi_rank_stream_worker, list_for_multiple_arguments_BM_stream)
+    pool.close()
+    pool.join()
+
+    # results of each rank are reduced to one sparse histogram per group pair and the best-match lists (in the same
+    # order as in BM) before the next rank, results of the reduced rank are removed from the results of each task
+    rank_to_BM_stream_results_dict = {}
+    for grouping_level in rank_to_grouping_dict:
+        current_rank_BM_stream_results = [rank_to_BM_stream_result_dict.pop(grouping_level) for rank_to_BM_stream_result_dict in BM_multi_rank_stream_results if grouping_level in rank_to_BM_stream_result_dict]
+        rank_to_BM_stream_results_dict[grouping_level] = reduce_BM_stream_results(current_rank_BM_stream_results)
+        del current_rank_BM_stream_results
+    del BM_multi_rank_stream_results
+
+    report_and_log(('Blast hits analyzed at levels: %s' % ','.join(rank_to_BM_stream_results_dict)), pwd_log_file, keep_quiet)
+    end_profiling()
+
+    return rank_to_BM_stream_results_dict
+
+
+def BM(args, config_dict, BM_stream_results=None):
 
     def do(plot_identity):
-        current_group_pair_identities_array = np.array(current_group_pair_identities)
-        current_group_pair_identity_cut_off = np.percentile(current_group_pair_identities_array, identity_percentile)
+        current_group_pair_identity_number = int(np.sum(current_group_pair_identity_histogram))
+        current_group_pair_identity_cut_off = get_percentile_from_histogram(current_group_pair_identity_histogram, identity_percentile)
         current_group_pair_identity_cut_off = float("{0:.2f}".format(current_group_pair_identity_cut_off))
         current_group_pair_name_split = current_group_pair_name.split('_')
         current_group_pair_name_swapped = '%s_%s' % (current_group_pair_name_split[1], current_group_pair_name_split[0])
@@ -1893,19 +2218,19 @@ def BM(args, config_dict):
                 '%s\t%s\n' % (current_group_pair_name, current_group_pair_identity_cut_off))
 
         # check length
-        if len(current_group_pair_identities) >= minimum_plot_number:
+        if current_group_pair_identity_number >= minimum_plot_number:
             if current_group_pair_name == current_group_pair_name_swapped:
                 if plot_identity is True:
-                    plot_identity_list(current_group_pair_identities, 'None', current_group_pair_name, pwd_iden_distrib_plot_folder)
+                    plot_identity_list(get_identity_list_from_histogram(current_group_pair_identity_histogram), 'None', current_group_pair_name, pwd_iden_distrib_plot_folder)
             else:
                 if plot_identity is True:
-                    plot_identity_list(current_group_pair_identities, current_group_pair_identity_cut_off, current_group_pair_name, pwd_iden_distrib_plot_folder)
+                    plot_identity_list(get_identity_list_from_histogram(current_group_pair_identity_histogram), current_group_pair_identity_cut_off, current_group_pair_name, pwd_iden_distrib_plot_folder)
 
             #report_and_log(("Plotting identity distribution (%dth): %s" % (ploted_group, current_group_pair_name)), pwd_log_file, keep_quiet)
 
         else:
             with open(pwd_unploted_groups_file, 'a') as unploted_groups_handle:
-                unploted_groups_handle.write('%s\t%s\n' % (current_group_pair_name, len(current_group_pair_identities)))
+                unploted_groups_handle.write('%s\t%s\n' % (current_group_pair_name, current_group_pair_identity_number))
             #report_and_log(("Plotting identity distribution (%dth): %s, blast hits < %d, skipped" % (ploted_group, current_group_pair_name, minimum_plot_number)), pwd_log_file, keep_quiet)
 
     output_prefix =             args['p']
@@ -1921,6 +2246,8 @@ def BM(args, config_dict):
     plot_identity =             args['plot_iden']
     keep_quiet =                args['quiet']
     keep_temp =                 args['tmp']
+    incremental =               args['incremental']
+    flanking_plot =             args['flk_plot']
 
 
     # get path to current script
@@ -1966,27 +2293,22 @@ def BM(args, config_dict):
         group_num = get_group_num_from_grouping_file(pwd_grouping_file)
 
 
+    start_profiling('BM', pwd_log_file)
+
+
     ############################################# define file/folder names #############################################
 
     MetaCHIP_op_folder = '%s_%s%s_HGTs_ip%s_al%sbp_c%s_ei%sbp_f%skbp' % (output_prefix, grouping_level, group_num, str(identity_percentile), str(align_len_cutoff), str(cover_cutoff), str(end_match_identity_cutoff), flanking_length_kbp)
 
 
     blast_result_folder =                               '%s_all_blastn_results'                           % (output_prefix)
+    blast_hit_store_folder =                            '%s_all_blastn_results_store'                     % (output_prefix)
+    BM_stream_cache_folder =                            '%s_%s_BM_stream_cache'                           % (output_prefix, grouping_level)
     combined_ffn_file =                                 '%s_all_combined_ffn.fasta'                       % (output_prefix)
     prodigal_output_folder =                            '%s_all_prodigal_output'                          % (output_prefix)
 
-    blast_result_filtered_folder =                      '%s_%s%s_blastn_results_filtered'                 % (output_prefix, grouping_level, group_num)
-    blast_result_filtered_folder_g2g =                  '%s_%s%s_1_blastn_results_filtered_g2g'           % (output_prefix, grouping_level, group_num)
-    blast_result_filtered_folder_with_group =           '%s_%s%s_2_blastn_results_filtered_with_group'    % (output_prefix, grouping_level, group_num)
-    blast_result_filtered_folder_in_one_line =          '%s_%s%s_3_blastn_results_filtered_in_one_line'   % (output_prefix, grouping_level, group_num)
-    op_candidates_only_gene_folder_name =               '%s_%s%s_4_HGTs_only_id'                          % (output_prefix, grouping_level, group_num)
-    op_candidates_with_group_folder_name =              '%s_%s%s_5_HGTs_with_group'                       % (output_prefix, grouping_level, group_num)
     gbk_folder =                                        '%s_%s%s_gbk_files'                               % (output_prefix, grouping_level, group_num)
     iden_distrib_plot_folder =                          '%s_%s%s_identity_distribution'                   % (output_prefix, grouping_level, group_num)
-    qual_idens_file =                                   '%s_%s%s_blastn_results_filtered.tab'             % (output_prefix, grouping_level, group_num)
-    qual_idens_file_gg =                                '%s_%s%s_qualified_iden_gg.txt'                   % (output_prefix, grouping_level, group_num)
-    qual_idens_file_gg_sorted =                         '%s_%s%s_qualified_iden_gg_sorted.txt'            % (output_prefix, grouping_level, group_num)
-    subjects_in_one_line_filename =                     '%s_%s%s_subjects_in_one_line.txt'                % (output_prefix, grouping_level, group_num)
     HGT_query_to_subjects_filename =                    '%s_%s%s_HGT_query_to_subjects.txt'               % (output_prefix, grouping_level, group_num)
     group_pair_iden_cutoff_file_name =                  '%s_%s%s_identity_cutoff.txt'                     % (output_prefix, grouping_level, group_num)
     op_candidates_with_group_file_name =                '%s_%s%s_HGTs_with_group.txt'                     % (output_prefix, grouping_level, group_num)
@@ -2006,22 +2328,14 @@ def BM(args, config_dict):
     pwd_prodigal_output_folder =                   '%s/%s'       % (MetaCHIP_wd, prodigal_output_folder)
     pwd_combined_ffn_file =                        '%s/%s'       % (MetaCHIP_wd, combined_ffn_file)
     pwd_blast_result_folder =                      '%s/%s'       % (MetaCHIP_wd, blast_result_folder)
-    pwd_blast_result_filtered_folder =             '%s/%s'       % (MetaCHIP_wd, blast_result_filtered_folder)
-    pwd_qualified_iden_file =                      '%s/%s'       % (MetaCHIP_wd, qual_idens_file)
-    pwd_blast_result_filtered_folder_g2g =         '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, blast_result_filtered_folder_g2g)
-    pwd_blast_result_filtered_folder_with_group =  '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, blast_result_filtered_folder_with_group)
-    pwd_blast_result_filtered_folder_in_one_line = '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, blast_result_filtered_folder_in_one_line)
+    pwd_blast_hit_store_folder =                   '%s/%s'       % (MetaCHIP_wd, blast_hit_store_folder)
+    pwd_BM_stream_cache_folder =                   '%s/%s'       % (MetaCHIP_wd, BM_stream_cache_folder)
     pwd_iden_distrib_plot_folder =                 '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, iden_distrib_plot_folder)
-    pwd_qual_iden_file_gg =                        '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, qual_idens_file_gg)
-    pwd_qual_iden_file_gg_sorted =                 '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, qual_idens_file_gg_sorted)
     pwd_unploted_groups_file =                     '%s/%s/%s/%s' % (MetaCHIP_wd, MetaCHIP_op_folder, iden_distrib_plot_folder, unploted_groups_file)
-    pwd_subjects_in_one_line =                     '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, subjects_in_one_line_filename)
     pwd_HGT_query_to_subjects_file =               '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, HGT_query_to_subjects_filename)
     pwd_group_pair_iden_cutoff_file =              '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, group_pair_iden_cutoff_file_name)
     pwd_op_candidates_with_group_file =            '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, op_candidates_with_group_file_name)
     pwd_op_candidates_only_gene_file =             '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, op_candidates_only_gene_file_name)
-    pwd_op_candidates_with_group_folder =          '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, op_candidates_with_group_folder_name)
-    pwd_op_candidates_only_gene_folder =           '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, op_candidates_only_gene_folder_name)
     pwd_op_candidates_only_gene_file_uniq =        '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, op_candidates_only_gene_file_name_uniq)
     pwd_op_candidates_BM =                         '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, op_candidates_BM)
     pwd_op_candidates_seq_nc =                     '%s/%s/%s'    % (MetaCHIP_wd, MetaCHIP_op_folder, op_candidates_seq_nc)
@@ -2054,83 +2368,59 @@ def BM(args, config_dict):
         name_to_group_dict[bin_name] = bin_group
 
 
-    ############################################### filter blastn results ##############################################
-
-    # check whether previous filter results exist
-    filter_blastn_results = 0
-    if os.path.isdir(pwd_blast_result_filtered_folder) is True:
-        blast_result_filtered_file_re = '%s/*_filtered.tab' % pwd_blast_result_filtered_folder
-        blast_result_filtered_file_list = [os.path.basename(file_name) for file_name in glob.glob(blast_result_filtered_file_re)]
-        if len(blast_result_filtered_file_list) != len(genome_name_list):
-            report_and_log(('A difference in numbers between the filtered blast results and qualified genomes were found, will re-run the blast results filter step for all qualified genomes'), pwd_log_file, keep_quiet)
-            filter_blastn_results = 1
-    else:
-        filter_blastn_results = 1
-
-    # filter blast results if filtered blast results not exist
-    if filter_blastn_results == 0:
-        report_and_log(('Filtered blastn results at specified taxonomic rank detected from folder %s. HGT analysis will be performed based on these files.' % blast_result_filtered_folder), pwd_log_file, keep_quiet)
-
-    else:
-        report_and_log(('Filtering blast matches with the following criteria: Query genome != Subject genome, Alignment length >= %sbp and coverage >= %s%s' % (align_len_cutoff, cover_cutoff, '%')), pwd_log_file, keep_quiet)
+    ############################## filter blastn results and get best-match in a single pass ##############################
 
-        # create folder
-        force_create_folder(pwd_blast_result_filtered_folder)
+    report_and_log(('Filtering blast matches with the following criteria: Query genome != Subject genome, Alignment length >= %sbp and coverage >= %s%s' % (align_len_cutoff, cover_cutoff, '%')), pwd_log_file, keep_quiet)
+    report_and_log(('Analyzing Blast hits to get group-to-group identities and HGT candidates with %s cores' % num_threads), pwd_log_file, keep_quiet)
 
-        # filter blastn results with multiprocessing
-        blast_result_file_re = '%s/*_blastn.tab' % pwd_blast_result_folder
-        blast_result_file_list = [os.path.basename(file_name) for file_name in glob.glob(blast_result_file_re)]
-        if len(blast_result_file_list) == 0:
-            report_and_log(('No blast results detected, program exited!'), pwd_log_file, keep_quiet)
-            exit()
-
-        list_for_multiple_arguments_filter_blast_results = []
-        for blast_result_file in blast_result_file_list:
-            genome_name = blast_result_file.split('_blastn')[0]
-            if genome_name in genome_name_list:
-                pwd_blast_result_file = '%s/%s' % (pwd_blast_result_folder, blast_result_file)
-                blast_result_filtered_file = '%s_filtered.tab' % ('.'.join(blast_result_file.split('.')[:-1]))
-                pwd_blast_result_filtered_file = '%s/%s' % (pwd_blast_result_filtered_folder, blast_result_filtered_file)
-                list_for_multiple_arguments_filter_blast_results.append([pwd_blast_result_file, align_len_cutoff, cover_cutoff, genome_name_list, pwd_blast_result_filtered_file])
+    # get blast result file list
+    blast_result_file_re = '%s/*_blastn.tab' % pwd_blast_result_folder
+    blast_result_file_list = sorted([os.path.basename(file_name) for file_name in glob.glob(blast_result_file_re)])
+    if len(blast_result_file_list) == 0:
+        report_and_log(('No blast results detected, program exited!'), pwd_log_file, keep_quiet)
+        end_profiling()
+        exit()
 
-        # filter_blast_results with multiprocessing
-        pool = mp.Pool(processes=num_threads)
-        pool.map(filter_blast_results_worker, list_for_multiple_arguments_filter_blast_results)
+    # index blast results if it was not done in PI (e.g. blastn run with -noblast or -qsub) or blast results changed
+    if blast_hit_store_is_current(pwd_blast_result_folder, pwd_blast_hit_store_folder) is False:
+        report_and_log(('Indexing blast results into %s' % blast_hit_store_folder), pwd_log_file, keep_quiet)
+        build_blast_hit_store(pwd_blast_result_folder, pwd_blast_hit_store_folder)
+
+    blast_hit_store = load_blast_hit_store(pwd_blast_hit_store_folder)
+    group_list, genome_group_number_list, genome_group_code = get_genome_group_code(blast_hit_store, name_to_group_number_dict)
+
+    # group-to-group identities and best-match donors are provided if all ranks were analysed in a single pass
+    if BM_stream_results is None:
+
+        # results of each blast result file are cached, in incremental mode, they will be reused for hits and genomes
+        # analysed in previous run
+        if (incremental is False) or (os.path.isdir(pwd_BM_stream_cache_folder) is False):
+            force_create_folder(pwd_BM_stream_cache_folder)
+
+        list_for_multiple_arguments_BM_stream = []
+        blast_file_offsets = blast_hit_store['blast_file_offsets']
+        for blast_file_index, blast_file_genome in enumerate(blast_hit_store['blast_file_genomes']):
+            if blast_file_genome.decode() in name_to_group_number_dict:
+                pwd_BM_stream_cache_file = '%s/%s.json' % (pwd_BM_stream_cache_folder, blast_file_genome.decode())
+                list_for_multiple_arguments_BM_stream.append([pwd_blast_hit_store_folder, int(blast_file_offsets[blast_file_index]), int(blast_file_offsets[blast_file_index + 1]),
+                                                              align_len_cutoff, cover_cutoff, pwd_BM_stream_cache_file, incremental])
+
+        # filter blast hits, get group-to-group identities and best-match donors with multiprocessing, group code
+        # are installed once per worker
+        BM_stream_context_dict = {'group_list':               group_list,
+                                  'genome_group_number_list': genome_group_number_list,
+                                  'genome_group_code':        genome_group_code}
+        pool = get_worker_context_pool(num_threads, BM_stream_context_dict)
+        BM_stream_results = reduce_BM_stream_results(profiled_pool_map(pool, BM_stream_worker, list_for_multiple_arguments_BM_stream))
         pool.close()
         pool.join()
 
+    group_pair_sparse_histogram_dict, best_match_list_list, BM_stream_status_list = BM_stream_results
+    if incremental is True:
+        report_and_log(('Blast hits of %s genomes were analysed in previous run, %s of them were updated with new hits, %s genomes analysed from scratch' % (BM_stream_status_list.count('reused') + BM_stream_status_list.count('updated'), BM_stream_status_list.count('updated'), BM_stream_status_list.count('computed'))), pwd_log_file, keep_quiet)
 
-    # combine qualified blast hits
-    report_and_log(('Combining filtered blastn results'), pwd_log_file, keep_quiet)
-    os.system('cat %s/*_blastn_filtered.tab > %s' % (pwd_blast_result_filtered_folder, pwd_qualified_iden_file))
-
-
-    ########################################### get group-to-group identities ##########################################
-
-    report_and_log(('Get group-to-group identities with %s cores' % num_threads), pwd_log_file, keep_quiet)
-
-    # create folder
-    force_create_folder(pwd_blast_result_filtered_folder_g2g)
-
-    # get file list
-    blast_result_filtered_file_re = '%s/*_filtered.tab' % pwd_blast_result_filtered_folder
-    blast_result_filtered_file_list = [os.path.basename(file_name) for file_name in glob.glob(blast_result_filtered_file_re)]
-
-    list_for_multiple_arguments_get_g2g_identities = []
-    for filtered_blast_result in blast_result_filtered_file_list:
-        pwd_filtered_blast_result = '%s/%s' % (pwd_blast_result_filtered_folder, filtered_blast_result)
-        pwd_filtered_blast_result_g2g = '%s/%s_g2g.tab' % (pwd_blast_result_filtered_folder_g2g, filtered_blast_result.split('.tab')[0])
-        list_for_multiple_arguments_get_g2g_identities.append([pwd_filtered_blast_result, name_to_group_number_dict, pwd_filtered_blast_result_g2g])
-
-    # get group-to-group identities with multiprocessing
-    pool = mp.Pool(processes=num_threads)
-    pool.map(get_g2g_identities_worker, list_for_multiple_arguments_get_g2g_identities)
-    pool.close()
-    pool.join()
-
-    # combine g2g_files and sort it
-    os.system('cat %s/*_g2g.tab > %s' % (pwd_blast_result_filtered_folder_g2g, pwd_qual_iden_file_gg))
-    os.system('cat %s | sort > %s' % (pwd_qual_iden_file_gg, pwd_qual_iden_file_gg_sorted))
+    # group-to-group identity histograms of all genomes
+    group_pair_identity_histogram_dict = merge_identity_histograms([group_pair_sparse_histogram_dict])
 
 
     ############ plot identity distribution between groups and get cutoff according to specified percentile ############
@@ -2142,95 +2432,41 @@ def BM(args, config_dict):
     # get identities for each group pair, plot identity distribution and generate group_pair to identity dict
     with open(pwd_unploted_groups_file, 'a') as unploted_groups_handle:
         unploted_groups_handle.write('Group\tHits_number\n')
-    current_group_pair_name = ''
-    current_group_pair_identities = []
     group_pair_iden_cutoff_dict = {}
-    ploted_group = 1
     minimum_plot_number = 10
     group_pair_iden_cutoff_file = open(pwd_group_pair_iden_cutoff_file, 'w')
-    for each_identity_g in open(pwd_qual_iden_file_gg_sorted):
-        each_identity_g_split = each_identity_g.strip().split('\t')
-        group_pair = each_identity_g_split[0]
-        identity = float(each_identity_g_split[1])
-        group_pair_split = group_pair.split('_')
-        group_pair_swapped = '%s_%s' % (group_pair_split[1], group_pair_split[0])
-        if current_group_pair_name == '':
-            current_group_pair_name = group_pair
-            current_group_pair_identities.append(identity)
-        else:
-            if (group_pair == current_group_pair_name) or (group_pair_swapped == current_group_pair_name):
-                current_group_pair_identities.append(identity)
-            else:
-                # get group_pair to identity dict and identity cut off for defined percentile
-                do(plot_identity)
-                ploted_group += 1
-                # restore current_group_pair_name and current_group_pair_identities for next group pair
-                current_group_pair_name = group_pair
-                current_group_pair_identities = []
-                current_group_pair_identities.append(identity)
-
-    # for the last group
-    do(plot_identity)
+    for current_group_pair_name in sorted(group_pair_identity_histogram_dict):
+        current_group_pair_identity_histogram = group_pair_identity_histogram_dict[current_group_pair_name]
+        do(plot_identity)
     group_pair_iden_cutoff_file.close()
 
 
-    ############################### add group to blast hits and put subjects in one line ###############################
-
-    report_and_log(('Analyzing Blast hits to get HGT candidates with %s cores' % num_threads), pwd_log_file, keep_quiet)
+    ################################ filter best-match donors with group pair identity cutoff ################################
 
-    # create folder
-    force_create_folder(pwd_blast_result_filtered_folder_with_group)
-    force_create_folder(pwd_blast_result_filtered_folder_in_one_line)
-    force_create_folder(pwd_op_candidates_with_group_folder)
-    force_create_folder(pwd_op_candidates_only_gene_folder)
-
-    list_for_multiple_arguments_get_HGT = []
-    for filtered_blast_result in blast_result_filtered_file_list:
-        genome_id = filtered_blast_result.split('_blastn_filtered.tab')[0]
-        pwd_filtered_blast_result = '%s/%s' % (pwd_blast_result_filtered_folder, filtered_blast_result)
-        pwd_filtered_blast_result_with_group =  '%s/%s_with_group_sorted.tab'    % (pwd_blast_result_filtered_folder_with_group, filtered_blast_result.split('.tab')[0])
-        pwd_filtered_blast_result_in_one_line = '%s/%s_subjects_in_one_line.tab' % (pwd_blast_result_filtered_folder_in_one_line, filtered_blast_result.split('.tab')[0])
-        pwd_hgt_candidates_with_group =         '%s/%s_HGTs_with_group.txt'      % (pwd_op_candidates_with_group_folder, genome_id)
-        pwd_hgt_candidates_only_gene =          '%s/%s_HGTs_only_gene.txt'       % (pwd_op_candidates_only_gene_folder, genome_id)
-
-        list_for_multiple_arguments_get_HGT.append([pwd_filtered_blast_result,
-                                                    name_to_group_number_dict,
-                                                    pwd_filtered_blast_result_with_group,
-                                                    pwd_filtered_blast_result_in_one_line,
-                                                    pwd_hgt_candidates_with_group,
-                                                    pwd_hgt_candidates_only_gene,
-                                                    group_pair_iden_cutoff_dict])
-
-    # add group to blast hits with multiprocessing
-    pool = mp.Pool(processes=num_threads)
-    pool.map(get_HGT_worker, list_for_multiple_arguments_get_HGT)
-    pool.close()
-    pool.join()
+    candidate2identity_dict = {}
+    op_candidates_with_group_handle = open(pwd_op_candidates_with_group_file, 'w')
+    op_candidates_only_gene_handle = open(pwd_op_candidates_only_gene_file, 'w')
+    for each_best_match_list in best_match_list_list:
+        for query, donor in each_best_match_list:
+            query_g = query.split('|')[0].split('_')[0]
+            candidate_g = donor.split('|')[0].split('_')[0]
+            candidate_iden = float(donor.split('|')[2])
+            if candidate_iden >= group_pair_iden_cutoff_dict['%s_%s' % (query_g, candidate_g)]:
+                recipient_gene = query.split('|')[1]
+                donor_gene = donor.split('|')[1]
+                op_candidates_with_group_handle.write('%s\t%s\n' % (query, donor))
+                op_candidates_only_gene_handle.write('%s\t%s\n' % (recipient_gene, donor_gene))
+                candidate2identity_dict['%s___%s' % (recipient_gene, donor_gene)] = candidate_iden
+    op_candidates_with_group_handle.close()
+    op_candidates_only_gene_handle.close()
 
 
     ################################ remove bidirection and add identity to output file ################################
 
-    # combine pwd_op_candidates_with_group_file and pwd_op_candidates_only_gene_file
-    os.system('cat %s/*_HGTs_with_group.txt > %s' % (pwd_op_candidates_with_group_folder, pwd_op_candidates_with_group_file))
-    os.system('cat %s/*_HGTs_only_gene.txt > %s'  % (pwd_op_candidates_only_gene_folder, pwd_op_candidates_only_gene_file))
-
-
-    # remove bidirection and add identity to output file
-    candidate2identity_dict = {}
-    for each_candidate_pair in open(pwd_op_candidates_with_group_file):
-        each_candidate_pair_split = each_candidate_pair.strip().split('\t')
-        recipient_gene = each_candidate_pair_split[0].split('|')[1]
-        donor_gene = each_candidate_pair_split[1].split('|')[1]
-        identity = float(each_candidate_pair_split[1].split('|')[2])
-        candidate2identity_key = '%s___%s' % (recipient_gene, donor_gene)
-        candidate2identity_dict[candidate2identity_key] = identity
-
     remove_bidirection(pwd_op_candidates_only_gene_file, candidate2identity_dict, pwd_op_candidates_only_gene_file_uniq)
 
 
-    ############################################### plot flanking region ###############################################
-
-    report_and_log(('Plotting flanking regions with %s cores' % num_threads), pwd_log_file, keep_quiet)
+    ################################### check end match and full length contig match ##################################
 
     # create folder to hold ACT output
     os.makedirs(pwd_op_act_folder)
@@ -2238,23 +2474,33 @@ def BM(args, config_dict):
     os.makedirs(pwd_end_match_folder)
     os.makedirs(pwd_full_length_match_folder)
 
-    # initialize manager.dict
-    manager = mp.Manager()
-    candidates_2_contig_match_category_dict_mp = manager.dict()
+    # contigs of candidates are compared in batches of candidates between the same pair of genomes, categories are
+    # returned by workers
+    candidate_match_list = [match for match in open(pwd_op_candidates_only_gene_file_uniq)]
+    candidates_2_contig_match_category_dict = {'___'.join(match.strip().split('\t')[:2]): 'normal' for match in candidate_match_list}
+    if (No_Eb_Check is False) and (len(candidate_match_list) > 0):
+        report_and_log(('Checking end match and full length contig match of %s candidates with %s cores' % (len(candidate_match_list), num_threads)), pwd_log_file, keep_quiet)
+        list_for_multiple_arguments_contig_match = []
+        for match_batch in get_genome_pair_match_batches(candidate_match_list, num_threads):
+            list_for_multiple_arguments_contig_match.append([match_batch, pwd_prodigal_output_folder, pwd_op_act_folder, pwd_blastn_exe, keep_temp, end_match_identity_cutoff])
 
-    list_for_multiple_arguments_flanking_regions = []
-    for match in open(pwd_op_candidates_only_gene_file_uniq):
-        list_for_multiple_arguments_flanking_regions.append([match, pwd_prodigal_output_folder, flanking_length, align_len_cutoff, name_to_group_number_dict, pwd_op_act_folder,
-                                                             pwd_normal_folder, pwd_end_match_folder, pwd_full_length_match_folder, pwd_blastn_exe, keep_temp,
-                                                             candidates_2_contig_match_category_dict_mp, end_match_identity_cutoff, No_Eb_Check])
+        pool = mp.Pool(processes=num_threads)
+        match_category_list = profiled_pool_map(pool, contig_match_worker, list_for_multiple_arguments_contig_match)
+        pool.close()
+        pool.join()
 
-    pool_flanking_regions = mp.Pool(processes=num_threads)
-    pool_flanking_regions.map(get_gbk_blast_act2, list_for_multiple_arguments_flanking_regions)
-    pool_flanking_regions.close()
-    pool_flanking_regions.join()
+        for match_batch_category_list in match_category_list:
+            for folder_name, match_category in match_batch_category_list:
+                candidates_2_contig_match_category_dict[folder_name] = match_category
+
+
+    ############################################### plot flanking region ###############################################
 
-    # convert mp.dict to normal dict
-    candidates_2_contig_match_category_dict = {each_key: each_value for each_key, each_value in candidates_2_contig_match_category_dict_mp.items()}
+    # plots of all candidates are rendered here, plots of PG validated HGTs only are rendered by PG
+    if (flanking_plot == 'all') and (len(candidate_match_list) > 0):
+        report_and_log(('Plotting flanking regions of %s candidates with %s cores' % (len(candidate_match_list), num_threads)), pwd_log_file, keep_quiet)
+        plot_flanking_regions(candidate_match_list, candidates_2_contig_match_category_dict, name_to_group_number_dict, pwd_prodigal_output_folder, flanking_length,
+                              pwd_op_act_folder, pwd_normal_folder, pwd_end_match_folder, pwd_full_length_match_folder, pwd_blastn_exe, keep_temp, num_threads)
 
 
     ################################################ get BM output file ################################################
@@ -2290,9 +2536,7 @@ def BM(args, config_dict):
 
     ####################################### export gene clusters for PG approach #######################################
 
-    os.system('cat %s/*_in_one_line.tab > %s' % (pwd_blast_result_filtered_folder_in_one_line, pwd_subjects_in_one_line))
-
-    export_HGT_query_to_subjects(pwd_op_candidates_BM, pwd_subjects_in_one_line, pwd_HGT_query_to_subjects_file)
+    export_HGT_query_to_subjects(pwd_op_candidates_BM, blast_hit_store, align_len_cutoff, cover_cutoff, genome_group_number_list, genome_group_code, pwd_HGT_query_to_subjects_file)
 
 
     ################################### export nc and aa sequence of predicted HGTs ####################################
@@ -2321,10 +2565,6 @@ def BM(args, config_dict):
 
     if keep_temp == 0:
         report_and_log(('Deleting temporary files'), pwd_log_file, keep_quiet)
-        os.remove(pwd_qualified_iden_file)
-        os.remove(pwd_qual_iden_file_gg)
-        os.remove(pwd_qual_iden_file_gg_sorted)
-        os.remove(pwd_subjects_in_one_line)
         os.remove(pwd_op_candidates_only_gene_file_uniq)
         os.remove(pwd_op_candidates_with_group_file)
         os.remove(pwd_op_candidates_only_gene_file)
@@ -2332,16 +2572,11 @@ def BM(args, config_dict):
         os.remove(pwd_group_pair_iden_cutoff_file)
 
         # os.remove(pwd_HGT_query_to_subjects_file) need this file in the PG approach
-        os.system('rm -r %s' % pwd_blast_result_filtered_folder_g2g)
-        os.system('rm -r %s' % pwd_blast_result_filtered_folder_with_group)
-        os.system('rm -r %s' % pwd_blast_result_filtered_folder_in_one_line)
-        os.system('rm -r %s' % pwd_op_candidates_only_gene_folder)
-        os.system('rm -r %s' % pwd_op_candidates_with_group_folder)
         os.system('rm -r %s' % pwd_iden_distrib_plot_folder)
-        os.system('rm -r %s' % pwd_blast_result_filtered_folder)
 
     # report
     report_and_log(('Done for Best-match approach!'), pwd_log_file, keep_quiet)
+    end_profiling()
 
 
 def PG(args, config_dict):
@@ -2356,6 +2591,13 @@ def PG(args, config_dict):
     end_match_identity_cutoff = args['ei']
     num_threads =               args['t']
     keep_quiet =                args['quiet']
+    keep_temp =                 args['tmp']
+    builtin_dtl =               args['builtin_dtl']
+    incremental =               args['incremental']
+    flanking_plot =             args['flk_plot']
+    reportable_only =           args['reportable_only']
+
+    flanking_length = flanking_length_kbp * 1000
 
     # read in config file
     pwd_ranger_exe = config_dict['ranger_linux']
@@ -2365,6 +2607,7 @@ def PG(args, config_dict):
     pwd_mafft_exe =     config_dict['mafft']
     pwd_fasttree_exe =  config_dict['fasttree']
     pwd_blastp_exe =    config_dict['blastp']
+    pwd_blastn_exe =    config_dict['blastn']
     circos_HGT_R =      config_dict['circos_HGT_R']
 
     warnings.filterwarnings("ignore")
@@ -2406,6 +2649,9 @@ def PG(args, config_dict):
         group_num = get_group_num_from_grouping_file(pwd_grouping_file)
 
 
+    start_profiling('PG', pwd_log_file)
+
+
     ############################################### Define folder/file name ################################################
 
     MetaCHIP_op_folder = '%s_%s%s_HGTs_ip%s_al%sbp_c%s_ei%sbp_f%skbp' % (output_prefix, grouping_level, group_num, str(identity_percentile), str(align_len_cutoff), str(cover_cutoff), str(end_match_identity_cutoff), flanking_length_kbp)
@@ -2414,6 +2660,8 @@ def PG(args, config_dict):
     genome_size_file_name =                             '%s_all_genome_size.txt'                      % (output_prefix)
     combined_faa_file =                                 '%s_all_combined_faa.fasta'                   % (output_prefix)
     tree_folder =                                       '%s_%s%s_PG_tree_folder'                      % (output_prefix, grouping_level, group_num)
+    gene_family_folder =                                '%s_%s%s_PG_gene_family_folder'               % (output_prefix, grouping_level, group_num)
+    gene_tree_cache_folder =                            '%s_%s_PG_gene_tree_cache'                    % (output_prefix, grouping_level)
     ranger_inputs_folder_name =                         '%s_%s%s_PG_Ranger_input'                     % (output_prefix, grouping_level, group_num)
     ranger_outputs_folder_name =                        '%s_%s%s_PG_Ranger_output'                    % (output_prefix, grouping_level, group_num)
     candidates_file_name =                              '%s_%s%s_HGTs_BM.txt'                         % (output_prefix, grouping_level, group_num)
@@ -2429,7 +2677,6 @@ def PG(args, config_dict):
     newick_tree_file =                                  '%s_%s%s_species_tree.newick'                 % (output_prefix, grouping_level, group_num)
     grouping_id_to_taxon_file_name =                    '%s_%s%s_group_to_taxon.txt'                  % (output_prefix, grouping_level, group_num)
     grouping_file_with_id_filename =                    '%s_%s%s_grouping_with_id.txt'                % (output_prefix, grouping_level, group_num)
-    combined_faa_file_subset =                          '%s_%s%s_combined_subset.faa'                 % (output_prefix, grouping_level, group_num)
     plot_identity_distribution_BM =                     '%s_%s%s_plot_HGT_identity_BM.png'            % (output_prefix, grouping_level, group_num)
     plot_identity_distribution_PG =                     '%s_%s%s_plot_HGT_identity_PG.png'            % (output_prefix, grouping_level, group_num)
     plot_at_ends_number =                               '%s_%s%s_plot_ctg_match_category.png'         % (output_prefix, grouping_level, group_num)
@@ -2470,7 +2717,8 @@ def PG(args, config_dict):
     pwd_ranger_inputs_folder =                          '%s/%s'                                       % (pwd_MetaCHIP_op_folder, ranger_inputs_folder_name)
     pwd_ranger_outputs_folder =                         '%s/%s'                                       % (pwd_MetaCHIP_op_folder, ranger_outputs_folder_name)
     pwd_tree_folder =                                   '%s/%s'                                       % (pwd_MetaCHIP_op_folder, tree_folder)
-    pwd_combined_faa_file_subset =                      '%s/%s'                                       % (pwd_MetaCHIP_op_folder, combined_faa_file_subset)
+    pwd_gene_family_folder =                            '%s/%s'                                       % (pwd_MetaCHIP_op_folder, gene_family_folder)
+    pwd_gene_tree_cache_folder =                        '%s/%s'                                       % (MetaCHIP_wd, gene_tree_cache_folder)
     pwd_genome_size_file =                              '%s/%s'                                       % (MetaCHIP_wd, genome_size_file_name)
     pwd_newick_tree_file =                              '%s/%s'                                       % (MetaCHIP_wd, newick_tree_file)
     pwd_grouping_id_to_taxon_file =                     '%s/%s'                                       % (MetaCHIP_wd, grouping_id_to_taxon_file_name)
@@ -2483,20 +2731,23 @@ def PG(args, config_dict):
     # create folders
     force_create_folder(pwd_tree_folder)
 
-    # get list of match pair list
-    candidates_list = []
+    # get list of match pair list, only candidates which can be reported get gene trees and reconciliations
+    candidates_list, skipped_candidates_list = plan_PG_candidates(pwd_candidates_file, reportable_only)
     candidates_list_genes = set()
-    for match_group in open(pwd_candidates_file):
-        if not match_group.startswith('Gene_1'):
-            match_group_split = match_group.strip().split('\t')[:2]
-            candidates_list.append(match_group_split)
-            candidates_list_genes.add(match_group_split[0])
-            candidates_list_genes.add(match_group_split[1])
+    for match_group_split in candidates_list:
+        candidates_list_genes.add(match_group_split[0])
+        candidates_list_genes.add(match_group_split[1])
 
-    if candidates_list == []:
+    if (candidates_list == []) and (skipped_candidates_list == []):
         report_and_log(('No HGT detected by BM approach, program exited!'), pwd_log_file, keep_quiet)
+        end_profiling()
         exit()
 
+    if len(skipped_candidates_list) > 0:
+        report_and_log(('Skipped gene trees and reconciliations of %s BM candidates not to be reported (end match: %s, full length match: %s), %s candidates left' % (len(skipped_candidates_list), len([i for i in skipped_candidates_list if i[2] == 'end_match']), len([i for i in skipped_candidates_list if i[2] == 'full_length_match']), len(candidates_list))), pwd_log_file, keep_quiet)
+        with open(pwd_log_file, 'a') as log_handle:
+            log_handle.write(''.join(['PG skipped for %s___%s (%s)\n' % (gene_1, gene_2, match_category) for gene_1, gene_2, match_category in skipped_candidates_list]))
+
     # for report and log
     report_and_log(('Get gene/genome member in gene/species tree for each BM predicted HGT'), pwd_log_file, keep_quiet)
 
@@ -2539,10 +2790,10 @@ def PG(args, config_dict):
                 gene_id_overall.add(each_subject)
 
 
-    ################################# Prepare subset of faa_file for building gene tree ####################################
+    ################################### Index sequences in faa_file for building gene tree ##################################
 
     # for report and log
-    report_and_log(('Prepare subset of %s for building gene tree' % combined_faa_file), pwd_log_file, keep_quiet)
+    report_and_log(('Index sequences in %s for building gene tree' % combined_faa_file), pwd_log_file, keep_quiet)
 
     # uniq gene id list
     gene_id_uniq_set = set()
@@ -2552,13 +2803,8 @@ def PG(args, config_dict):
     # get combined_faa_file file
     os.system('cat %s/*.faa > %s' % (pwd_prodigal_output_folder, pwd_combined_faa_file))
 
-    # prepare combined_ffn file subset to speed up
-    pwd_combined_faa_file_subset_handle = open(pwd_combined_faa_file_subset, 'w')
-    for each_gene in SeqIO.parse(pwd_combined_faa_file, 'fasta'):
-        if each_gene.id in gene_id_uniq_set:
-            pwd_combined_faa_file_subset_handle.write('>%s\n' % each_gene.id)
-            pwd_combined_faa_file_subset_handle.write('%s\n' % str(each_gene.seq))
-    pwd_combined_faa_file_subset_handle.close()
+    # index sequences needed for building gene trees, workers will get sequences by their offsets in combined_faa_file
+    combined_faa_offset_index_dict = get_fasta_offset_index(pwd_combined_faa_file, gene_id_uniq_set)
 
 
     ################################## Extract gene sequences, run mafft and fasttree ##################################
@@ -2571,72 +2817,155 @@ def PG(args, config_dict):
     for each_to_extract in candidates_list:
         list_for_multiple_arguments_extract_gene_tree_seq.append([each_to_extract,
                                                                   pwd_tree_folder,
-                                                                  pwd_combined_faa_file_subset,
-                                                                  pwd_blastp_exe,
-                                                                  pwd_mafft_exe,
-                                                                  pwd_fasttree_exe,
-                                                                  name_to_group_dict,
-                                                                  genome_name_list,
-                                                                  HGT_query_to_subjects_dict,
-                                                                  pwd_newick_tree_file])
+                                                                  pwd_combined_faa_file,
+                                                                  pwd_blastp_exe])
+
+    # tables shared by all candidates are installed once per worker
+    extract_gene_tree_seq_context_dict = {'name_to_group_dict':             name_to_group_dict,
+                                          'genome_name_set':                set(genome_name_list),
+                                          'HGT_query_to_subjects_dict':     HGT_query_to_subjects_dict,
+                                          'combined_faa_offset_index_dict': combined_faa_offset_index_dict}
+    pool = get_worker_context_pool(num_threads, extract_gene_tree_seq_context_dict)
+    gene_tree_member_list = profiled_pool_map(pool, extract_gene_tree_seq_worker, list_for_multiple_arguments_extract_gene_tree_seq)
+    pool.close()
+    pool.join()
+
+    # group candidates with the same gene members (e.g. candidates share the same recipient gene), gene tree and
+    # species tree for each gene family will be built only once
+    gene_tree_parameters = 'mafft --quiet; min_cov_in_msa 50, min_consensus_in_msa 50; FastTree -quiet -wag'
+    gene_family_to_candidates_dict = {}
+    list_for_multiple_arguments_gene_tree = []
+    for each_gene_tree_member in gene_tree_member_list:
+        if each_gene_tree_member is not None:
+            each_to_process, gene_member_list, pwd_gene_tree_seq = each_gene_tree_member
+            gene_family_key = get_gene_family_key(gene_member_list, gene_tree_parameters)
+            if gene_family_key not in gene_family_to_candidates_dict:
+                gene_family_to_candidates_dict[gene_family_key] = []
+                genome_subset = {'_'.join(gene_member.split('_')[:-1]) for gene_member in gene_member_list}
+                list_for_multiple_arguments_gene_tree.append([pwd_gene_tree_seq, pwd_gene_family_folder, gene_family_key, genome_subset, pwd_mafft_exe, pwd_fasttree_exe, pwd_newick_tree_file, pwd_gene_tree_cache_folder, incremental])
+            gene_family_to_candidates_dict[gene_family_key].append(each_to_process)
+
+    report_and_log(('Building gene/species trees for %s unique gene families' % len(list_for_multiple_arguments_gene_tree)), pwd_log_file, keep_quiet)
+
+    # parse and index the species tree before forking, so workers do not need to read it again
+    from MetaCHIP.species_tree_index import get_species_tree_index
+    get_species_tree_index(pwd_newick_tree_file)
+
+    # gene trees are cached for incremental runs
+    if (incremental is False) or (os.path.isdir(pwd_gene_tree_cache_folder) is False):
+        force_create_folder(pwd_gene_tree_cache_folder)
+
+    force_create_folder(pwd_gene_family_folder)
     pool = mp.Pool(processes=num_threads)
-    pool.map(extract_gene_tree_seq_worker, list_for_multiple_arguments_extract_gene_tree_seq)
+    gene_tree_cache_list = profiled_pool_map(pool, gene_tree_worker, list_for_multiple_arguments_gene_tree)
     pool.close()
     pool.join()
 
+    # only keep cached gene trees of current gene families
+    if incremental is True:
+        report_and_log(('Gene trees of %s gene families were reused from previous run' % len([i for i in gene_tree_cache_list if i[1] is True])), pwd_log_file, keep_quiet)
+        current_gene_tree_cache_key_set = {i[0] for i in gene_tree_cache_list}
+        for gene_tree_cache_file in os.listdir(pwd_gene_tree_cache_folder):
+            if gene_tree_cache_file.split('_gene_tree')[0] not in current_gene_tree_cache_key_set:
+                os.remove('%s/%s' % (pwd_gene_tree_cache_folder, gene_tree_cache_file))
+
+    # copy gene/species trees of gene family to candidates
+    for gene_family_key in gene_family_to_candidates_dict:
+        pwd_family_gene_tree_newick = '%s/%s_gene_tree.newick' % (pwd_gene_family_folder, gene_family_key)
+        pwd_family_species_tree_newick = '%s/%s_species_tree.newick' % (pwd_gene_family_folder, gene_family_key)
+        for each_to_process in gene_family_to_candidates_dict[gene_family_key]:
+            if os.path.isfile(pwd_family_gene_tree_newick):
+                shutil.copyfile(pwd_family_gene_tree_newick, '%s/%s___%s_gene_tree.newick' % (pwd_tree_folder, each_to_process[0], each_to_process[1]))
+            if os.path.isfile(pwd_family_species_tree_newick):
+                shutil.copyfile(pwd_family_species_tree_newick, '%s/%s_species_tree.newick' % (pwd_tree_folder, '___'.join(each_to_process)))
+
+    # remove sequence files of gene families
+    for each_gene_tree_member in gene_tree_member_list:
+        if each_gene_tree_member is not None:
+            os.remove(each_gene_tree_member[2])
+    os.system('rm -r %s' % pwd_gene_family_folder)
+
 
     ##################################################### Run Ranger-DTL ###################################################
 
-    # prepare folders
-    force_create_folder(pwd_ranger_inputs_folder)
-    force_create_folder(pwd_ranger_outputs_folder)
+    candidate_to_predicted_transfers_dict = {}
+    if builtin_dtl is True:
 
-    # for report and log
-    report_and_log(('Running Ranger-DTL2 with dated mode'), pwd_log_file, keep_quiet)
+        # for report and log
+        report_and_log(('Running built-in dated DTL reconciliation'), pwd_log_file, keep_quiet)
 
-    # put multiple arguments in list
-    list_for_multiple_arguments_Ranger = []
-    for each_paired_tree in candidates_list:
-        list_for_multiple_arguments_Ranger.append([each_paired_tree, pwd_ranger_inputs_folder, pwd_tree_folder, pwd_ranger_exe, pwd_ranger_outputs_folder])
+        # put multiple arguments in list
+        list_for_multiple_arguments_dated_dtl = []
+        for each_paired_tree in candidates_list:
+            list_for_multiple_arguments_dated_dtl.append([each_paired_tree, pwd_tree_folder, pwd_newick_tree_file])
 
-    pool = mp.Pool(processes=num_threads)
-    pool.map(Ranger_worker, list_for_multiple_arguments_Ranger)
-    pool.close()
-    pool.join()
+        pool = mp.Pool(processes=num_threads)
+        predicted_transfers_list = profiled_pool_map(pool, dated_dtl_worker, list_for_multiple_arguments_dated_dtl)
+        pool.close()
+        pool.join()
+
+        for each_paired_tree, predicted_transfers in zip(candidates_list, predicted_transfers_list):
+            if predicted_transfers is not None:
+                candidate_to_predicted_transfers_dict['___'.join(each_paired_tree)] = predicted_transfers
 
+    else:
 
-    ########################################### parse Ranger-DTL prediction result #########################################
+        # prepare folders
+        force_create_folder(pwd_ranger_inputs_folder)
+        force_create_folder(pwd_ranger_outputs_folder)
 
-    # for report and log
-    report_and_log(('Parsing Ranger prediction results'), pwd_log_file, keep_quiet)
+        # for report and log
+        report_and_log(('Running Ranger-DTL2 with dated mode'), pwd_log_file, keep_quiet)
+
+        # put multiple arguments in list
+        list_for_multiple_arguments_Ranger = []
+        for each_paired_tree in candidates_list:
+            list_for_multiple_arguments_Ranger.append([each_paired_tree, pwd_ranger_inputs_folder, pwd_tree_folder, pwd_ranger_exe, pwd_ranger_outputs_folder, pwd_newick_tree_file])
+
+        pool = mp.Pool(processes=num_threads)
+        profiled_pool_map(pool, Ranger_worker, list_for_multiple_arguments_Ranger)
+        pool.close()
+        pool.join()
+
+        # for report and log
+        report_and_log(('Parsing Ranger prediction results'), pwd_log_file, keep_quiet)
+
+        for each_ranger_prediction in candidates_list:
+            each_ranger_prediction_concate = '___'.join(each_ranger_prediction)
+            ranger_out_file_name = each_ranger_prediction_concate + '_ranger_output.txt'
+            pwd_ranger_result = '%s/%s' % (pwd_ranger_outputs_folder, ranger_out_file_name)
+
+            if os.path.isfile(pwd_ranger_result) == True:
+
+                # parse prediction result
+                predicted_transfers = []
+                for each_line in open(pwd_ranger_result):
+                    if 'Transfer' in each_line:
+                        if not each_line.startswith('The minimum reconciliation cost'):
+                            mapping = each_line.strip().split(':')[1].split(',')[1]
+                            recipient = each_line.strip().split(':')[1].split(',')[2]
+                            donor_p = mapping.split('-->')[1][1:]
+                            donor_p = '_'.join(donor_p.split('XXXXX'))
+                            donor_p = '.'.join(donor_p.split('SSSSS'))
+                            recipient_p = recipient.split('-->')[1][1:]
+                            recipient_p = '_'.join(recipient_p.split('XXXXX'))
+                            recipient_p = '.'.join(recipient_p.split('SSSSS'))
+                            predicted_transfer = donor_p + '-->' + recipient_p
+                            predicted_transfers.append(predicted_transfer)
+
+                candidate_to_predicted_transfers_dict[each_ranger_prediction_concate] = predicted_transfers
+
+
+    ############################################# get predicted HGT directions #############################################
 
     candidate_2_predictions_dict = {}
     candidate_2_possible_direction_dict = {}
     for each_ranger_prediction in candidates_list:
         each_ranger_prediction_concate = '___'.join(each_ranger_prediction)
-        ranger_out_file_name = each_ranger_prediction_concate + '_ranger_output.txt'
-        pwd_ranger_result = '%s/%s' % (pwd_ranger_outputs_folder, ranger_out_file_name)
-
-        if os.path.isfile(pwd_ranger_result) == True:
-
-            # parse prediction result
-            predicted_transfers = []
-            for each_line in open(pwd_ranger_result):
-                if 'Transfer' in each_line:
-                    if not each_line.startswith('The minimum reconciliation cost'):
-                        mapping = each_line.strip().split(':')[1].split(',')[1]
-                        recipient = each_line.strip().split(':')[1].split(',')[2]
-                        donor_p = mapping.split('-->')[1][1:]
-                        donor_p = '_'.join(donor_p.split('XXXXX'))
-                        donor_p = '.'.join(donor_p.split('SSSSS'))
-                        recipient_p = recipient.split('-->')[1][1:]
-                        recipient_p = '_'.join(recipient_p.split('XXXXX'))
-                        recipient_p = '.'.join(recipient_p.split('SSSSS'))
-                        predicted_transfer = donor_p + '-->' + recipient_p
-                        predicted_transfers.append(predicted_transfer)
-
-
-            candidate_2_predictions_dict[each_ranger_prediction_concate] = predicted_transfers
+
+        if each_ranger_prediction_concate in candidate_to_predicted_transfers_dict:
+
+            candidate_2_predictions_dict[each_ranger_prediction_concate] = candidate_to_predicted_transfers_dict[each_ranger_prediction_concate]
 
             # get two possible transfer situation
             candidate_split_gene = each_ranger_prediction_concate.split('___')
@@ -2663,6 +2992,8 @@ def PG(args, config_dict):
     #combined_output_validated_handle.write(combined_output_validated_header)
     combined_output_handle.write(combined_output_validated_header)
     validated_candidate_list = []
+    PG_validated_match_list = []
+    candidates_2_contig_match_category_dict = {}
     for match_group in open(pwd_candidates_file):
         if not match_group.startswith('Gene_1'):
             match_group_split = match_group.strip().split('\t')
@@ -2690,6 +3021,11 @@ def PG(args, config_dict):
                 if donor_gene not in validated_candidate_list:
                     validated_candidate_list.append(donor_gene)
                 #combined_output_validated_handle.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (recipient_gene, donor_gene, recipient_genome_id, donor_genome_id, identity, end_break, Ctg_align, validated_prediction))
+            # only plots of normal HGTs are kept in the final output, plots in end match and full length match
+            # folders are removed when predictions are combined
+            if (Ctg_align == 'no') and (end_break == 'no') and (validated_prediction != 'NA'):
+                PG_validated_match_list.append('%s\t%s\t%s\n' % (recipient_gene, donor_gene, identity))
+                candidates_2_contig_match_category_dict[concatenated] = 'normal'
             combined_output_handle.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (recipient_gene, donor_gene, recipient_genome_id, donor_genome_id, identity, end_break, Ctg_align, validated_prediction))
     combined_output_handle.close()
     #combined_output_validated_handle.close()
@@ -2708,6 +3044,16 @@ def PG(args, config_dict):
     # combined_output_validated_fasta_nc_handle.close()
     # combined_output_validated_fasta_aa_handle.close()
 
+    ############################################ plot flanking region ##############################################
+
+    # plots of PG validated HGTs without end match or full length contig match are rendered into the normal folder,
+    # as they would be by BM
+    if (flanking_plot == 'final') and (len(PG_validated_match_list) > 0):
+        report_and_log(('Plotting flanking regions of %s PG validated HGTs with %s cores' % (len(PG_validated_match_list), num_threads)), pwd_log_file, keep_quiet)
+        plot_flanking_regions(PG_validated_match_list, candidates_2_contig_match_category_dict, name_to_group_number_dict, pwd_prodigal_output_folder, flanking_length,
+                              pwd_flanking_region_plot_folder, pwd_1_normal_folder, pwd_2_at_ends_folder, pwd_3_full_contig_match_folder, pwd_blastn_exe, keep_temp, num_threads)
+
+
     ###################################### separate PG validated flanking region plots #####################################
 
     # # create folders
@@ -2764,18 +3110,19 @@ def PG(args, config_dict):
 
     # remove tmp files
     os.remove(pwd_combined_faa_file)
-    os.remove(pwd_combined_faa_file_subset)
     os.remove(pwd_candidates_seq_file)
     os.remove(pwd_HGT_query_to_subjects_file)
     os.remove(pwd_grouping_file_with_id)
     os.remove(pwd_candidates_file)
 
-    os.system('rm -r %s' % pwd_ranger_inputs_folder)
-    os.system('rm -r %s' % pwd_ranger_outputs_folder)
+    if builtin_dtl is False:
+        os.system('rm -r %s' % pwd_ranger_inputs_folder)
+        os.system('rm -r %s' % pwd_ranger_outputs_folder)
     os.system('rm -r %s' % pwd_tree_folder)
 
     # for report and log
     report_and_log(('Done for Phylogenetic approach!'), pwd_log_file, keep_quiet)
+    end_profiling()
 
 
 def combine_PG_output(PG_output_file_list_with_path, output_prefix, detection_ranks, combined_PG_output_normal):
@@ -3024,7 +3371,7 @@ def Get_circlize_plot(multi_level_detection, output_prefix, pwd_candidates_file_
     matrix_file.close()
 
     # get plot with R
-    os.system('Rscript %s -m %s -p %s' % (circos_HGT_R, pwd_cir_plot_matrix_filename, pwd_plot_circos))
+    profiled_system('Rscript %s -m %s -p %s' % (circos_HGT_R, pwd_cir_plot_matrix_filename, pwd_plot_circos), 'Rscript')
 
     # rm tmp files
     os.system('rm %s' % pwd_cir_plot_t1)
@@ -3050,7 +3397,13 @@ def combine_multiple_level_predictions(args, config_dict):
 
     detection_rank_list = args['r']
 
+    MetaCHIP_wd =   '%s_MetaCHIP_wd'           % output_prefix
+    pwd_log_folder = '%s/%s_log_files'         % (MetaCHIP_wd, output_prefix)
+    pwd_log_file =  '%s/%s_%s_combine_%s.log'  % (pwd_log_folder, output_prefix, detection_rank_list, datetime.now().strftime('%Y-%m-%d_%Hh-%Mm-%Ss_%f'))
+    start_profiling('combine', pwd_log_file)
+
     # cat ffn and faa files from prodigal output folder
+    report_and_log(('Extracting sequences of detected HGTs'), pwd_log_file, True)
     pwd_combined_ffn = '%s_MetaCHIP_wd/combined.ffn' % output_prefix
     os.system('cat %s_MetaCHIP_wd/%s_all_prodigal_output/*.ffn > %s' % (output_prefix, output_prefix, pwd_combined_ffn))
 
@@ -3115,6 +3468,7 @@ def combine_multiple_level_predictions(args, config_dict):
 
         ###################################### Get_circlize_plot #######################################
 
+        report_and_log(('Plotting detected HGTs with circlize'), pwd_log_file, True)
         grouping_file_re = '%s_MetaCHIP_wd/%s_%s*_grouping.txt' % (output_prefix, output_prefix, detection_rank_list)
         grouping_file = [os.path.basename(file_name) for file_name in glob.glob(grouping_file_re)][0]
         taxon_rank_num = grouping_file[len(output_prefix) + 1:].split('_')[0]
@@ -3148,8 +3502,7 @@ def combine_multiple_level_predictions(args, config_dict):
     # for multiple level detection
     if len(detection_rank_list) > 1:
 
-        time_format = '[%Y-%m-%d %H:%M:%S]'
-        print('%s Combine multiple level predictions' % (datetime.now().strftime(time_format)))
+        report_and_log(('Combine multiple level predictions'), pwd_log_file, keep_quiet)
 
         multi_level_detection = True
 
@@ -3247,6 +3600,7 @@ def combine_multiple_level_predictions(args, config_dict):
 
         ###################################### Get_circlize_plot #######################################
 
+        report_and_log(('Plotting detected HGTs with circlize'), pwd_log_file, True)
         for detection_rank in detection_rank_list:
 
             grouping_file_re = '%s_MetaCHIP_wd/%s_%s*_grouping.txt' % (output_prefix, output_prefix, detection_rank)
@@ -3279,6 +3633,7 @@ def combine_multiple_level_predictions(args, config_dict):
 
 
     os.remove(pwd_combined_ffn)
+    end_profiling()
 
 
 if __name__ == '__main__':
@@ -3300,6 +3655,10 @@ if __name__ == '__main__':
     parser.add_argument('-force',         required=False, action="store_true", help='overwrite previous results')
     parser.add_argument('-quiet',         required=False, action="store_true", help='Do not report progress')
     parser.add_argument('-tmp',           required=False, action="store_true", help='keep temporary files')
+    parser.add_argument('-builtin_dtl',   required=False, action="store_true", help='reconcile gene and species trees with the built-in dated DTL engine instead of Ranger-DTL')
+    parser.add_argument('-incremental',   required=False, action="store_true", help='reuse results of previous run for unchanged genomes and blast hits')
+    parser.add_argument('-flk_plot',      required=False, default='final', choices=['none', 'final', 'all'], help='plot flanking regions of no HGT (none), only the HGTs in the final output (final) or all BM candidates (all, the behaviour of previous versions, needed if you use the per-rank Flanking_region_plots folders), default: final')
+    parser.add_argument('-reportable_only', required=False, action="store_true", help='skip PG for candidates with end match or full length contig match, always on for multiple ranks as they are not reported')
 
     args = vars(parser.parse_args())
 
@@ -3309,13 +3668,15 @@ if __name__ == '__main__':
         PG(args, config_dict)
 
     else:
+        rank_to_BM_stream_results_dict = BM_multi_rank_stream(args, config_dict)
         for detection_rank_BM_PG in detection_rank_list_BM_PG:
             current_rank_args_BM_PG = copy.deepcopy(args)
             current_rank_args_BM_PG['r'] = detection_rank_BM_PG
             current_rank_args_BM_PG['quiet'] = True
+            current_rank_args_BM_PG['reportable_only'] = True
 
             print('Detect HGT at level: %s' % detection_rank_BM_PG)
-            BM(current_rank_args_BM_PG, config_dict)
+            BM(current_rank_args_BM_PG, config_dict, rank_to_BM_stream_results_dict.get(detection_rank_BM_PG))
             PG(current_rank_args_BM_PG, config_dict)
 
     combine_multiple_level_predictions(args, config_dict)
@@ -20,26 +20,27 @@ from __future__ import division
 
 
 import os
-import re
+import hashlib
 import glob
 import shutil
 import argparse
 import warnings
 import itertools
+import numpy as np
 from time import sleep
 from datetime import datetime
 from string import ascii_uppercase
-from Bio import SeqIO, AlignIO, Align
+from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 from Bio.Seq import Seq
 from Bio.Alphabet import IUPAC, generic_dna
-from Bio import SeqFeature as SF
 from Bio.SeqRecord import SeqRecord
-from Bio.SeqFeature import SeqFeature, FeatureLocation
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
 import multiprocessing as mp
 from MetaCHIP.MetaCHIP_config import config_dict
+from MetaCHIP.blast_hit_store import get_blast_result_file_stat, build_blast_hit_store
+from MetaCHIP.msa_column_filter import get_supermatrix_array, filter_msa_array_columns, write_msa_array
+from MetaCHIP.annotation_store import get_prodigal_version, get_annotation_key, fetch_annotation, add_annotation, evict_annotation_store
+from MetaCHIP.run_profiler import start_profiling, record_profile_step, profiled_system, profiled_pool_map, end_profiling
 
 
 def report_and_log(message_for_report, log_file, keep_quiet):
@@ -51,6 +52,8 @@ def report_and_log(message_for_report, log_file, keep_quiet):
     if keep_quiet is False:
         print('%s %s' % ((datetime.now().strftime(time_format)), message_for_report))
 
+    record_profile_step(message_for_report)
+
 
 def force_create_folder(folder_to_create):
     if os.path.isdir(folder_to_create):
@@ -132,149 +135,144 @@ def export_aa_record(gene_seq, gene_id, gene_description, output_handle):
     SeqIO.write(seq_record, output_handle, 'fasta')
 
 
-def remove_low_cov_and_consensus_columns(alignment_file_in, minimal_cov, min_consensus, alignment_file_out):
-
-    def list_to_segments(list_in):
-
-        segments_out = []
-        current_element = None
-        current_segment = [None, None]
-        for each_element in list_in:
+# base code of A, C, G and T (either case) for codon lookup, other characters are 4
+base_code_lookup = np.full(256, 4, dtype=np.uint8)
+for base_code, base in enumerate(b'ACGT'):
+    base_code_lookup[base] = base_code
+    base_code_lookup[base + 32] = base_code
 
-            # for the first ellment
-            if current_element == None:
-                current_element = each_element
-                current_segment = [each_element, each_element]
 
-            elif each_element == current_element + 1:
-                current_segment[1] = each_element
-                current_element = each_element
+def get_codon_lookup_table(transl_table):
 
-            elif each_element != current_element + 1:
+    # amino acids of the 64 codons (index: first base * 16 + second base * 4 + third base), translated by Biopython,
+    # so that lookup results are the same as translating genes one by one
+    codon_list = [(a + b + c) for a in 'ACGT' for b in 'ACGT' for c in 'ACGT']
 
-                # add segment to list
-                segments_out.append(current_segment)
+    return np.frombuffer(str(Seq(''.join(codon_list)).translate(table=transl_table)).encode(), dtype=np.uint8)
 
-                # resetting segment
-                current_segment = [each_element, each_element]
-                current_element = each_element
 
-        # add segment to list
-        segments_out.append(current_segment)
+def translate_gene_list(sequence_nc_list, transl_table_list):
 
-        return segments_out
+    # translate genes of a genome in one go with codon lookup tables, genes with codons other than A, C, G and T
+    # (e.g. N) or a partial codon at the end are translated by Biopython
+    codon_num_list = [len(sequence_nc) // 3 for sequence_nc in sequence_nc_list]
+    codon_offsets = np.concatenate([[0], np.cumsum(codon_num_list, dtype=np.int64)])
+    base_code = base_code_lookup[np.frombuffer(''.join([sequence_nc[:(codon_num * 3)] for sequence_nc, codon_num in zip(sequence_nc_list, codon_num_list)]).encode(), dtype=np.uint8)]
+    codon_index = base_code[0::3].astype(np.int64) * 16 + base_code[1::3] * 4 + base_code[2::3]
+    invalid_codon = (base_code[0::3] | base_code[1::3] | base_code[2::3]) > 3
+    codon_index[invalid_codon] = 0
 
-    def remove_columns_from_msa(alignment_in, cols_to_remove):
+    # genes of each transl_table
+    aa_array = np.empty(len(codon_index), dtype=np.uint8)
+    codon_transl_table = np.repeat(np.array(transl_table_list, dtype=object), codon_num_list)
+    for transl_table in set(transl_table_list):
+        codon_in_table = (codon_transl_table == transl_table)
+        aa_array[codon_in_table] = get_codon_lookup_table(transl_table)[codon_index[codon_in_table]]
+    aa_bytes = aa_array.tobytes()
 
-        # get 0 based index of all wanted columns
-        cols_to_remove_0_base = [(i - 1) for i in cols_to_remove]
-        aln_cols_index_all = list(range(alignment_in.get_alignment_length()))
-        aln_cols_index_wanted = []
-        for i in aln_cols_index_all:
-            if i not in cols_to_remove_0_base:
-                aln_cols_index_wanted.append(i)
+    fallback_gene_set = set((np.searchsorted(codon_offsets, np.flatnonzero(invalid_codon), side='right') - 1).tolist())
+    sequence_aa_list = []
+    for gene_index, sequence_nc in enumerate(sequence_nc_list):
+        if (gene_index in fallback_gene_set) or (len(sequence_nc) % 3 != 0):
+            sequence_aa_list.append(str(Seq(sequence_nc).translate(table=transl_table_list[gene_index])))
+        else:
+            sequence_aa_list.append(aa_bytes[codon_offsets[gene_index]:codon_offsets[gene_index + 1]].decode())
 
-        # get wanted alignment segments
-        wanted_segments = list_to_segments(aln_cols_index_wanted)
+    return sequence_aa_list
 
-        # create an empty Alignment object
-        alignment_new = Align.MultipleSeqAlignment([])
-        for sequence in alignment_in:
-            new_seq_object = Seq('')
-            new_seq_record = SeqRecord(new_seq_object)
-            new_seq_record.id = sequence.id
-            new_seq_record.description = sequence.description
-            alignment_new.append(new_seq_record)
 
-        # add wanted columns to empty Alignment object
-        for segment in wanted_segments:
+def get_fasta_lines(seq_id, seq):
 
-            # for single column segment
-            if segment[0] == segment[1]:
-                segment_value = alignment_in[:, segment[0]]
+    # the same as SeqIO.write in fasta format, sequences wrapped at 60 letters
+    return '>%s\n%s' % (seq_id, ''.join([(seq[i:i + 60] + '\n') for i in range(0, len(seq), 60)]))
 
-                m = 0
-                for each_seq in alignment_new:
-                    each_seq.seq = Seq(str(each_seq.seq) + segment_value[m])
-                    m += 1
 
-            # for multiple columns segment
-            else:
-                segment_value = alignment_in[:, (segment[0]):(segment[1] + 1)]
-                alignment_new += segment_value
+def get_gbk_qualifier_lines(key, value, quote):
 
-        return alignment_new
+    # the same line wrapping as SeqIO.write in genbank format
+    qualifier_indent = ' ' * 21
+    if quote is True:
+        line = '%s/%s="%s"' % (qualifier_indent, key, value.replace('"', '""'))
+    else:
+        line = '%s/%s=%s' % (qualifier_indent, key, value)
 
-    def remove_low_cov_columns(alignment_in, min_cov_cutoff):
+    # lines without space (e.g. translation) are cut at 80 letters
+    if ' ' not in line.lstrip():
+        return ''.join([(line[:80] + '\n')] + [(qualifier_indent + line[i:i + 59] + '\n') for i in range(80, len(line), 59)])
 
-        # get columns with low coverage
-        sequence_number = len(alignment_in)
-        total_col_num = alignment_in.get_alignment_length()
-        low_cov_columns = []
-        n = 0
-        while n < total_col_num:
-            current_column = alignment_in[:, n]
-            dash_number = current_column.count('-')
-            gap_percent = (dash_number / sequence_number) * 100
+    qualifier_lines = ''
+    while line.lstrip():
+        if len(line) <= 80:
+            return qualifier_lines + line + '\n'
+        index = 80
+        for each_index in range(min(len(line) - 1, 80), 22, -1):
+            if line[each_index] == ' ':
+                index = each_index
+                break
+        qualifier_lines += line[:index] + '\n'
+        line = qualifier_indent + line[index:].lstrip()
 
-            if gap_percent > min_cov_cutoff:
-                low_cov_columns.append(n + 1)
+    return qualifier_lines
 
-            n += 1
 
-        # remove identified columns
-        alignment_new = remove_columns_from_msa(alignment_in, low_cov_columns)
+def get_gbk_location(cds_start, cds_end, cds_strand, record_length):
 
-        return alignment_new
+    # location of FeatureLocation(cds_start, cds_end) as written by SeqIO.write in genbank format
+    if cds_start == cds_end:
+        if cds_end == record_length:
+            location = '%s^1' % record_length
+        else:
+            location = '%s^%s' % (cds_end, cds_end + 1)
+    elif cds_start + 1 == cds_end:
+        location = '%s' % cds_end
+    else:
+        location = '%s..%s' % (cds_start + 1, cds_end)
 
-    def remove_low_consensus_columns(alignment_in, min_css_cutoff):
+    if cds_strand == '-':
+        location = 'complement(%s)' % location
 
-        # get columns with low coverage
-        sequence_number = len(alignment_in)
-        total_col_num = alignment_in.get_alignment_length()
-        low_css_columns = []
-        n = 0
-        while n < total_col_num:
-            current_column = alignment_in[:, n]
+    return location
 
-            # get all aa in current column
-            aa_list = set()
-            for aa in current_column:
-                aa_list.add(aa)
 
-            # get maximum aa percent
-            most_abundant_aa_percent = 0
-            for each_aa in aa_list:
-                each_aa_percent = (current_column.count(each_aa) / sequence_number) * 100
-                if each_aa_percent > most_abundant_aa_percent:
-                    most_abundant_aa_percent = each_aa_percent
+def get_gbk_header_lines(seq_id, record_length):
 
-            # if maximum percent lower than provided cutoff, add current column to low consensus column list
-            if most_abundant_aa_percent < min_css_cutoff:
-                low_css_columns.append(n + 1)
+    # LOCUS to FEATURES lines written by SeqIO.write in genbank format for a SeqRecord with only id and sequence
+    if (len(seq_id) > 16) and (len(str(record_length)) > (11 - (len(seq_id) - 16))):
+        name_length = '%s %s' % (seq_id, record_length)
+    else:
+        name_length = seq_id + str(record_length).rjust(28)[len(seq_id):]
 
-            n += 1
+    accession = seq_id
+    if (seq_id.count('.') == 1) and seq_id[(seq_id.index('.') + 1):].isdigit():
+        accession = seq_id.split('.', 1)[0]
+    accession_with_version = accession
+    if seq_id.startswith(accession + '.'):
+        try:
+            accession_with_version = '%s.%i' % (accession, int(seq_id.split('.', 1)[1]))
+        except ValueError:
+            pass
 
-        # remove identified columns
-        alignment_new = remove_columns_from_msa(alignment_in, low_css_columns)
+    header_lines  = 'LOCUS       %s bp    DNA              UNK 01-JAN-1980\n' % name_length
+    header_lines += 'DEFINITION  .\n'
+    header_lines += 'ACCESSION   %s\n' % accession
+    header_lines += 'VERSION     %s\n' % accession_with_version
+    header_lines += 'KEYWORDS    .\n'
+    header_lines += 'SOURCE      .\n'
+    header_lines += '  ORGANISM  .\n'
+    header_lines += '            .\n'
+    header_lines += 'FEATURES             Location/Qualifiers\n'
 
-        return alignment_new
+    return header_lines
 
-    # read in alignment
-    alignment = AlignIO.read(alignment_file_in, "fasta")
 
-    # remove_low_cov_columns
-    alignment_cov = remove_low_cov_columns(alignment, minimal_cov)
+def get_gbk_sequence_lines(seq):
 
-    # remove_low_consensus_columns
-    alignment_cov_css = remove_low_consensus_columns(alignment_cov, min_consensus)
+    # 60 letters per line in blocks of 10
+    seq = seq.lower()
+    block_list = [seq[i:i + 10] for i in range(0, len(seq), 10)]
+    sequence_lines = ['%s %s\n' % (str(i * 10 + 1).rjust(9), ' '.join(block_list[i:i + 6])) for i in range(0, len(block_list), 6)]
 
-    # write filtered alignment
-    alignment_file_out_handle = open(alignment_file_out, 'w')
-    for each_seq in alignment_cov_css:
-        alignment_file_out_handle.write('>%s\n' % str(each_seq.id))
-        alignment_file_out_handle.write('%s\n' % str(each_seq.seq))
-    alignment_file_out_handle.close()
+    return 'ORIGIN\n' + ''.join(sequence_lines) + '//\n'
 
 
 def prodigal_parser(seq_file, sco_file, prefix, output_folder):
@@ -289,9 +287,11 @@ def prodigal_parser(seq_file, sco_file, prefix, output_folder):
     # get sequence id list
     id_to_sequence_dict = {}
     sequence_id_list = []
-    for each_seq in SeqIO.parse(seq_file, 'fasta'):
-        id_to_sequence_dict[each_seq.id] = str(each_seq.seq)
-        sequence_id_list.append(each_seq.id)
+    with open(seq_file) as seq_file_handle:
+        for seq_title, seq in SimpleFastaParser(seq_file_handle):
+            seq_id = seq_title.split(None, 1)[0] if seq_title.strip() != '' else ''
+            id_to_sequence_dict[seq_id] = seq
+            sequence_id_list.append(seq_id)
 
 
     # get sequence to cds dict and sequence to transl_table dict
@@ -323,71 +323,51 @@ def prodigal_parser(seq_file, sco_file, prefix, output_folder):
     seq_to_transl_table_dict[current_seq_id] = current_transl_table
 
 
-    bin_gbk_file_handle = open(pwd_bin_gbk_file, 'w')
-    bin_ffn_file_handle = open(pwd_bin_ffn_file, 'w')
-    bin_faa_file_handle = open(pwd_bin_faa_file, 'w')
-    gene_index = 1
+    # cut genes out of sequences, reverse complement table is taken from Biopython
+    complement_from = ''.join([chr(i) for i in range(32, 127)])
+    complement_table = str.maketrans(complement_from, str(Seq(complement_from, generic_dna).complement()))
+    gene_list = []
+    sequence_nc_list = []
+    transl_table_list = []
     for seq_id in sequence_id_list:
-
-        # create SeqRecord
-        current_sequence = Seq(id_to_sequence_dict[seq_id])
-        current_SeqRecord = SeqRecord(current_sequence, id=seq_id)
-        current_SeqRecord.seq.alphabet = generic_dna
-        transl_table = seq_to_transl_table_dict[seq_id]
-
-        # add SeqFeature to SeqRecord
         for cds in seq_to_cds_dict[seq_id]:
-
-            # define locus_tag id
-            locus_tag_id = '%s_%s' % (prefix, "{:0>5}".format(gene_index))
-
-            # define FeatureLocation
             cds_split = cds.split('_')
-            cds_start = SF.ExactPosition(int(cds_split[0]))
-            cds_end = SF.ExactPosition(int(cds_split[1]))
+            cds_start = int(cds_split[0])
+            cds_end = int(cds_split[1])
             cds_strand = cds_split[2]
-            current_strand = None
-            if cds_strand == '+':
-                current_strand = 1
-            if cds_strand == '-':
-                current_strand = -1
-            current_feature_location = FeatureLocation(cds_start, cds_end, strand=current_strand)
-
-            # get nc sequence
             sequence_nc = ''
             if cds_strand == '+':
                 sequence_nc = id_to_sequence_dict[seq_id][cds_start-1:cds_end]
             if cds_strand == '-':
-                sequence_nc = str(Seq(id_to_sequence_dict[seq_id][cds_start-1:cds_end], generic_dna).reverse_complement())
+                sequence_nc = id_to_sequence_dict[seq_id][cds_start-1:cds_end].translate(complement_table)[::-1]
+            gene_list.append([seq_id, cds_start, cds_end, cds_strand])
+            sequence_nc_list.append(sequence_nc)
+            transl_table_list.append(seq_to_transl_table_dict[seq_id])
 
-            # translate to aa sequence
-            sequence_aa = str(SeqRecord(Seq(sequence_nc)).seq.translate(table=transl_table))
+    # translate to aa sequence, and remove * at the end
+    sequence_aa_list = [sequence_aa[:-1] for sequence_aa in translate_gene_list(sequence_nc_list, transl_table_list)]
 
-            # remove * at the end
-            sequence_aa = sequence_aa[:-1]
 
-            # export nc and aa sequences
-            export_dna_record(sequence_nc, locus_tag_id, '', bin_ffn_file_handle)
-            export_aa_record(sequence_aa, locus_tag_id, '', bin_faa_file_handle)
-
-            # Define feature type
-            current_feature_type = 'CDS'
-
-            # Define feature qualifiers
-            current_qualifiers_dict = {}
-            current_qualifiers_dict['locus_tag'] = locus_tag_id
-            current_qualifiers_dict['transl_table'] = transl_table
-            current_qualifiers_dict['translation'] = sequence_aa
-
-            # Create a SeqFeature
-            current_feature = SeqFeature(current_feature_location, type=current_feature_type, qualifiers=current_qualifiers_dict)
-
-            # Append Feature to SeqRecord
-            current_SeqRecord.features.append(current_feature)
+    # export nc and aa sequences and genbank records, genes are numbered in the order they are in sequences
+    bin_gbk_file_handle = open(pwd_bin_gbk_file, 'w', buffering=1024 * 1024)
+    bin_ffn_file_handle = open(pwd_bin_ffn_file, 'w', buffering=1024 * 1024)
+    bin_faa_file_handle = open(pwd_bin_faa_file, 'w', buffering=1024 * 1024)
+    gene_index = 0
+    for seq_id in sequence_id_list:
+        current_sequence = id_to_sequence_dict[seq_id]
+        gbk_feature_lines = []
+        for cds in seq_to_cds_dict[seq_id]:
+            gene_seq_id, cds_start, cds_end, cds_strand = gene_list[gene_index]
+            locus_tag_id = '%s_%s' % (prefix, "{:0>5}".format(gene_index + 1))
+            bin_ffn_file_handle.write(get_fasta_lines(locus_tag_id, sequence_nc_list[gene_index]))
+            bin_faa_file_handle.write(get_fasta_lines(locus_tag_id, sequence_aa_list[gene_index]))
+            gbk_feature_lines.append('     CDS             %s\n' % get_gbk_location(cds_start, cds_end, cds_strand, len(current_sequence)))
+            gbk_feature_lines.append(get_gbk_qualifier_lines('locus_tag', locus_tag_id, True))
+            gbk_feature_lines.append(get_gbk_qualifier_lines('transl_table', transl_table_list[gene_index], False))
+            gbk_feature_lines.append(get_gbk_qualifier_lines('translation', sequence_aa_list[gene_index], True))
             gene_index += 1
 
-        # export to gbk file
-        SeqIO.write(current_SeqRecord, bin_gbk_file_handle, 'genbank')
+        bin_gbk_file_handle.write(get_gbk_header_lines(seq_id, len(current_sequence)) + ''.join(gbk_feature_lines) + get_gbk_sequence_lines(current_sequence))
 
     bin_gbk_file_handle.close()
     bin_ffn_file_handle.close()
@@ -425,12 +405,30 @@ def prodigal_worker(argument_list):
     pwd_prodigal_exe = argument_list[2]
     nonmeta_mode = argument_list[3]
     pwd_prodigal_output_folder = argument_list[4]
+    pwd_annotation_store = argument_list[5]
+    prodigal_version = argument_list[6]
 
     # prepare command (according to Prokka)
     input_genome_basename, input_genome_ext = os.path.splitext(input_genome)
     pwd_input_genome = '%s/%s' % (input_genome_folder, input_genome)
     pwd_output_sco = '%s/%s.sco' % (pwd_prodigal_output_folder, input_genome_basename)
 
+    # link annotation from store if the same genome was annotated before, re-parse Prodigal output if it was
+    # annotated under another name
+    if pwd_annotation_store is not None:
+        annotation_key = get_annotation_key(pwd_input_genome, nonmeta_mode, prodigal_version)
+        annotation_fetched = fetch_annotation(pwd_annotation_store, annotation_key, input_genome_basename, pwd_output_sco, pwd_prodigal_output_folder)
+        if annotation_fetched == 'all':
+            return 'reused'
+        if annotation_fetched == 'sco':
+            prodigal_parser(pwd_input_genome, pwd_output_sco, input_genome_basename, pwd_prodigal_output_folder)
+            add_annotation(pwd_annotation_store, annotation_key, input_genome_basename, pwd_output_sco, pwd_prodigal_output_folder)
+            return 'parsed'
+
+    # sco file of previous run might be linked to the store, remove it rather than overwrite it
+    if os.path.isfile(pwd_output_sco):
+        os.remove(pwd_output_sco)
+
     prodigal_cmd_meta = '%s -f sco -q -c -m -g 11 -p meta -i %s -o %s' % (
     pwd_prodigal_exe, pwd_input_genome, pwd_output_sco)
     prodigal_cmd_nonmeta = '%s -f sco -q -c -m -g 11 -i %s -o %s' % (
@@ -441,11 +439,30 @@ def prodigal_worker(argument_list):
     else:
         prodigal_cmd = prodigal_cmd_meta
 
-    os.system(prodigal_cmd)
+    profiled_system(prodigal_cmd, 'prodigal')
 
     # prepare ffn, faa and gbk files from prodigal output
     prodigal_parser(pwd_input_genome, pwd_output_sco, input_genome_basename, pwd_prodigal_output_folder)
 
+    if pwd_annotation_store is not None:
+        add_annotation(pwd_annotation_store, annotation_key, input_genome_basename, pwd_output_sco, pwd_prodigal_output_folder)
+
+    return 'annotated'
+
+
+def get_species_tree_key(pwd_faa_folder, faa_file_list, path_to_hmm, minimal_cov_in_msa, min_consensus_in_msa):
+
+    # species tree depends only on the proteins of the genomes in it, the marker genes and column filtering cutoffs,
+    # not on the grouping rank
+    species_tree_key = hashlib.sha1(('cov%s_css%s\n' % (minimal_cov_in_msa, min_consensus_in_msa)).encode())
+    with open(path_to_hmm, 'rb') as hmm_file_handle:
+        species_tree_key.update(hashlib.sha1(hmm_file_handle.read()).digest())
+    for faa_file in sorted(faa_file_list):
+        with open('%s/%s' % (pwd_faa_folder, faa_file), 'rb') as faa_file_handle:
+            species_tree_key.update(('%s\n' % faa_file).encode() + hashlib.sha1(faa_file_handle.read()).digest())
+
+    return species_tree_key.hexdigest()
+
 
 def copy_annotaion_worker(argument_list):
     genome = argument_list[0]
@@ -459,100 +476,138 @@ def copy_annotaion_worker(argument_list):
     #os.system('cp %s/%s.gbk %s' % (pwd_prodigal_output_folder, genome, pwd_gbk_folder))  # may not need
 
 
-def hmmsearch_worker(argument_list):
-
-    faa_file_basename = argument_list[0]
-    pwd_SCG_tree_wd = argument_list[1]
-    pwd_hmmsearch_exe = argument_list[2]
-    path_to_hmm = argument_list[3]
-    pwd_faa_folder = argument_list[4]
-
-    # run hmmsearch
-    pwd_faa_file = '%s/%s.faa' % (pwd_faa_folder, faa_file_basename)
-    os.system('%s -o /dev/null --domtblout %s/%s_hmmout.tbl %s %s' % (pwd_hmmsearch_exe, pwd_SCG_tree_wd, faa_file_basename, path_to_hmm, pwd_faa_file))
-
-    # Reading the protein file in a dictionary
-    proteinSequence = {}
-    for seq_record in SeqIO.parse(pwd_faa_file, 'fasta'):
-        proteinSequence[seq_record.id] = str(seq_record.seq)
-
-    # Reading the hmmersearch table/extracting the protein part found beu hmmsearch out of the protein/Writing
-    # each protein sequence that was extracted to a fasta file (one for each hmm in phylo.hmm
-    hmm_id = ''
-    hmm_name = ''
-    hmm_pos1 = 0
-    hmm_pos2 = 0
-    hmm_score = 0
-    pwd_hmmout_tbl = pwd_SCG_tree_wd + '/' + faa_file_basename + '_hmmout.tbl'
-    with open(pwd_hmmout_tbl, 'r') as tbl:
-        for line in tbl:
-            if line[0] == "#": continue
-            line = re.sub('\s+', ' ', line)
-            splitLine = line.split(' ')
-
-            if (hmm_id == ''):
-                hmm_id = splitLine[4]
-                hmm_name = splitLine[0]
-                hmm_pos1 = int(splitLine[17]) - 1
-                hmm_pos2 = int(splitLine[18])
-                hmm_score = float(splitLine[13])
-            elif (hmm_id == splitLine[4]):
-                if (float(splitLine[13]) > hmm_score):
-                    hmm_name = splitLine[0]
-                    hmm_pos1 = int(splitLine[17]) - 1
-                    hmm_pos2 = int(splitLine[18])
-                    hmm_score = float(splitLine[13])
+# default reporting thresholds of hmmsearch (-E and --domE), E-values in domtblout have two significant digits
+hmmsearch_reporting_threshold = 10
+hmmsearch_evalue_rounding_error = 0.05
+
+
+def get_hmmsearch_reporting_status(evalue_min, evalue_max):
+
+    # 'yes' or 'no' if a hit with an E-value between evalue_min and evalue_max (as printed) is reported or not,
+    # 'uncertain' if it is too close to the threshold to tell
+    if evalue_max * (1 + hmmsearch_evalue_rounding_error) <= hmmsearch_reporting_threshold:
+        return 'yes'
+    if evalue_min * (1 - hmmsearch_evalue_rounding_error) > hmmsearch_reporting_threshold:
+        return 'no'
+
+    return 'uncertain'
+
+
+def parse_hmmsearch_domtblout(pwd_hmmout_tbl, search_space_size=None, genome_proteome_size_dict=None):
+
+    # return {(genome, hmm_id): [score, protein, ali_from, ali_to]} of the best domain (by domain score, the first one
+    # if tied) of each marker in each genome, proteins are named genome_index.
+    # For a chunk of proteomes searched with -Z search_space_size and --domZ 1, E-values are rescaled to what they
+    # would be if each genome was searched on its own (-Z: proteome size, --domZ: number of reported proteins of the
+    # genome for the marker) and hits above the reporting thresholds are dropped. Genomes in which a hit too close to
+    # a threshold to tell could be the best domain of a marker are returned as well, they need to be searched on
+    # their own.
+    domain_line_list = []
+    protein_status_dict = {}
+    with open(pwd_hmmout_tbl) as hmmout_tbl_handle:
+        for each_line in hmmout_tbl_handle:
+            if each_line[0] == '#':
+                continue
+            each_line_split = each_line.split(None, 22)
+            protein_id = each_line_split[0]
+            genome_hmm = ('_'.join(protein_id.split('_')[:-1]), each_line_split[4])
+            if genome_hmm not in protein_status_dict:
+                protein_status_dict[genome_hmm] = {}
+            if search_space_size is None:
+                protein_status_dict[genome_hmm][protein_id] = 'yes'
             else:
-                file_out = open(pwd_SCG_tree_wd + '/' + hmm_id + '.fasta', 'a+')
-                file_out.write('>' + faa_file_basename + '\n')
-                if hmm_name != '':
-                    seq = str(proteinSequence[hmm_name][hmm_pos1:hmm_pos2])
-                    file_out.write(str(seq) + '\n')
-                    file_out.close()
-                hmm_id = splitLine[4]
-                hmm_name = splitLine[0]
-                hmm_pos1 = int(splitLine[17]) - 1
-                hmm_pos2 = int(splitLine[18])
-                hmm_score = float(splitLine[13])
-
-        else:
-            file_out = open(pwd_SCG_tree_wd + '/' + hmm_id + '.fasta', 'a+')
-            file_out.write('>' + faa_file_basename + '\n')
-            if hmm_name != '':
-                seq = str(proteinSequence[hmm_name][hmm_pos1:hmm_pos2])
-                file_out.write(str(seq) + '\n')
-                file_out.close()
+                sequence_evalue = float(each_line_split[6]) * genome_proteome_size_dict[genome_hmm[0]] / search_space_size
+                protein_status_dict[genome_hmm][protein_id] = get_hmmsearch_reporting_status(sequence_evalue, sequence_evalue)
+            domain_line_list.append([genome_hmm, protein_id, each_line_split])
+
+    best_domain_dict = {}
+    best_uncertain_domain_score_dict = {}
+    for genome_hmm, protein_id, each_line_split in domain_line_list:
+        domain_status = protein_status_dict[genome_hmm][protein_id]
+        if (search_space_size is not None) and (domain_status != 'no'):
+            protein_status_list = list(protein_status_dict[genome_hmm].values())
+            domain_evalue = float(each_line_split[11])
+            domain_evalue_status = get_hmmsearch_reporting_status(domain_evalue * protein_status_list.count('yes'), domain_evalue * (len(protein_status_list) - protein_status_list.count('no')))
+            if domain_evalue_status != 'yes':
+                domain_status = domain_evalue_status
+        domain_score = float(each_line_split[13])
+        if domain_status == 'yes':
+            if (genome_hmm not in best_domain_dict) or (domain_score > best_domain_dict[genome_hmm][0]):
+                best_domain_dict[genome_hmm] = [domain_score, protein_id, int(each_line_split[17]) - 1, int(each_line_split[18])]
+        elif domain_status == 'uncertain':
+            best_uncertain_domain_score_dict[genome_hmm] = max(domain_score, best_uncertain_domain_score_dict.get(genome_hmm, domain_score))
+
+    uncertain_genome_set = set()
+    for genome_hmm, domain_score in best_uncertain_domain_score_dict.items():
+        if (genome_hmm not in best_domain_dict) or (domain_score >= best_domain_dict[genome_hmm][0]):
+            uncertain_genome_set.add(genome_hmm[0])
+
+    return best_domain_dict, uncertain_genome_set
+
+
+def hmmsearch_batch_worker(argument_list):
+
+    chunk_index = argument_list[0]
+    faa_file_basename_list = argument_list[1]
+    pwd_SCG_tree_wd = argument_list[2]
+    pwd_hmmsearch_exe = argument_list[3]
+    path_to_hmm = argument_list[4]
+    pwd_faa_folder = argument_list[5]
+    hmmsearch_cpu = argument_list[6]
+
+    pwd_chunk_faa = '%s/hmmsearch_chunk_%s.faa' % (pwd_SCG_tree_wd, chunk_index)
+    pwd_hmmout_tbl = '%s/hmmsearch_chunk_%s_hmmout.tbl' % (pwd_SCG_tree_wd, chunk_index)
+
+    # concatenate proteomes of the chunk
+    protein_seq_dict = {}
+    genome_proteome_size_dict = {}
+    with open(pwd_chunk_faa, 'w') as chunk_faa_handle:
+        for faa_file_basename in faa_file_basename_list:
+            genome_proteome_size_dict[faa_file_basename] = 0
+            for seq_record in SeqIO.parse('%s/%s.faa' % (pwd_faa_folder, faa_file_basename), 'fasta'):
+                protein_seq_dict[seq_record.id] = str(seq_record.seq)
+                chunk_faa_handle.write('>%s\n%s\n' % (seq_record.id, protein_seq_dict[seq_record.id]))
+                genome_proteome_size_dict[faa_file_basename] += 1
+
+    # E-values are calculated with the size of the smallest proteome (-Z) and domain E-values with --domZ 1, so the
+    # output has all hits that would be reported for a genome searched on its own, E-values are rescaled to each
+    # genome when parsing
+    search_space_size = max(min(genome_proteome_size_dict.values()), 1)
+    profiled_system('%s -o /dev/null --cpu %s -Z %s --domZ 1 --domtblout %s %s %s' % (pwd_hmmsearch_exe, hmmsearch_cpu, search_space_size, pwd_hmmout_tbl, path_to_hmm, pwd_chunk_faa), 'hmmsearch')
+    best_domain_dict, uncertain_genome_set = parse_hmmsearch_domtblout(pwd_hmmout_tbl, search_space_size, genome_proteome_size_dict)
+
+    # genomes with hits too close to the reporting thresholds are searched on their own
+    for faa_file_basename in sorted(uncertain_genome_set):
+        pwd_genome_hmmout_tbl = '%s/%s_hmmout.tbl' % (pwd_SCG_tree_wd, faa_file_basename)
+        profiled_system('%s -o /dev/null --cpu %s --domtblout %s %s %s/%s.faa' % (pwd_hmmsearch_exe, hmmsearch_cpu, pwd_genome_hmmout_tbl, path_to_hmm, pwd_faa_folder, faa_file_basename), 'hmmsearch')
+        best_domain_dict = {genome_hmm: best_domain for genome_hmm, best_domain in best_domain_dict.items() if genome_hmm[0] != faa_file_basename}
+        best_domain_dict.update(parse_hmmsearch_domtblout(pwd_genome_hmmout_tbl)[0])
+
+    # extract the best hit region of each marker in each genome, marker files are written by the parent process
+    marker_seq_list = []
+    for (genome, hmm_id), (domain_score, protein_id, ali_from, ali_to) in best_domain_dict.items():
+        marker_seq_list.append([hmm_id, genome, protein_seq_dict[protein_id][ali_from:ali_to]])
+
+    os.remove(pwd_chunk_faa)
+
+    return marker_seq_list
 
 
 def convert_hmmalign_output(align_in, align_out):
 
-    # read in alignment
-    sequence_id_list = []
-    sequence_seq_dict = {}
+    # read in alignment, sequences are split into blocks, ids in the order they first appear
+    sequence_block_dict = {}
     for aligned_seq in open(align_in):
-        aligned_seq_split = aligned_seq.strip().split(' ')
-        aligned_seq_split = remove_empty_element(aligned_seq_split)
-
-        if aligned_seq_split != []:
-            aligned_seq_id = aligned_seq_split[0]
-            aligned_seq_seq = aligned_seq_split[1]
-
-            # add id to sequence id list
-            if aligned_seq_id not in sequence_id_list:
-                sequence_id_list.append(aligned_seq_id)
-
-            # add seq to sequence seq dict
-            if aligned_seq_id not in sequence_seq_dict:
-                sequence_seq_dict[aligned_seq_id] = aligned_seq_seq
-            else:
-                sequence_seq_dict[aligned_seq_id] += aligned_seq_seq
+        aligned_seq_split = aligned_seq.split()
+        if len(aligned_seq_split) >= 2:
+            if aligned_seq_split[0] not in sequence_block_dict:
+                sequence_block_dict[aligned_seq_split[0]] = []
+            sequence_block_dict[aligned_seq_split[0]].append(aligned_seq_split[1])
 
     # write out
     align_out_handle = open(align_out, 'w')
-    for sequence_id in sequence_id_list:
-        sequence_seq = sequence_seq_dict[sequence_id]
-        align_out_handle.write('>%s\n' % sequence_id)
-        align_out_handle.write('%s\n' % sequence_seq)
+    for sequence_id in sequence_block_dict:
+        align_out_handle.write('>%s\n%s\n' % (sequence_id, ''.join(sequence_block_dict[sequence_id])))
     align_out_handle.close()
 
 
@@ -568,7 +623,7 @@ def hmmalign_worker(argument_list):
     pwd_aln_out =     '%s/%s_aligned.fasta'     % (pwd_SCG_tree_wd, fastaFile_basename)
 
     hmmalign_cmd = '%s --trim --outformat PSIBLAST %s %s > %s ; rm %s' % (pwd_hmmalign_exe, pwd_hmm_file, pwd_seq_in, pwd_aln_out_tmp, pwd_seq_in)
-    os.system(hmmalign_cmd)
+    profiled_system(hmmalign_cmd, 'hmmalign')
 
     # convert alignment format
     convert_hmmalign_output(pwd_aln_out_tmp, pwd_aln_out)
@@ -613,7 +668,7 @@ def parallel_blastn_worker(argument_list):
                                                         pwd_blast_db,
                                                         pwd_blast_result_file,
                                                         blast_parameters)
-    os.system(blastn_cmd)
+    profiled_system(blastn_cmd, 'blastn')
 
 
 def create_blastn_job_script(wd_on_katana, job_script_folder, job_script_file_name, node_num, ppn_num, memory, walltime,
@@ -662,6 +717,9 @@ def PI(args, config_dict):
     nonmeta_mode =          args['nonmeta']
     qsub_on =               args['qsub']
     noblast =               args['noblast']
+    incremental =           args['incremental']
+    pwd_annotation_store =  args['annotation_store']
+    annotation_store_gb =   args['annotation_store_gb']
 
     # read in config file
 
@@ -711,13 +769,28 @@ def PI(args, config_dict):
         print('No input genome detected, program exited!')
         exit()
 
+    # incremental mode adds new genomes to annotation and blast results of previous run
+    if incremental is True:
+        if (qsub_on is True) or (noblast is True):
+            print('Incremental mode can not be used together with -qsub or -noblast, program exited!')
+            exit()
+        if (os.path.isdir('%s/%s_all_prodigal_output' % (MetaCHIP_wd, output_prefix)) is False) or (os.path.isdir('%s/%s_all_blastn_results' % (MetaCHIP_wd, output_prefix)) is False):
+            print('No annotation or blast results of previous run found, all input genomes will be processed')
+            incremental = False
+
 
     # report running mode
     if grouping_only is True:
         report_and_log('running with grouping-only mode', pwd_log_file, keep_quiet)
+    elif incremental is True:
+        if os.path.isdir(pwd_log_folder) is False:
+            os.mkdir(pwd_log_folder)
+        start_profiling('PI', pwd_log_file)
+        report_and_log('running with incremental mode', pwd_log_file, keep_quiet)
     else:
         force_create_folder(MetaCHIP_wd)
         force_create_folder(pwd_log_folder)
+        start_profiling('PI', pwd_log_file)
 
 
     ############################################ read GTDB output into dict  ###########################################
@@ -834,6 +907,9 @@ def PI(args, config_dict):
     blast_db_folder =                    '%s_all_blastdb'                       % (output_prefix)
     blast_results_file =                 '%s_all_all_vs_all_blastn.tab'         % (output_prefix)
     blast_result_folder =                '%s_all_blastn_results'                % (output_prefix)
+    blast_result_incremental_folder =    '%s_all_blastn_results_incremental'    % (output_prefix)
+    new_genome_ffn_file =                '%s_new_genomes_ffn.fasta'             % (output_prefix)
+    blast_hit_store_folder =             '%s_all_blastn_results_store'          % (output_prefix)
     blast_cmd_file =                     '%s_all_blastn_commands.txt'           % (output_prefix)
     blast_job_scripts_folder =           '%s_all_blastn_job_scripts'            % (output_prefix)
 
@@ -850,9 +926,9 @@ def PI(args, config_dict):
     usearch_output_txt =                 '%s_%s%s_usearch_output.txt'           % (output_prefix, grouping_level, group_num)
     usearch_cluster_to_gene_file =       '%s_%s%s_gene_clusters.txt'            % (output_prefix, grouping_level, group_num)
     SCG_tree_wd =                        '%s_%s%s_get_SCG_tree_wd'              % (output_prefix, grouping_level, group_num)
-    combined_alignment_file_tmp =        '%s_%s%s_species_tree_tmp.aln'         % (output_prefix, grouping_level, group_num)
     combined_alignment_file =            '%s_%s%s_species_tree_cov%s_css%s.aln' % (output_prefix, grouping_level, group_num, minimal_cov_in_msa, min_consensus_in_msa)
     newick_tree_file =                   '%s_%s%s_species_tree.newick'          % (output_prefix, grouping_level, group_num)
+    species_tree_cache_folder =          '%s_species_tree_cache'                % (output_prefix)
     hmm_profile_sep_folder =             '%s_%s%s_hmm_profile_fetched'          % (output_prefix, grouping_level, group_num)
 
     pwd_genome_size_file =               '%s/%s'                                % (MetaCHIP_wd, genome_size_file_name)
@@ -873,11 +949,13 @@ def PI(args, config_dict):
     pwd_usearch_output_txt =             '%s/%s'                                % (MetaCHIP_wd, usearch_output_txt)
     pwd_usearch_cluster_to_gene_file =   '%s/%s'                                % (MetaCHIP_wd, usearch_cluster_to_gene_file)
     pwd_SCG_tree_wd =                    '%s/%s'                                % (MetaCHIP_wd, SCG_tree_wd)
-    pwd_combined_alignment_file_tmp =    '%s/%s/%s'                             % (MetaCHIP_wd, SCG_tree_wd, combined_alignment_file_tmp)
     pwd_combined_alignment_file =        '%s/%s/%s'                             % (MetaCHIP_wd, SCG_tree_wd, combined_alignment_file)
     pwd_hmm_profile_sep_folder =         '%s/%s/%s'                             % (MetaCHIP_wd, SCG_tree_wd, hmm_profile_sep_folder)
     pwd_newick_tree_file =               '%s/%s'                                % (MetaCHIP_wd, newick_tree_file)
+    pwd_species_tree_cache_folder =      '%s/%s'                                % (MetaCHIP_wd, species_tree_cache_folder)
     pwd_blast_result_folder =            '%s/%s'                                % (MetaCHIP_wd, blast_result_folder)
+    pwd_blast_result_incremental_folder = '%s/%s'                               % (MetaCHIP_wd, blast_result_incremental_folder)
+    pwd_blast_hit_store_folder =         '%s/%s'                                % (MetaCHIP_wd, blast_hit_store_folder)
     pwd_blast_job_scripts_folder =       '%s/%s'                                % (MetaCHIP_wd, blast_job_scripts_folder)
     pwd_blast_cmd_file =                 '%s/%s'                                % (MetaCHIP_wd, blast_cmd_file)
 
@@ -954,6 +1032,11 @@ def PI(args, config_dict):
     for each_id in group_id_uniq_sorted:
         group_id_uniq_count.append(group_id_all.count(each_id))
 
+    # matplotlib is slow to import, only load it when plotting
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+
     x_range = range(len(group_id_uniq_sorted))
     if grouping_level == 'x':
         plt.bar(x_range, group_id_uniq_count, tick_label=group_id_uniq_sorted, align='center', alpha=0.2, linewidth=0)
@@ -1020,27 +1103,44 @@ def PI(args, config_dict):
 
     if grouping_only == False:
 
-        # for report and log
-        report_and_log(('Running Prodigal with %s cores for all input genomes' % num_threads), pwd_log_file, keep_quiet)
-
-        # create prodigal output folder
-        force_create_folder(pwd_prodigal_output_folder)
-
         # get input genome list
         input_genome_file_re = '%s/*.%s' % (input_genome_folder, file_extension)
         input_genome_file_name_list = [os.path.basename(file_name) for file_name in glob.glob(input_genome_file_re)]
 
+        # in incremental mode, only genomes without annotation from previous run will be annotated
+        if incremental is True:
+            new_genome_list = [input_genome for input_genome in input_genome_file_name_list if not os.path.isfile('%s/%s.ffn' % (pwd_prodigal_output_folder, os.path.splitext(input_genome)[0]))]
+            report_and_log(('Running Prodigal with %s cores for %s new genomes' % (num_threads, len(new_genome_list))), pwd_log_file, keep_quiet)
+        else:
+            new_genome_list = input_genome_file_name_list
+            report_and_log(('Running Prodigal with %s cores for all input genomes' % num_threads), pwd_log_file, keep_quiet)
+
+            # create prodigal output folder
+            force_create_folder(pwd_prodigal_output_folder)
+
+        # annotation store is keyed by Prodigal version
+        prodigal_version = None
+        if pwd_annotation_store is not None:
+            os.makedirs(pwd_annotation_store, exist_ok=True)
+            pwd_annotation_store = os.path.abspath(pwd_annotation_store)
+            prodigal_version = get_prodigal_version(pwd_prodigal_exe)
+
         # prepare arguments for prodigal_worker
         list_for_multiple_arguments_Prodigal = []
-        for input_genome in input_genome_file_name_list:
-            list_for_multiple_arguments_Prodigal.append([input_genome, input_genome_folder, pwd_prodigal_exe, nonmeta_mode, pwd_prodigal_output_folder])
+        for input_genome in new_genome_list:
+            list_for_multiple_arguments_Prodigal.append([input_genome, input_genome_folder, pwd_prodigal_exe, nonmeta_mode, pwd_prodigal_output_folder, pwd_annotation_store, prodigal_version])
 
         # run prodigal with multiprocessing
         pool = mp.Pool(processes=num_threads)
-        pool.map(prodigal_worker, list_for_multiple_arguments_Prodigal)
+        prodigal_status_list = profiled_pool_map(pool, prodigal_worker, list_for_multiple_arguments_Prodigal)
         pool.close()
         pool.join()
 
+        if pwd_annotation_store is not None:
+            report_and_log(('Annotation store: %s genomes linked, %s re-parsed from Prodigal output, %s annotated with Prodigal' % (prodigal_status_list.count('reused'), prodigal_status_list.count('parsed'), prodigal_status_list.count('annotated'))), pwd_log_file, keep_quiet)
+            evicted_entry_num, store_size = evict_annotation_store(pwd_annotation_store, annotation_store_gb)
+            report_and_log(('Annotation store: %s least recently used genomes evicted, store size %.2f GB' % (evicted_entry_num, store_size / (1024 * 1024 * 1024))), pwd_log_file, keep_quiet)
+
 
     ################ copy annotation files (with clear taxonomic classification) into separate folders #################
 
@@ -1063,19 +1163,13 @@ def PI(args, config_dict):
 
     # copy annotaion files with multiprocessing
     pool = mp.Pool(processes=num_threads)
-    pool.map(copy_annotaion_worker, list_for_multiple_arguments_copy_annotaion)
+    profiled_pool_map(pool, copy_annotaion_worker, list_for_multiple_arguments_copy_annotaion)
     pool.close()
     pool.join()
 
 
     ########################################### get species tree (hmmsearch) ###########################################
 
-    # create wd
-    force_create_folder(pwd_SCG_tree_wd)
-
-    # for report and log
-    report_and_log(('Running Hmmsearch with %s cores' % num_threads), pwd_log_file, keep_quiet)
-
     faa_file_re = '%s/*.faa' % pwd_faa_folder
     faa_file_list = [os.path.basename(file_name) for file_name in glob.glob(faa_file_re)]
     faa_file_list = sorted(faa_file_list)
@@ -1085,95 +1179,109 @@ def PI(args, config_dict):
         faa_file_basename, faa_file_extension = os.path.splitext(faa_file)
         faa_file_basename_list.append(faa_file_basename)
 
-    # prepare arguments for hmmsearch_worker
-    list_for_multiple_arguments_hmmsearch = []
-    for faa_file_basename in faa_file_basename_list:
-        list_for_multiple_arguments_hmmsearch.append([faa_file_basename, pwd_SCG_tree_wd, pwd_hmmsearch_exe, path_to_hmm, pwd_faa_folder])
+    # species tree of the same genomes was built for another rank in this run
+    species_tree_key = get_species_tree_key(pwd_faa_folder, faa_file_list, path_to_hmm, minimal_cov_in_msa, min_consensus_in_msa)
+    pwd_species_tree_cache_file = '%s/%s.newick' % (pwd_species_tree_cache_folder, species_tree_key)
 
-    # run hmmsearch with multiprocessing
-    pool = mp.Pool(processes=num_threads)
-    pool.map(hmmsearch_worker, list_for_multiple_arguments_hmmsearch)
-    pool.close()
-    pool.join()
+    if os.path.isfile(pwd_species_tree_cache_file):
+        shutil.copyfile(pwd_species_tree_cache_file, pwd_newick_tree_file)
+        report_and_log(('Species tree of the same genomes found in %s, exported to: %s' % (species_tree_cache_folder, newick_tree_file)), pwd_log_file, keep_quiet)
 
+    else:
 
-    ############################################# get species tree (hmmalign) #############################################
+        # create wd
+        force_create_folder(pwd_SCG_tree_wd)
 
-    # for report and log
-    report_and_log(('Running Hmmalign with %s cores' % num_threads), pwd_log_file, keep_quiet)
+        # for report and log
+        report_and_log(('Running Hmmsearch with %s cores' % num_threads), pwd_log_file, keep_quiet)
+
+        # proteomes are searched in chunks with multiple threads per hmmsearch, chunks are more than processes to
+        # balance the load
+        hmmsearch_cpu = min(4, num_threads)
+        hmmsearch_process_num = max(1, num_threads // hmmsearch_cpu)
+        hmmsearch_chunk_num = max(1, min(len(faa_file_basename_list), hmmsearch_process_num * 4))
+        list_for_multiple_arguments_hmmsearch = []
+        for chunk_index in range(hmmsearch_chunk_num):
+            list_for_multiple_arguments_hmmsearch.append([chunk_index, faa_file_basename_list[chunk_index::hmmsearch_chunk_num], pwd_SCG_tree_wd, pwd_hmmsearch_exe, path_to_hmm, pwd_faa_folder, hmmsearch_cpu])
+
+        # run hmmsearch with multiprocessing
+        pool = mp.Pool(processes=hmmsearch_process_num)
+        hmmsearch_results = profiled_pool_map(pool, hmmsearch_batch_worker, list_for_multiple_arguments_hmmsearch)
+        pool.close()
+        pool.join()
 
-    # fetch combined hmm profiles
-    force_create_folder(pwd_hmm_profile_sep_folder)
-    sep_combined_hmm(path_to_hmm, pwd_hmm_profile_sep_folder, pwd_hmmfetch_exe, pwd_hmmstat_exe)
+        # write sequences of each marker to its own file, genomes in the same order as faa files
+        marker_seq_dict = {}
+        for marker_seq_list in hmmsearch_results:
+            for hmm_id, genome, marker_seq in marker_seq_list:
+                if hmm_id not in marker_seq_dict:
+                    marker_seq_dict[hmm_id] = {}
+                marker_seq_dict[hmm_id][genome] = marker_seq
+        for hmm_id in marker_seq_dict:
+            with open('%s/%s.fasta' % (pwd_SCG_tree_wd, hmm_id), 'w') as marker_seq_handle:
+                for faa_file_basename in faa_file_basename_list:
+                    if faa_file_basename in marker_seq_dict[hmm_id]:
+                        marker_seq_handle.write('>%s\n%s\n' % (faa_file_basename, marker_seq_dict[hmm_id][faa_file_basename]))
 
-    # Call hmmalign to align all single fasta files with hmms
-    files = os.listdir(pwd_SCG_tree_wd)
-    fastaFiles = [i for i in files if i.endswith('.fasta')]
 
-    # prepare arguments for hmmalign_worker
-    list_for_multiple_arguments_hmmalign = []
-    for fastaFile in fastaFiles:
+        ############################################# get species tree (hmmalign) #############################################
 
-        fastaFiles_basename = '.'.join(fastaFile.split('.')[:-1])
-        list_for_multiple_arguments_hmmalign.append([fastaFiles_basename, pwd_SCG_tree_wd, pwd_hmm_profile_sep_folder, pwd_hmmalign_exe])
+        # for report and log
+        report_and_log(('Running Hmmalign with %s cores' % num_threads), pwd_log_file, keep_quiet)
 
-    # run hmmalign with multiprocessing
-    pool = mp.Pool(processes=num_threads)
-    pool.map(hmmalign_worker, list_for_multiple_arguments_hmmalign)
-    pool.close()
-    pool.join()
+        # fetch combined hmm profiles
+        force_create_folder(pwd_hmm_profile_sep_folder)
+        sep_combined_hmm(path_to_hmm, pwd_hmm_profile_sep_folder, pwd_hmmfetch_exe, pwd_hmmstat_exe)
 
+        # Call hmmalign to align all single fasta files with hmms
+        files = os.listdir(pwd_SCG_tree_wd)
+        fastaFiles = [i for i in files if i.endswith('.fasta')]
 
-    ################################### get species tree (Concatenating alignments) ####################################
+        # prepare arguments for hmmalign_worker
+        list_for_multiple_arguments_hmmalign = []
+        for fastaFile in fastaFiles:
+
+            fastaFiles_basename = '.'.join(fastaFile.split('.')[:-1])
+            list_for_multiple_arguments_hmmalign.append([fastaFiles_basename, pwd_SCG_tree_wd, pwd_hmm_profile_sep_folder, pwd_hmmalign_exe])
+
+        # run hmmalign with multiprocessing
+        pool = mp.Pool(processes=num_threads)
+        profiled_pool_map(pool, hmmalign_worker, list_for_multiple_arguments_hmmalign)
+        pool.close()
+        pool.join()
 
-    # for report and log
-    report_and_log('Concatenating alignments', pwd_log_file, keep_quiet)
-
-    # concatenating the single alignments
-    concatAlignment = {}
-    for element in faa_file_basename_list:
-        concatAlignment[element] = ''
-
-    # Reading all single alignment files and append them to the concatenated alignment
-    files = os.listdir(pwd_SCG_tree_wd)
-    fastaFiles = [i for i in files if i.endswith('.fasta')]
-    for faa_file_basename in fastaFiles:
-        fastaFile = pwd_SCG_tree_wd + '/' + faa_file_basename
-        proteinSequence = {}
-        alignmentLength = 0
-        for seq_record_2 in SeqIO.parse(fastaFile, 'fasta'):
-            proteinName = seq_record_2.id
-            proteinSequence[proteinName] = str(seq_record_2.seq)
-            alignmentLength = len(proteinSequence[proteinName])
-
-        for element in faa_file_basename_list:
-            if element in proteinSequence.keys():
-                concatAlignment[element] += proteinSequence[element]
-            else:
-                concatAlignment[element] += '-' * alignmentLength
 
-    # writing alignment to file
-    file_out = open(pwd_combined_alignment_file_tmp, 'w')
-    for element in faa_file_basename_list:
-        file_out.write('>' + element + '\n' + concatAlignment[element] + '\n')
-    file_out.close()
+        ################################### get species tree (Concatenating alignments) ####################################
 
-    # remove columns with low coverage and low consensus
-    report_and_log(('Removing columns from concatenated alignment represented by <%s%s of genomes and with an amino acid consensus <%s%s' % (minimal_cov_in_msa, '%', min_consensus_in_msa, '%')), pwd_log_file, keep_quiet)
-    remove_low_cov_and_consensus_columns(pwd_combined_alignment_file_tmp, minimal_cov_in_msa, min_consensus_in_msa, pwd_combined_alignment_file)
+        # for report and log
+        report_and_log('Concatenating alignments', pwd_log_file, keep_quiet)
 
+        # concatenating the single alignments into a genome x column array, genomes missing from a marker alignment
+        # are filled with gaps
+        aligned_marker_file_list = sorted(['%s/%s' % (pwd_SCG_tree_wd, i) for i in os.listdir(pwd_SCG_tree_wd) if i.endswith('_aligned.fasta')])
+        supermatrix_array = get_supermatrix_array(aligned_marker_file_list, faa_file_basename_list)
 
-    ########################################### get species tree (fasttree) ############################################
+        # remove columns with low coverage and low consensus
+        report_and_log(('Removing columns from concatenated alignment represented by <%s%s of genomes and with an amino acid consensus <%s%s' % (minimal_cov_in_msa, '%', min_consensus_in_msa, '%')), pwd_log_file, keep_quiet)
+        supermatrix_array = filter_msa_array_columns(supermatrix_array, minimal_cov_in_msa, min_consensus_in_msa)
+        write_msa_array(faa_file_basename_list, supermatrix_array, pwd_combined_alignment_file)
 
-    # for report and log
-    report_and_log('Running FastTree', pwd_log_file, keep_quiet)
 
-    # calling fasttree for tree calculation
-    fasttree_cmd = '%s -quiet %s > %s' % (pwd_fasttree_exe, pwd_combined_alignment_file, pwd_newick_tree_file)
-    os.system(fasttree_cmd)
+        ########################################### get species tree (fasttree) ############################################
 
-    # for report and log
-    report_and_log(('Species tree exported to: %s' % newick_tree_file), pwd_log_file, keep_quiet)
+        # for report and log
+        report_and_log('Running FastTree', pwd_log_file, keep_quiet)
+
+        # calling fasttree for tree calculation
+        fasttree_cmd = '%s -quiet %s > %s' % (pwd_fasttree_exe, pwd_combined_alignment_file, pwd_newick_tree_file)
+        profiled_system(fasttree_cmd, 'FastTree')
+
+        # for report and log
+        report_and_log(('Species tree exported to: %s' % newick_tree_file), pwd_log_file, keep_quiet)
+
+        # keep species tree for other ranks
+        os.makedirs(pwd_species_tree_cache_folder, exist_ok=True)
+        shutil.copyfile(pwd_newick_tree_file, pwd_species_tree_cache_file)
 
 
     ################################################### run Usearch ####################################################
@@ -1204,7 +1312,74 @@ def PI(args, config_dict):
 
     ############################################### run all vs all blastn ##############################################
 
-    if grouping_only == False:
+    if (grouping_only == False) and (incremental is True):
+
+        # blast database of all genes
+        force_create_folder(pwd_blast_db_folder)
+        os.system('cat %s/*.ffn > %s' % (pwd_prodigal_output_folder, pwd_combined_ffn_file))
+        os.system('cp %s %s' % (pwd_combined_ffn_file, pwd_blast_db_folder))
+        makeblastdb_cmd = '%s -in %s/%s -dbtype nucl -parse_seqids -logfile /dev/null' % (pwd_makeblastdb_exe, pwd_blast_db_folder, combined_ffn_file)
+        profiled_system(makeblastdb_cmd, 'makeblastdb')
+        pwd_blast_db = '%s/%s' % (pwd_blast_db_folder, combined_ffn_file)
+
+        # new genomes (and genomes without blast results) will be blasted against all genes, the others against
+        # genes of new genomes only, with e-value calculated for the size of the whole database
+        ffn_file_list = sorted([os.path.basename(file_name) for file_name in glob.glob('%s/*.ffn' % pwd_prodigal_output_folder)])
+        new_ffn_file_list = [i for i in ffn_file_list if not os.path.isfile('%s/%s_blastn.tab' % (pwd_blast_result_folder, '.'.join(i.split('.')[:-1])))]
+        previous_ffn_file_list = sorted(set(ffn_file_list) - set(new_ffn_file_list))
+
+        if len(new_ffn_file_list) == 0:
+            report_and_log(('No new genome found, blastn skipped'), pwd_log_file, keep_quiet)
+
+        else:
+            blast_db_size = 0
+            for each_line in open(pwd_combined_ffn_file):
+                if not each_line.startswith('>'):
+                    blast_db_size += len(each_line.strip())
+
+            force_create_folder(pwd_blast_result_incremental_folder)
+            pwd_new_genome_blast_db = '%s/%s' % (pwd_blast_db_folder, new_genome_ffn_file)
+            os.system('cat %s > %s' % (' '.join(['%s/%s' % (pwd_prodigal_output_folder, i) for i in new_ffn_file_list]), pwd_new_genome_blast_db))
+            makeblastdb_cmd = '%s -in %s -dbtype nucl -parse_seqids -logfile /dev/null' % (pwd_makeblastdb_exe, pwd_new_genome_blast_db)
+            profiled_system(makeblastdb_cmd, 'makeblastdb')
+
+            list_for_multiple_arguments_blastn = []
+            for ffn_file in new_ffn_file_list:
+                list_for_multiple_arguments_blastn.append([ffn_file, pwd_prodigal_output_folder, pwd_blast_db, pwd_blast_result_folder, blast_parameters, pwd_blastn_exe])
+            for ffn_file in previous_ffn_file_list:
+                list_for_multiple_arguments_blastn.append([ffn_file, pwd_prodigal_output_folder, pwd_new_genome_blast_db, pwd_blast_result_incremental_folder, '%s -dbsize %s' % (blast_parameters, blast_db_size), pwd_blastn_exe])
+
+            pwd_blast_cmd_file_handle = open(pwd_blast_cmd_file, 'w')
+            for ffn_file, pwd_query_folder, pwd_db, pwd_output_folder, parameters, pwd_exe in list_for_multiple_arguments_blastn:
+                blastn_cmd = '%s -query %s/%s -db %s -out %s/%s %s' % (pwd_exe, pwd_query_folder, ffn_file, pwd_db, pwd_output_folder, '%s_blastn.tab' % '.'.join(ffn_file.split('.')[:-1]), parameters)
+                pwd_blast_cmd_file_handle.write('%s\n' % blastn_cmd)
+            pwd_blast_cmd_file_handle.close()
+
+            report_and_log(('Running blastn for %s new genomes against all genes and %s previous genomes against genes of new genomes with %s cores' % (len(new_ffn_file_list), len(previous_ffn_file_list), num_threads)), pwd_log_file, keep_quiet)
+
+            # run blastn with multiprocessing
+            pool = mp.Pool(processes=num_threads)
+            profiled_pool_map(pool, parallel_blastn_worker, list_for_multiple_arguments_blastn)
+            pool.close()
+            pool.join()
+
+            # append hits to genes of new genomes to blast results of previous genomes
+            blast_result_file_stat_dict = {each_file_stat.split('\t')[0]: each_file_stat for each_file_stat in get_blast_result_file_stat(pwd_blast_result_folder)}
+            appended_file_stat_dict = {}
+            for blast_result_file in sorted(os.listdir(pwd_blast_result_incremental_folder)):
+                pwd_blast_result_incremental_file = '%s/%s' % (pwd_blast_result_incremental_folder, blast_result_file)
+                if (blast_result_file in blast_result_file_stat_dict) and (os.path.getsize(pwd_blast_result_incremental_file) > 0):
+                    appended_file_stat_dict[blast_result_file] = blast_result_file_stat_dict[blast_result_file]
+                    with open('%s/%s' % (pwd_blast_result_folder, blast_result_file), 'ab') as blast_result_file_handle:
+                        with open(pwd_blast_result_incremental_file, 'rb') as blast_result_incremental_file_handle:
+                            shutil.copyfileobj(blast_result_incremental_file_handle, blast_result_file_handle)
+            shutil.rmtree(pwd_blast_result_incremental_folder, ignore_errors=True)
+
+            # index hits of new genomes and appended hits into the blast hit store of previous run
+            report_and_log(('Indexing new blast results into %s' % blast_hit_store_folder), pwd_log_file, keep_quiet)
+            build_blast_hit_store(pwd_blast_result_folder, pwd_blast_hit_store_folder, appended_file_stat_dict)
+
+    if (grouping_only == False) and (incremental is False):
 
         # make blast db and run all vs all blastn
         force_create_folder(pwd_blast_db_folder)
@@ -1214,7 +1389,7 @@ def PI(args, config_dict):
         os.system('cat %s/*.ffn > %s' % (pwd_prodigal_output_folder, pwd_combined_ffn_file))
         os.system('cp %s %s' % (pwd_combined_ffn_file, pwd_blast_db_folder))
         makeblastdb_cmd = '%s -in %s/%s -dbtype nucl -parse_seqids -logfile /dev/null' % (pwd_makeblastdb_exe, pwd_blast_db_folder, combined_ffn_file)
-        os.system(makeblastdb_cmd)
+        profiled_system(makeblastdb_cmd, 'makeblastdb')
 
         # prepare arguments list for parallel_blastn_worker
         ffn_file_re = '%s/*.ffn' % pwd_prodigal_output_folder
@@ -1252,10 +1427,14 @@ def PI(args, config_dict):
 
                 # run blastn with multiprocessing
                 pool = mp.Pool(processes=num_threads)
-                pool.map(parallel_blastn_worker, list_for_multiple_arguments_blastn)
+                profiled_pool_map(pool, parallel_blastn_worker, list_for_multiple_arguments_blastn)
                 pool.close()
                 pool.join()
 
+                # index blast results into a columnar store for BP
+                report_and_log(('Indexing blast results into %s' % blast_hit_store_folder), pwd_log_file, keep_quiet)
+                build_blast_hit_store(pwd_blast_result_folder, pwd_blast_hit_store_folder)
+
 
     ############################################## remove temporary files ##############################################
 
@@ -1265,13 +1444,15 @@ def PI(args, config_dict):
     os.remove(pwd_combined_faa_file)
 
     os.system('rm -r %s' % pwd_faa_folder)
-    os.system('rm -r %s' % pwd_SCG_tree_wd)
+    if os.path.isdir(pwd_SCG_tree_wd):
+        os.system('rm -r %s' % pwd_SCG_tree_wd)
     # os.system('rm -r %s' % pwd_blast_db_folder)
 
 
     ############################################### for report and log file ##############################################
 
     report_and_log('PrepIn done!', pwd_log_file, keep_quiet)
+    end_profiling()
 
 
 
@@ -1293,6 +1474,9 @@ if __name__ == '__main__':
     parser.add_argument('-t',             required=False, type=int, default=1, help='number of threads, default: 1')
     parser.add_argument('-qsub',          required=False, action="store_true", help='run blastn with job scripts, only for HPC users')
     parser.add_argument('-force',         required=False, action="store_true", help='overwrite previous results')
+    parser.add_argument('-incremental',   required=False, action="store_true", help='only annotate and blast new genomes, add their results to those of previous run')
+    parser.add_argument('-annotation_store',    required=False, default=None, help='folder of Prodigal annotations shared by projects, reuse annotation of genomes found there')
+    parser.add_argument('-annotation_store_gb', required=False, type=float, default=100, help='maximum size of annotation store in GB, least recently used genomes are evicted, default: 100')
     parser.add_argument('-quiet',         required=False, action="store_true", help='not report progress')
 
     args = vars(parser.parse_args())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import hashlib
+import subprocess
+
+
+# Persistent store of Prodigal annotations, shared by projects. Each entry is a folder named by the hash of the genome
+# sequence file, Prodigal mode and version. It holds the Prodigal output (prodigal.sco) and the ffn, faa and gbk files
+# from prodigal_parser, which are named by genome (gene ids are prefixed with it), so an entry can hold files of more
+# than one genome name. Files are hard linked into projects (copied if the store is on another file system), the
+# modification time of an entry records its last use and least recently used entries are evicted first.
+
+annotation_file_ext_list = ['ffn', 'faa', 'gbk']
+
+
+def get_prodigal_version(pwd_prodigal_exe):
+
+    # "Prodigal V2.6.3: February, 2016" on stderr
+    try:
+        version_output = subprocess.run([pwd_prodigal_exe, '-v'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+    except OSError:
+        return 'unknown'
+
+    for each_line in version_output.split('\n'):
+        if each_line.strip().startswith('Prodigal'):
+            return each_line.strip().split(':')[0]
+
+    return 'unknown'
+
+
+def get_annotation_key(pwd_genome_file, nonmeta_mode, prodigal_version):
+
+    annotation_key = hashlib.sha256()
+    with open(pwd_genome_file, 'rb') as genome_file_handle:
+        for each_block in iter(lambda: genome_file_handle.read(1024 * 1024), b''):
+            annotation_key.update(each_block)
+    annotation_key.update(('\nnonmeta:%s\n%s' % (nonmeta_mode, prodigal_version)).encode())
+
+    return annotation_key.hexdigest()
+
+
+def link_or_copy(pwd_file_from, pwd_file_to):
+
+    if os.path.isfile(pwd_file_to):
+        os.remove(pwd_file_to)
+    try:
+        os.link(pwd_file_from, pwd_file_to)
+    except OSError:
+        shutil.copyfile(pwd_file_from, pwd_file_to)
+
+
+def fetch_annotation(pwd_annotation_store, annotation_key, genome_name, pwd_sco_file, output_folder):
+
+    # return 'all' if Prodigal output and annotation files of genome_name were linked into output_folder, 'sco' if
+    # only Prodigal output was found (genome annotated under another name), None if genome is not in the store
+    pwd_annotation_entry = '%s/%s' % (pwd_annotation_store, annotation_key)
+    pwd_entry_sco_file = '%s/prodigal.sco' % pwd_annotation_entry
+    if not os.path.isfile(pwd_entry_sco_file):
+        return None
+
+    link_or_copy(pwd_entry_sco_file, pwd_sco_file)
+    os.utime(pwd_annotation_entry)
+
+    for each_ext in annotation_file_ext_list:
+        if not os.path.isfile('%s/%s.%s' % (pwd_annotation_entry, genome_name, each_ext)):
+            return 'sco'
+
+    for each_ext in annotation_file_ext_list:
+        link_or_copy('%s/%s.%s' % (pwd_annotation_entry, genome_name, each_ext), '%s/%s.%s' % (output_folder, genome_name, each_ext))
+
+    return 'all'
+
+
+def add_annotation(pwd_annotation_store, annotation_key, genome_name, pwd_sco_file, output_folder):
+
+    # files are linked into a temporary folder (or with temporary names) first, so that workers annotating the same
+    # genome will never see an incomplete entry
+    pwd_annotation_entry = '%s/%s' % (pwd_annotation_store, annotation_key)
+    tmp_file_suffix = 'tmp%s' % os.getpid()
+
+    file_to_add_list = [[pwd_sco_file, 'prodigal.sco']]
+    for each_ext in annotation_file_ext_list:
+        file_to_add_list.append(['%s/%s.%s' % (output_folder, genome_name, each_ext), '%s.%s' % (genome_name, each_ext)])
+
+    if not os.path.isdir(pwd_annotation_entry):
+        pwd_annotation_entry_tmp = '%s_%s' % (pwd_annotation_entry, tmp_file_suffix)
+        os.mkdir(pwd_annotation_entry_tmp)
+        for pwd_file_from, entry_file in file_to_add_list:
+            link_or_copy(pwd_file_from, '%s/%s' % (pwd_annotation_entry_tmp, entry_file))
+        try:
+            os.rename(pwd_annotation_entry_tmp, pwd_annotation_entry)
+            return
+        except OSError:
+            shutil.rmtree(pwd_annotation_entry_tmp, ignore_errors=True)
+
+    # add files of a new genome name to an existing entry
+    for pwd_file_from, entry_file in file_to_add_list[1:]:
+        link_or_copy(pwd_file_from, '%s/%s.%s' % (pwd_annotation_entry, entry_file, tmp_file_suffix))
+        os.replace('%s/%s.%s' % (pwd_annotation_entry, entry_file, tmp_file_suffix), '%s/%s' % (pwd_annotation_entry, entry_file))
+    os.utime(pwd_annotation_entry)
+
+
+def evict_annotation_store(pwd_annotation_store, max_store_size_gb):
+
+    # remove least recently used entries until the store is no larger than max_store_size_gb, entries of current
+    # run are the most recently used, files linked into projects stay there
+    annotation_entry_list = []
+    store_size = 0
+    for annotation_key in os.listdir(pwd_annotation_store):
+        pwd_annotation_entry = '%s/%s' % (pwd_annotation_store, annotation_key)
+        if (not os.path.isdir(pwd_annotation_entry)) or ('_tmp' in annotation_key):
+            continue
+        entry_size = sum([os.path.getsize('%s/%s' % (pwd_annotation_entry, i)) for i in os.listdir(pwd_annotation_entry)])
+        annotation_entry_list.append([os.path.getmtime(pwd_annotation_entry), pwd_annotation_entry, entry_size])
+        store_size += entry_size
+
+    evicted_entry_num = 0
+    for last_used, pwd_annotation_entry, entry_size in sorted(annotation_entry_list):
+        if store_size <= max_store_size_gb * 1024 * 1024 * 1024:
+            break
+        shutil.rmtree(pwd_annotation_entry, ignore_errors=True)
+        store_size -= entry_size
+        evicted_entry_num += 1
+
+    return evicted_entry_num, store_size
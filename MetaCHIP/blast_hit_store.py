@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import glob
+import hashlib
+import shutil
+import numpy as np
+
+
+# Columnar store of all-vs-all blastn hits (outfmt: qseqid sseqid pident length mismatch gapopen qstart qend sstart
+# send evalue bitscore qlen slen). Gene and genome names are integer coded, every column is saved as a .npy file and
+# can be memory-mapped, rows are kept in the order of sorted blast result files.
+
+blast_hit_store_int_columns = ['align_len', 'qstart', 'qend', 'sstart', 'send', 'qlen', 'slen']
+blast_hit_store_row_columns = ['query', 'subject', 'identity'] + blast_hit_store_int_columns
+blast_hit_store_columns = blast_hit_store_row_columns + ['gene_names', 'gene_hash', 'gene_genome', 'genome_names', 'blast_file_genomes', 'blast_file_offsets']
+blast_hit_store_file_list = 'blast_files.txt'
+
+
+def get_blast_result_file_stat(pwd_blast_result_folder):
+
+    blast_result_file_re = '%s/*_blastn.tab' % pwd_blast_result_folder
+    blast_result_file_list = sorted([os.path.basename(file_name) for file_name in glob.glob(blast_result_file_re)])
+
+    blast_result_file_stat = []
+    for blast_result_file in blast_result_file_list:
+        file_stat = os.stat('%s/%s' % (pwd_blast_result_folder, blast_result_file))
+        blast_result_file_stat.append('%s\t%s\t%s' % (blast_result_file, file_stat.st_size, int(file_stat.st_mtime)))
+
+    return blast_result_file_stat
+
+
+def get_indexed_file_stat(pwd_blast_hit_store_folder):
+
+    # blast_files.txt is written at last, so an incomplete store has no indexed files
+    pwd_blast_hit_store_file_list = '%s/%s' % (pwd_blast_hit_store_folder, blast_hit_store_file_list)
+    if not os.path.isfile(pwd_blast_hit_store_file_list):
+        return None
+    for each_column in blast_hit_store_columns:
+        if not os.path.isfile('%s/%s.npy' % (pwd_blast_hit_store_folder, each_column)):
+            return None
+
+    return [each.strip() for each in open(pwd_blast_hit_store_file_list) if each.strip() != '']
+
+
+def blast_hit_store_is_current(pwd_blast_result_folder, pwd_blast_hit_store_folder):
+
+    return get_indexed_file_stat(pwd_blast_hit_store_folder) == get_blast_result_file_stat(pwd_blast_result_folder)
+
+
+def get_gene_name_hash(gene_name_list):
+
+    # 64-bit hash of gene names, rows can be fingerprinted with it regardless of the width of the gene_names column
+    return np.array([int.from_bytes(hashlib.blake2b(gene_name.encode(), digest_size=8).digest(), 'little', signed=True) for gene_name in gene_name_list], dtype=np.int64)
+
+
+def parse_blast_result_file(pwd_blast_result_file, gene_to_id_dict, start_position=0):
+
+    # parse blast hits from start_position (in bytes) to the end of file, new genes are added to gene_to_id_dict
+    query_id_list = []
+    subject_id_list = []
+    identity_list = []
+    int_column_dict = {each_column: [] for each_column in blast_hit_store_int_columns}
+    with open(pwd_blast_result_file) as blast_result_file_handle:
+        blast_result_file_handle.seek(start_position)
+        for match in blast_result_file_handle:
+            match_split = match.strip().split('\t')
+            if len(match_split) < 14:
+                continue
+            query = match_split[0]
+            subject = match_split[1]
+            if query not in gene_to_id_dict:
+                gene_to_id_dict[query] = len(gene_to_id_dict)
+            if subject not in gene_to_id_dict:
+                gene_to_id_dict[subject] = len(gene_to_id_dict)
+            query_id_list.append(gene_to_id_dict[query])
+            subject_id_list.append(gene_to_id_dict[subject])
+            identity_list.append(float(match_split[2]))
+            int_column_dict['align_len'].append(int(match_split[3]))
+            int_column_dict['qstart'].append(int(match_split[6]))
+            int_column_dict['qend'].append(int(match_split[7]))
+            int_column_dict['sstart'].append(int(match_split[8]))
+            int_column_dict['send'].append(int(match_split[9]))
+            int_column_dict['qlen'].append(int(match_split[12]))
+            int_column_dict['slen'].append(int(match_split[13]))
+
+    row_column_dict = {'query':    np.array(query_id_list, dtype=np.int64),
+                       'subject':  np.array(subject_id_list, dtype=np.int64),
+                       'identity': np.array(identity_list, dtype=np.float64)}
+    for each_column in blast_hit_store_int_columns:
+        row_column_dict[each_column] = np.array(int_column_dict[each_column], dtype=np.int32)
+
+    return row_column_dict
+
+
+def build_blast_hit_store(pwd_blast_result_folder, pwd_blast_hit_store_folder, appended_file_stat_dict=None):
+
+    # Rows of files indexed in the previous store are reused if file size and modification time did not change.
+    # appended_file_stat_dict: blast result files appended since they were indexed, file name -> stat before
+    # appending, only hits after the previous end of these files will be parsed.
+    blast_result_file_stat = get_blast_result_file_stat(pwd_blast_result_folder)
+    if appended_file_stat_dict is None:
+        appended_file_stat_dict = {}
+
+    previous_store = None
+    indexed_file_row_dict = {}
+    indexed_file_stat = get_indexed_file_stat(pwd_blast_hit_store_folder)
+    if indexed_file_stat is not None:
+        previous_store = load_blast_hit_store(pwd_blast_hit_store_folder)
+        previous_offsets = previous_store['blast_file_offsets']
+        for file_index, each_file_stat in enumerate(indexed_file_stat):
+            indexed_file_row_dict[each_file_stat] = [int(previous_offsets[file_index]), int(previous_offsets[file_index + 1])]
+
+    # gene ids are assigned in the order they were found (genes of the previous store keep their ids) and re-coded
+    # to sorted order at last
+    gene_to_id_dict = {}
+    if previous_store is not None:
+        gene_to_id_dict = {gene_name.decode(): gene_id for gene_id, gene_name in enumerate(previous_store['gene_names'])}
+
+    row_column_chunk_dict = {each_column: [] for each_column in blast_hit_store_row_columns}
+    blast_file_genome_list = []
+    blast_file_offset_list = [0]
+    parsed_file_num = 0
+    for each_file_stat in blast_result_file_stat:
+        blast_result_file = each_file_stat.split('\t')[0]
+        pwd_blast_result_file = '%s/%s' % (pwd_blast_result_folder, blast_result_file)
+        blast_file_genome_list.append(blast_result_file.split('_blastn')[0])
+
+        file_chunk_list = []
+        if each_file_stat in indexed_file_row_dict:
+            reused_stat = each_file_stat
+        else:
+            reused_stat = appended_file_stat_dict.get(blast_result_file)
+        if reused_stat in indexed_file_row_dict:
+            row_start, row_end = indexed_file_row_dict[reused_stat]
+            file_chunk_list.append({each_column: previous_store[each_column][row_start:row_end] for each_column in blast_hit_store_row_columns})
+        if reused_stat != each_file_stat:
+            start_position = int(reused_stat.split('\t')[1]) if reused_stat in indexed_file_row_dict else 0
+            file_chunk_list.append(parse_blast_result_file(pwd_blast_result_file, gene_to_id_dict, start_position))
+            parsed_file_num += 1
+
+        for file_chunk in file_chunk_list:
+            for each_column in blast_hit_store_row_columns:
+                row_column_chunk_dict[each_column].append(file_chunk[each_column])
+        blast_file_offset_list.append(blast_file_offset_list[-1] + sum([len(file_chunk['query']) for file_chunk in file_chunk_list]))
+
+    row_column_dict = {}
+    for each_column in blast_hit_store_row_columns:
+        column_dtype = np.float64 if each_column == 'identity' else np.int64 if each_column in ['query', 'subject'] else np.int32
+        row_column_dict[each_column] = np.concatenate(row_column_chunk_dict[each_column]).astype(column_dtype) if row_column_chunk_dict[each_column] else np.zeros(0, dtype=column_dtype)
+
+    # gene and genome tables of genes found in blast hits, in sorted order so that names can be looked up with
+    # np.searchsorted
+    gene_name_by_id = list(gene_to_id_dict)
+    used_gene_ids = np.unique(np.concatenate([row_column_dict['query'], row_column_dict['subject']]))
+    used_gene_name_list = [gene_name_by_id[gene_id] for gene_id in used_gene_ids]
+    used_gene_order = sorted(range(len(used_gene_name_list)), key=used_gene_name_list.__getitem__)
+    gene_name_list = [used_gene_name_list[i] for i in used_gene_order]
+    gene_id_recode = np.zeros(len(gene_name_by_id), dtype=np.int32)
+    gene_id_recode[used_gene_ids[used_gene_order]] = np.arange(len(gene_name_list), dtype=np.int32)
+
+    gene_genome_name_list = ['_'.join(gene_name.split('_')[:-1]) for gene_name in gene_name_list]
+    genome_name_list = sorted(set(gene_genome_name_list))
+    genome_to_id_dict = {genome_name: genome_id for genome_id, genome_name in enumerate(genome_name_list)}
+
+    column_dict = {'query':              gene_id_recode[row_column_dict['query']],
+                   'subject':            gene_id_recode[row_column_dict['subject']],
+                   'identity':           row_column_dict['identity'],
+                   'gene_names':         np.array([gene_name.encode() for gene_name in gene_name_list], dtype=bytes),
+                   'gene_hash':          get_gene_name_hash(gene_name_list),
+                   'gene_genome':        np.array([genome_to_id_dict[genome_name] for genome_name in gene_genome_name_list], dtype=np.int32),
+                   'genome_names':       np.array([genome_name.encode() for genome_name in genome_name_list], dtype=bytes),
+                   'blast_file_genomes': np.array([genome_name.encode() for genome_name in blast_file_genome_list], dtype=bytes),
+                   'blast_file_offsets': np.array(blast_file_offset_list, dtype=np.int64)}
+    for each_column in blast_hit_store_int_columns:
+        column_dict[each_column] = row_column_dict[each_column]
+
+    # write out store
+    previous_store = None
+    if os.path.isdir(pwd_blast_hit_store_folder):
+        shutil.rmtree(pwd_blast_hit_store_folder, ignore_errors=True)
+    os.mkdir(pwd_blast_hit_store_folder)
+    for each_column in blast_hit_store_columns:
+        np.save('%s/%s.npy' % (pwd_blast_hit_store_folder, each_column), column_dict[each_column])
+
+    with open('%s/%s' % (pwd_blast_hit_store_folder, blast_hit_store_file_list), 'w') as blast_hit_store_file_list_handle:
+        for each_file_stat in blast_result_file_stat:
+            blast_hit_store_file_list_handle.write('%s\n' % each_file_stat)
+
+    return parsed_file_num
+
+
+def get_row_fingerprint(blast_hit_store, row_start, row_end):
+
+    # fingerprint of blast hits between row_start and row_end, independent of the gene ids of the store
+    row_fingerprint = hashlib.sha1()
+    row_fingerprint.update(np.ascontiguousarray(blast_hit_store['gene_hash'][blast_hit_store['query'][row_start:row_end]]).tobytes())
+    row_fingerprint.update(np.ascontiguousarray(blast_hit_store['gene_hash'][blast_hit_store['subject'][row_start:row_end]]).tobytes())
+    for each_column in ['identity'] + blast_hit_store_int_columns:
+        row_fingerprint.update(np.ascontiguousarray(blast_hit_store[each_column][row_start:row_end]).tobytes())
+
+    return row_fingerprint.hexdigest()
+
+
+def load_blast_hit_store(pwd_blast_hit_store_folder, mmap_mode='r'):
+
+    blast_hit_store = {}
+    for each_column in blast_hit_store_columns:
+        blast_hit_store[each_column] = np.load('%s/%s.npy' % (pwd_blast_hit_store_folder, each_column), mmap_mode=mmap_mode)
+
+    return blast_hit_store
+
+
+def get_gene_id(blast_hit_store, gene_name_list):
+
+    # return the integer ids of provided genes, -1 for genes not in the store
+    gene_names = blast_hit_store['gene_names']
+    gene_name_array = np.array([gene_name.encode() for gene_name in gene_name_list], dtype=bytes)
+    if (len(gene_names) == 0) or (len(gene_name_array) == 0):
+        return np.full(len(gene_name_array), -1, dtype=np.int64)
+
+    gene_id_array = np.searchsorted(gene_names, gene_name_array)
+    gene_id_array[gene_id_array >= len(gene_names)] = 0
+    gene_id_array[gene_names[gene_id_array] != gene_name_array] = -1
+
+    return gene_id_array
+
+
+def get_genome_group_code(blast_hit_store, name_to_group_number_dict):
+
+    # group_list: sorted groups, genome_group_number_list: group number (e.g. A_1) of each genome in the store,
+    # genome_group_code: index of each genome's group in group_list, -1 for genomes not in the grouping file
+    group_list = sorted({name_to_group_number_dict[genome].split('_')[0] for genome in name_to_group_number_dict})
+    group_to_code_dict = {group: group_code for group_code, group in enumerate(group_list)}
+
+    genome_group_number_list = []
+    genome_group_code = np.full(len(blast_hit_store['genome_names']), -1, dtype=np.int32)
+    for genome_id, genome_name in enumerate(blast_hit_store['genome_names']):
+        genome_name = genome_name.decode()
+        genome_group_number = name_to_group_number_dict.get(genome_name, '')
+        genome_group_number_list.append(genome_group_number)
+        if genome_group_number != '':
+            genome_group_code[genome_id] = group_to_code_dict[genome_group_number.split('_')[0]]
+
+    return group_list, genome_group_number_list, genome_group_code
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+# Dated DTL (duplication, transfer and loss) reconciliation of a rooted binary gene tree with a dated (ultrametric)
+# species tree, an in-process alternative to Ranger-DTL-Dated with the same cost model:
+#   c(g, x):  min cost of gene subtree g with g mapped to species node x
+#   in(g, x): min cost of gene subtree g mapped to x or below x, one loss for each species node passed
+#   speciation at x:  in(g1, x1) + in(g2, x2)
+#   duplication at x: D + in(g1, x) + in(g2, x)
+#   transfer at x:    T + in(g1, x) + c(g2, y), y is not an ancestor or descendant of x and the branches above x
+#                     and y exist at the same time
+# Species tree nodes and branches (named after the node below them) are numbered in preorder, internal species/gene
+# tree nodes are named n1, n2, ... and m1, m2, ... as in Ranger-DTL outputs. Gene tree leaves must be named after
+# species tree leaves.
+
+
+def get_dated_species_tree(species_tree):
+
+    species_node_list = list(species_tree.traverse('preorder'))
+    node_to_id_dict = {node: node_id for node_id, node in enumerate(species_node_list)}
+    species_node_num = len(species_node_list)
+
+    species_node_name_list = []
+    left_child = np.full(species_node_num, -1, dtype=np.int64)
+    right_child = np.full(species_node_num, -1, dtype=np.int64)
+    node_parent = np.full(species_node_num, -1, dtype=np.int64)
+    node_time = np.zeros(species_node_num)
+    internal_node_num = 0
+    for node_id, node in enumerate(species_node_list):
+        if node.is_leaf():
+            species_node_name_list.append(node.name)
+        else:
+            if len(node.children) != 2:
+                raise ValueError('Species tree must be binary, please resolve polytomies first')
+            internal_node_num += 1
+            species_node_name_list.append('n%s' % internal_node_num)
+            left_child[node_id] = node_to_id_dict[node.children[0]]
+            right_child[node_id] = node_to_id_dict[node.children[1]]
+        if node_id > 0:
+            node_parent[node_id] = node_to_id_dict[node.up]
+            node_time[node_id] = node_time[node_parent[node_id]] + node.dist
+
+    # last node (in preorder) of each subtree and height (number of nodes to the farthest leaf) of each node
+    subtree_end = np.arange(species_node_num)
+    node_height = np.zeros(species_node_num, dtype=np.int64)
+    for node_id in range(species_node_num - 1, 0, -1):
+        subtree_end[node_parent[node_id]] = max(subtree_end[node_parent[node_id]], subtree_end[node_id])
+        node_height[node_parent[node_id]] = max(node_height[node_parent[node_id]], node_height[node_id] + 1)
+
+    # transfer from the branch above x (row) to the branch above y (column)
+    node_id_array = np.arange(species_node_num)
+    y_in_subtree_of_x = (node_id_array[np.newaxis, :] >= node_id_array[:, np.newaxis]) & (node_id_array[np.newaxis, :] <= subtree_end[:, np.newaxis])
+    parent_time = np.full(species_node_num, np.inf)
+    parent_time[1:] = node_time[node_parent[1:]]
+    branch_overlap = (parent_time[:, np.newaxis] < node_time[np.newaxis, :]) & (parent_time[np.newaxis, :] < node_time[:, np.newaxis])
+    transfer_allowed = branch_overlap & ~y_in_subtree_of_x & ~y_in_subtree_of_x.T
+
+    dated_species_tree = {'names':             species_node_name_list,
+                          'leaf_to_id':        {species_node_name_list[node_id]: node_id for node_id, node in enumerate(species_node_list) if node.is_leaf()},
+                          'left_child':        left_child,
+                          'right_child':       right_child,
+                          'internal_nodes':    np.nonzero(left_child >= 0)[0],
+                          'height_levels':     [np.nonzero(node_height == height)[0] for height in range(1, node_height.max() + 1)] if species_node_num > 1 else [],
+                          'transfer_allowed':  transfer_allowed}
+
+    return dated_species_tree
+
+
+def get_gene_tree_arrays(gene_tree, dated_species_tree):
+
+    gene_node_list = list(gene_tree.traverse('preorder'))
+    node_to_id_dict = {node: node_id for node_id, node in enumerate(gene_node_list)}
+
+    gene_node_name_list = []
+    gene_node_children = []
+    gene_leaf_species = []
+    for node_id, node in enumerate(gene_node_list):
+        if node.is_leaf():
+            if node.name not in dated_species_tree['leaf_to_id']:
+                raise ValueError('Gene tree leaf %s not found in species tree' % node.name)
+            gene_node_name_list.append(node.name)
+            gene_node_children.append([])
+            gene_leaf_species.append(dated_species_tree['leaf_to_id'][node.name])
+        else:
+            if len(node.children) != 2:
+                raise ValueError('Gene tree must be binary, please resolve polytomies first')
+            gene_node_name_list.append('m%s' % (node_id + 1))
+            gene_node_children.append([node_to_id_dict[child_node] for child_node in node.children])
+            gene_leaf_species.append(-1)
+
+    return gene_node_name_list, gene_node_children, gene_leaf_species
+
+
+def get_dtl_cost_tables(dated_species_tree, gene_node_children, gene_leaf_species, duplication_cost, transfer_cost, loss_cost):
+
+    left_child = dated_species_tree['left_child']
+    right_child = dated_species_tree['right_child']
+    internal_nodes = dated_species_tree['internal_nodes']
+    transfer_allowed = dated_species_tree['transfer_allowed']
+    species_node_num = len(left_child)
+
+    mapping_cost = np.full((len(gene_node_children), species_node_num), np.inf)
+    subtree_cost = np.full((len(gene_node_children), species_node_num), np.inf)
+    recipient_cost = np.full((len(gene_node_children), species_node_num), np.inf)
+    for gene_node_id in range(len(gene_node_children) - 1, -1, -1):
+
+        if len(gene_node_children[gene_node_id]) == 0:
+            mapping_cost[gene_node_id, gene_leaf_species[gene_node_id]] = 0
+        else:
+            child_1, child_2 = gene_node_children[gene_node_id]
+            speciation = np.full(species_node_num, np.inf)
+            speciation[internal_nodes] = np.minimum(subtree_cost[child_1, left_child[internal_nodes]] + subtree_cost[child_2, right_child[internal_nodes]],
+                                                    subtree_cost[child_2, left_child[internal_nodes]] + subtree_cost[child_1, right_child[internal_nodes]])
+            duplication = duplication_cost + subtree_cost[child_1] + subtree_cost[child_2]
+            transfer = transfer_cost + np.minimum(subtree_cost[child_1] + recipient_cost[child_2], subtree_cost[child_2] + recipient_cost[child_1])
+            mapping_cost[gene_node_id] = np.minimum(np.minimum(speciation, duplication), transfer)
+
+        # from the leaves up, in(g, x) = min(c(g, x), in(g, child of x) + loss)
+        subtree_cost[gene_node_id] = mapping_cost[gene_node_id]
+        for height_level in dated_species_tree['height_levels']:
+            subtree_cost[gene_node_id, height_level] = np.minimum(mapping_cost[gene_node_id, height_level],
+                                                                  np.minimum(subtree_cost[gene_node_id, left_child[height_level]], subtree_cost[gene_node_id, right_child[height_level]]) + loss_cost)
+
+        # min cost of receiving g by a transfer from the branch above each species node
+        if transfer_allowed.any():
+            recipient_cost[gene_node_id] = np.where(transfer_allowed, mapping_cost[gene_node_id][np.newaxis, :], np.inf).min(axis=1)
+
+    return mapping_cost, subtree_cost, recipient_cost
+
+
+def dated_dtl_reconciliation(dated_species_tree, gene_tree, duplication_cost=2, transfer_cost=3, loss_cost=1):
+
+    # returns the minimum reconciliation cost, the number of duplications, transfers and losses and events of one
+    # optimal reconciliation, in the form of [gene node, event, mapping, recipient] in gene tree postorder
+    species_node_name_list = dated_species_tree['names']
+    left_child = dated_species_tree['left_child']
+    right_child = dated_species_tree['right_child']
+    transfer_allowed = dated_species_tree['transfer_allowed']
+
+    gene_node_name_list, gene_node_children, gene_leaf_species = get_gene_tree_arrays(gene_tree, dated_species_tree)
+    mapping_cost, subtree_cost, recipient_cost = get_dtl_cost_tables(dated_species_tree, gene_node_children, gene_leaf_species, duplication_cost, transfer_cost, loss_cost)
+
+    # trace back one optimal reconciliation, speciation is preferred over duplication and duplication over transfer
+    event_dict = {}
+    event_num_dict = {'Duplication': 0, 'Transfer': 0, 'Loss': 0}
+    to_trace = [(0, int(np.argmin(mapping_cost[0])), True)]
+    while to_trace:
+        gene_node_id, species_node_id, is_mapped = to_trace.pop()
+
+        # go down in the species tree until g was mapped, each species node passed is a loss
+        while (not is_mapped) and mapping_cost[gene_node_id, species_node_id] != subtree_cost[gene_node_id, species_node_id]:
+            if subtree_cost[gene_node_id, left_child[species_node_id]] + loss_cost == subtree_cost[gene_node_id, species_node_id]:
+                species_node_id = left_child[species_node_id]
+            else:
+                species_node_id = right_child[species_node_id]
+            event_num_dict['Loss'] += 1
+
+        current_cost = mapping_cost[gene_node_id, species_node_id]
+        if len(gene_node_children[gene_node_id]) == 0:
+            event_dict[gene_node_id] = [gene_node_name_list[gene_node_id], 'Leaf Node', species_node_name_list[species_node_id], None]
+            continue
+
+        child_1, child_2 = gene_node_children[gene_node_id]
+        species_child_1, species_child_2 = left_child[species_node_id], right_child[species_node_id]
+        if (species_child_1 >= 0) and (subtree_cost[child_1, species_child_1] + subtree_cost[child_2, species_child_2] == current_cost):
+            event_dict[gene_node_id] = [gene_node_name_list[gene_node_id], 'Speciation', species_node_name_list[species_node_id], None]
+            to_trace.extend([(child_1, species_child_1, False), (child_2, species_child_2, False)])
+        elif (species_child_1 >= 0) and (subtree_cost[child_2, species_child_1] + subtree_cost[child_1, species_child_2] == current_cost):
+            event_dict[gene_node_id] = [gene_node_name_list[gene_node_id], 'Speciation', species_node_name_list[species_node_id], None]
+            to_trace.extend([(child_1, species_child_2, False), (child_2, species_child_1, False)])
+        elif duplication_cost + subtree_cost[child_1, species_node_id] + subtree_cost[child_2, species_node_id] == current_cost:
+            event_dict[gene_node_id] = [gene_node_name_list[gene_node_id], 'Duplication', species_node_name_list[species_node_id], None]
+            event_num_dict['Duplication'] += 1
+            to_trace.extend([(child_1, species_node_id, False), (child_2, species_node_id, False)])
+        else:
+            if transfer_cost + subtree_cost[child_1, species_node_id] + recipient_cost[child_2, species_node_id] == current_cost:
+                donor_child, recipient_child = child_1, child_2
+            else:
+                donor_child, recipient_child = child_2, child_1
+            recipient_species_node_id = int(np.nonzero(transfer_allowed[species_node_id] & (mapping_cost[recipient_child] == recipient_cost[recipient_child, species_node_id]))[0][0])
+            event_dict[gene_node_id] = [gene_node_name_list[gene_node_id], 'Transfer', species_node_name_list[species_node_id], species_node_name_list[recipient_species_node_id]]
+            event_num_dict['Transfer'] += 1
+            to_trace.extend([(donor_child, species_node_id, False), (recipient_child, recipient_species_node_id, True)])
+
+    # events in gene tree postorder
+    event_list = []
+    to_visit = [(0, False)]
+    while to_visit:
+        gene_node_id, children_visited = to_visit.pop()
+        if children_visited or (len(gene_node_children[gene_node_id]) == 0):
+            event_list.append(event_dict[gene_node_id])
+        else:
+            to_visit.append((gene_node_id, True))
+            to_visit.extend([(child_node_id, False) for child_node_id in reversed(gene_node_children[gene_node_id])])
+
+    reconciliation = {'cost':         int(mapping_cost[0].min()),
+                      'duplications': event_num_dict['Duplication'],
+                      'transfers':    event_num_dict['Transfer'],
+                      'losses':       event_num_dict['Loss'],
+                      'events':       event_list}
+
+    return reconciliation
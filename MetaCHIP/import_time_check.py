@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+
+
+# Startup regression check. Modules are imported in a fresh interpreter with "python -X importtime", the cumulative
+# import time is compared with a fixed budget and the run fails if the budget is exceeded or if one of the slow
+# packages, which should only be imported by the steps that use them, is loaded at import time.
+
+default_module_list = ['MetaCHIP.PI', 'MetaCHIP.BM_PG']
+deferred_package_list = ['matplotlib', 'scipy', 'ete3', 'reportlab', 'Bio.Graphics']
+
+
+def parse_importtime_output(importtime_output):
+
+    # lines look like: "import time:  self [us] | cumulative | imported package", nested imports are indented
+    import_time_list = []
+    for each_line in importtime_output.split('\n'):
+        if not each_line.startswith('import time:'):
+            continue
+        each_line_split = each_line[len('import time:'):].split('|')
+        if len(each_line_split) != 3 or not each_line_split[0].strip().isdigit():
+            continue
+        package_name = each_line_split[2].rstrip()
+        import_time_list.append({'package':    package_name.strip(),
+                                 'depth':      (len(package_name) - len(package_name.lstrip()) - 1) // 2,
+                                 'self_ms':    int(each_line_split[0]) / 1000,
+                                 'cumulative_ms': int(each_line_split[1]) / 1000})
+
+    return import_time_list
+
+
+def get_import_time(cmd_list):
+
+    # run in a fresh interpreter, the importtime report goes to stderr
+    cmd_out = subprocess.run([sys.executable, '-X', 'importtime'] + cmd_list, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    import_time_list = parse_importtime_output(cmd_out.stderr)
+
+    total_ms = sum([i['cumulative_ms'] for i in import_time_list if i['depth'] == 0])
+    loaded_package_set = {i['package'] for i in import_time_list}
+    deferred_loaded = [i for i in deferred_package_list if i in loaded_package_set]
+    slowest_imports = sorted([i for i in import_time_list if i['depth'] == 0], key=lambda x: x['cumulative_ms'], reverse=True)[:5]
+
+    return total_ms, deferred_loaded, slowest_imports
+
+
+def import_time_check(args):
+
+    module_list = [i.strip() for i in args['m'].split(',') if i.strip() != '']
+    budget_ms = args['budget']
+    repeat = args['repeat']
+
+    # targets to check, the first run also compiles .pyc files, so the fastest of -repeat runs is used
+    target_list = [[each_module, ['-c', 'import %s' % each_module]] for each_module in module_list]
+    pwd_MetaCHIP_exe = shutil.which(args['exe']) if args['exe'] is not None else None
+    if pwd_MetaCHIP_exe is not None:
+        target_list.append(['%s -h' % args['exe'], [pwd_MetaCHIP_exe, '-h']])
+    elif args['exe'] is not None:
+        print('%s not found, skipped command line startup check' % args['exe'])
+
+    report_list = []
+    for target_name, cmd_list in target_list:
+        best_total_ms = None
+        deferred_loaded = []
+        slowest_imports = []
+        for run_index in range(repeat):
+            total_ms, deferred_loaded, slowest_imports = get_import_time(cmd_list)
+            if (best_total_ms is None) or (total_ms < best_total_ms):
+                best_total_ms = total_ms
+
+        status = 'ok'
+        if best_total_ms > budget_ms:
+            status = 'OVER_BUDGET'
+        if len(deferred_loaded) > 0:
+            status = 'EAGER_IMPORT'
+
+        report_list.append({'target':          target_name,
+                            'import_time_ms':  round(best_total_ms, 1),
+                            'budget_ms':       budget_ms,
+                            'deferred_loaded': deferred_loaded,
+                            'slowest_imports': [[i['package'], round(i['cumulative_ms'], 1)] for i in slowest_imports],
+                            'status':          status})
+
+    # report
+    print('%-30s %15s %10s %14s' % ('Target', 'Import_time(ms)', 'Budget(ms)', 'Status'))
+    for each_report in report_list:
+        print('%-30s %15.1f %10s %14s' % (each_report['target'], each_report['import_time_ms'], each_report['budget_ms'], each_report['status']))
+        if len(each_report['deferred_loaded']) > 0:
+            print('    imported at startup: %s' % ','.join(each_report['deferred_loaded']))
+        if each_report['status'] != 'ok':
+            print('    slowest imports: %s' % ', '.join(['%s (%s ms)' % (i[0], i[1]) for i in each_report['slowest_imports']]))
+
+    if args['o'] is not None:
+        with open(args['o'], 'w') as report_handle:
+            json.dump({'python': sys.version.split()[0], 'targets': report_list}, report_handle, indent=2)
+
+    return report_list
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m',      required=False, default=','.join(default_module_list), help='modules to import, separated by comma, default: %s' % ','.join(default_module_list))
+    parser.add_argument('-exe',    required=False, default=None, help='also check the startup of this MetaCHIP executable with -h')
+    parser.add_argument('-budget', required=False, type=float, default=800, help='import time budget in milliseconds, default: 800')
+    parser.add_argument('-repeat', required=False, type=int, default=3, help='number of runs, the fastest is used, default: 3')
+    parser.add_argument('-o',      required=False, default=None, help='write report in json format')
+    args = vars(parser.parse_args())
+
+    report_list = import_time_check(args)
+
+    # exit with 1 if any target is over budget or imports a deferred package
+    if len([i for i in report_list if i['status'] != 'ok']) > 0:
+        sys.exit(1)
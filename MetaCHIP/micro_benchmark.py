@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.Alphabet import generic_dna
+from Bio.SeqRecord import SeqRecord
+from Bio.SeqFeature import SeqFeature, FeatureLocation
+from MetaCHIP.PI import prodigal_parser, convert_hmmalign_output
+from MetaCHIP.msa_column_filter import remove_low_cov_and_consensus_columns, get_supermatrix_array
+from MetaCHIP.blast_hit_store import build_blast_hit_store, load_blast_hit_store, get_genome_group_code
+from MetaCHIP.BM_PG import get_qualigied_blast_hits, get_query_subjects, get_best_match_donor, check_full_lenght_and_end_match
+from MetaCHIP.BM_PG import remove_bidirection, get_genome_annotation_index, get_flanking_region, combine_PG_output
+
+
+# Micro-benchmarks of the pure Python hot spots of MetaCHIP. Each fixture function writes (into a temporary folder)
+# realistic input of a size proportional to -scale and returns the function to time, its arguments and the number
+# of units (genes, hits, columns or pairs) processed per call. Fixtures only depend on seed and scale, so throughput
+# of different versions can be compared with a baseline saved by -save_baseline.
+
+micro_benchmark_report_version = 1
+
+
+def get_random_dna(seq_len, random_state):
+
+    return np.array(list(b'ACGT'), dtype=np.uint8)[random_state.randint(0, 4, size=seq_len)].tobytes().decode()
+
+
+def get_prodigal_parser_fixture(fixture_folder, scale, random_state):
+
+    # contigs and a prodigal .sco file with 25 genes per contig
+    contig_num = int(200 * scale)
+    pwd_seq_file = '%s/prodigal_input.fasta' % fixture_folder
+    pwd_sco_file = '%s/prodigal_input.sco' % fixture_folder
+    pwd_output_folder = '%s/prodigal_output' % fixture_folder
+    os.mkdir(pwd_output_folder)
+
+    gene_num = 0
+    seq_file_handle = open(pwd_seq_file, 'w')
+    sco_file_handle = open(pwd_sco_file, 'w')
+    for contig_index in range(contig_num):
+        contig_id = 'contig_%s' % (contig_index + 1)
+        gene_len_list = random_state.randint(100, 500, size=25) * 3
+        spacer_len_list = random_state.randint(20, 200, size=26)
+        contig_seq = get_random_dna(int(gene_len_list.sum() + spacer_len_list.sum()), random_state)
+        seq_file_handle.write('>%s\n%s\n' % (contig_id, contig_seq))
+        sco_file_handle.write('# Sequence Data: seqnum=%s;seqlen=%s;seqhdr="%s"\n' % (contig_index + 1, len(contig_seq), contig_id))
+        sco_file_handle.write('# Model Data: version=Prodigal.v2.6.3;run_type=Metagenomic;model="39|Sulfolobus_acidocaldarius_DSM_639|A|36.7|11|1";gc_cont=36.70;transl_table=11;uses_sd=1\n')
+        gene_end = 0
+        for gene_index, gene_len in enumerate(gene_len_list):
+            gene_start = gene_end + spacer_len_list[gene_index] + 1
+            gene_end = gene_start + gene_len - 1
+            sco_file_handle.write('>%s_%s_%s_%s\n' % (gene_index + 1, gene_start, gene_end, '+-'[random_state.randint(2)]))
+            gene_num += 1
+    seq_file_handle.close()
+    sco_file_handle.close()
+
+    return prodigal_parser, [pwd_seq_file, pwd_sco_file, 'genome', pwd_output_folder], gene_num, 'genes'
+
+
+def get_convert_hmmalign_output_fixture(fixture_folder, scale, random_state):
+
+    # hmmalign PSIBLAST format, 200 sequences in blocks of 80 columns
+    seq_num = 200
+    alignment_len = int(3000 * scale)
+    pwd_align_in = '%s/hmmalign_output.txt' % fixture_folder
+    pwd_align_out = '%s/hmmalign_output.fasta' % fixture_folder
+
+    alignment_array = np.array(list(b'ACDEFGHIKLMNPQRSTVWY-'), dtype=np.uint8)[random_state.randint(0, 21, size=(seq_num, alignment_len))]
+    align_in_handle = open(pwd_align_in, 'w')
+    for block_start in range(0, alignment_len, 80):
+        for seq_index in range(seq_num):
+            align_in_handle.write('%-40s %s\n' % ('genome_%s' % (seq_index + 1), alignment_array[seq_index, block_start:block_start + 80].tobytes().decode()))
+        align_in_handle.write('\n')
+    align_in_handle.close()
+
+    return convert_hmmalign_output, [pwd_align_in, pwd_align_out], alignment_len, 'columns'
+
+
+def get_supermatrix_array_fixture(fixture_folder, scale, random_state):
+
+    # 43 marker alignments of 500 genomes, each genome misses 10% of the markers
+    seq_num = 500
+    marker_num = 43
+    genome_list = ['genome_%s' % (seq_index + 1) for seq_index in range(seq_num)]
+    residue_array = np.array(list(b'ACDEFGHIKLMNPQRSTVWY-'), dtype=np.uint8)
+    alignment_file_list = []
+    alignment_len = 0
+    for marker_index in range(marker_num):
+        marker_len = int(random_state.randint(100, 600) * scale) + 1
+        marker_array = residue_array[random_state.randint(0, 21, size=(seq_num, marker_len))]
+        pwd_alignment_file = '%s/marker_%s_aligned.fasta' % (fixture_folder, marker_index)
+        with open(pwd_alignment_file, 'w') as alignment_file_handle:
+            for seq_index in np.flatnonzero(random_state.random_sample(seq_num) >= 0.1):
+                alignment_file_handle.write('>%s\n%s\n' % (genome_list[seq_index], marker_array[seq_index].tobytes().decode()))
+        alignment_file_list.append(pwd_alignment_file)
+        alignment_len += marker_len
+
+    return get_supermatrix_array, [alignment_file_list, genome_list], alignment_len, 'columns'
+
+
+def get_remove_low_cov_and_consensus_columns_fixture(fixture_folder, scale, random_state):
+
+    # concatenated SCG alignment of 200 genomes, columns differ in gap percent and conservation
+    seq_num = 200
+    alignment_len = int(20000 * scale)
+    pwd_alignment_in = '%s/species_tree_tmp.aln' % fixture_folder
+    pwd_alignment_out = '%s/species_tree.aln' % fixture_folder
+
+    residue_array = np.array(list(b'ACDEFGHIKLMNPQRSTVWY'), dtype=np.uint8)
+    column_consensus = residue_array[random_state.randint(0, 20, size=alignment_len)]
+    alignment_array = np.tile(column_consensus, (seq_num, 1))
+    substituted = random_state.random_sample((seq_num, alignment_len)) < random_state.random_sample(alignment_len) * 0.8
+    alignment_array[substituted] = residue_array[random_state.randint(0, 20, size=int(substituted.sum()))]
+    alignment_array[random_state.random_sample((seq_num, alignment_len)) < random_state.random_sample(alignment_len) * 0.6] = ord('-')
+    with open(pwd_alignment_in, 'w') as alignment_in_handle:
+        for seq_index in range(seq_num):
+            alignment_in_handle.write('>genome_%s\n%s\n' % (seq_index + 1, alignment_array[seq_index].tobytes().decode()))
+
+    return remove_low_cov_and_consensus_columns, [pwd_alignment_in, 50, 25, pwd_alignment_out], alignment_len, 'columns'
+
+
+def get_blast_hit_store_fixture(fixture_folder, scale, random_state):
+
+    # all-vs-all blastn results of 20 genomes in 4 groups, 300 genes per genome and 40 hits per query gene
+    genome_num = 20
+    gene_num = int(300 * scale)
+    pwd_blast_result_folder = '%s/blastn_results' % fixture_folder
+    pwd_blast_hit_store_folder = '%s/blastn_results_store' % fixture_folder
+    os.mkdir(pwd_blast_result_folder)
+
+    gene_len = random_state.randint(300, 1500, size=(genome_num, gene_num))
+    for genome_index in range(genome_num):
+        blast_result_handle = open('%s/genome%s_blastn.tab' % (pwd_blast_result_folder, genome_index + 1), 'w')
+        for gene_index in range(gene_num):
+            query = 'genome%s_%s' % (genome_index + 1, '{:0>5}'.format(gene_index + 1))
+            for subject_genome_index in random_state.choice(genome_num, size=40):
+                subject_gene_index = random_state.randint(gene_num) if subject_genome_index != genome_index else gene_index
+                subject = 'genome%s_%s' % (subject_genome_index + 1, '{:0>5}'.format(subject_gene_index + 1))
+                query_len = gene_len[genome_index, gene_index]
+                subject_len = gene_len[subject_genome_index, subject_gene_index]
+                align_len = random_state.randint(50, min(query_len, subject_len) + 1)
+                identity = 100.0 if subject == query else round(random_state.uniform(70, 100), 3)
+                blast_result_handle.write('%s\t%s\t%s\t%s\t0\t0\t1\t%s\t1\t%s\t1e-50\t500\t%s\t%s\n' % (query, subject, identity, align_len, align_len, align_len, query_len, subject_len))
+        blast_result_handle.close()
+
+    build_blast_hit_store(pwd_blast_result_folder, pwd_blast_hit_store_folder)
+
+    return load_blast_hit_store(pwd_blast_hit_store_folder)
+
+
+def get_blast_hit_store_group_code(blast_hit_store):
+
+    name_to_group_number_dict = {}
+    for genome_index, genome_name in enumerate(blast_hit_store['genome_names']):
+        name_to_group_number_dict[genome_name.decode()] = '%s_%s' % ('ABCD'[genome_index % 4], genome_index // 4 + 1)
+
+    return get_genome_group_code(blast_hit_store, name_to_group_number_dict)
+
+
+def get_qualigied_blast_hits_fixture(fixture_folder, scale, random_state):
+
+    blast_hit_store = get_blast_hit_store_fixture(fixture_folder, scale, random_state)
+    _, _, genome_group_code = get_blast_hit_store_group_code(blast_hit_store)
+
+    return get_qualigied_blast_hits, [blast_hit_store, 0, len(blast_hit_store['query']), 200, 75, genome_group_code], len(blast_hit_store['query']), 'hits'
+
+
+def run_best_match(blast_hit_store, qualified_rows, genome_group_number_list):
+
+    # the best-match step of BM_stream_worker
+    best_match_list = []
+    for query_with_group, subjects_list in get_query_subjects(blast_hit_store, qualified_rows, genome_group_number_list):
+        donor = get_best_match_donor(query_with_group, subjects_list)
+        if donor is not None:
+            best_match_list.append([query_with_group, donor])
+
+    return best_match_list
+
+
+def get_best_match_donor_fixture(fixture_folder, scale, random_state):
+
+    blast_hit_store = get_blast_hit_store_fixture(fixture_folder, scale, random_state)
+    _, genome_group_number_list, genome_group_code = get_blast_hit_store_group_code(blast_hit_store)
+    qualified_rows = get_qualigied_blast_hits(blast_hit_store, 0, len(blast_hit_store['query']), 200, 75, genome_group_code)
+
+    return run_best_match, [blast_hit_store, qualified_rows, genome_group_number_list], len(qualified_rows), 'hits'
+
+
+def run_check_full_lenght_and_end_match(qualified_ctg_match_list_list, identity_cutoff):
+
+    return [check_full_lenght_and_end_match(qualified_ctg_match_list, identity_cutoff) for qualified_ctg_match_list in qualified_ctg_match_list_list]
+
+
+def get_check_full_lenght_and_end_match_fixture(fixture_folder, scale, random_state):
+
+    # blastn hits (outfmt 6 with qlen and slen) between the contigs of 2000 candidate pairs, best hit first
+    qualified_ctg_match_list_list = []
+    hit_num = 0
+    for _ in range(int(2000 * scale)):
+        query_len = random_state.randint(5000, 200000)
+        subject_len = random_state.randint(5000, 200000)
+        ctg_match_list = []
+        for _ in range(random_state.randint(1, 21)):
+            align_len = random_state.randint(100, 3000)
+            query_start = random_state.randint(1, query_len - align_len)
+            subject_start = random_state.randint(1, subject_len - align_len)
+            if random_state.randint(2) == 0:
+                subject_start, subject_end = subject_start, subject_start + align_len - 1
+            else:
+                subject_start, subject_end = subject_start + align_len - 1, subject_start
+            identity = round(random_state.uniform(85, 100), 3)
+            ctg_match_list.append(['ctg_1', 'ctg_2', str(identity), str(align_len), '0', '0', str(query_start), str(query_start + align_len - 1),
+                                   str(subject_start), str(subject_end), '0.0', str(align_len * 2), str(query_len), str(subject_len)])
+        ctg_match_list.sort(key=lambda x: float(x[11]), reverse=True)
+        qualified_ctg_match_list_list.append(ctg_match_list)
+        hit_num += len(ctg_match_list)
+
+    return run_check_full_lenght_and_end_match, [qualified_ctg_match_list_list, 90], hit_num, 'hits'
+
+
+def get_remove_bidirection_fixture(fixture_folder, scale, random_state):
+
+    # BM candidate pairs, 20% of them were also found in reverse direction
+    pair_num = int(3000 * scale)
+    pwd_input_file = '%s/candidates_only_gene.txt' % fixture_folder
+    pwd_output_file = '%s/candidates_only_gene_uniq.txt' % fixture_folder
+
+    pair_list = []
+    for pair_index in range(pair_num):
+        pair_list.append(['genome%s_%s' % (random_state.randint(100), '{:0>5}'.format(pair_index + 1)), 'genome%s_%s' % (random_state.randint(100), '{:0>5}'.format(pair_index + 1))])
+    for pair_index in random_state.choice(pair_num, size=pair_num // 5, replace=False):
+        pair_list.append(pair_list[pair_index][::-1])
+    pair_list = [pair_list[i] for i in random_state.permutation(len(pair_list))]
+
+    candidate2identity_dict = {}
+    with open(pwd_input_file, 'w') as input_file_handle:
+        for gene_1, gene_2 in pair_list:
+            input_file_handle.write('%s\t%s\n' % (gene_1, gene_2))
+            candidate2identity_dict['%s___%s' % (gene_1, gene_2)] = round(random_state.uniform(90, 100), 3)
+
+    return remove_bidirection, [pwd_input_file, candidate2identity_dict, pwd_output_file], len(pair_list), 'pairs'
+
+
+def run_get_flanking_region(pwd_gbk_file, HGT_candidate_list, flanking_length):
+
+    genome_annotation_index = get_genome_annotation_index(pwd_gbk_file)
+
+    return [get_flanking_region(genome_annotation_index, HGT_candidate, flanking_length) for HGT_candidate in HGT_candidate_list]
+
+
+def get_get_flanking_region_fixture(fixture_folder, scale, random_state):
+
+    # 40 contigs of 50 Kbp with a gene every ~1 Kbp, flanking regions of 500 candidates are extracted
+    pwd_gbk_file = '%s/genome.gbk' % fixture_folder
+    contig_record_list = []
+    locus_tag_list = []
+    for contig_index in range(int(40 * scale)):
+        contig_record = SeqRecord(Seq(get_random_dna(50000, random_state), generic_dna), id='contig_%s' % (contig_index + 1))
+        gene_end = 0
+        while gene_end < 48500:
+            gene_start = gene_end + random_state.randint(20, 200)
+            gene_end = gene_start + random_state.randint(100, 500) * 3
+            locus_tag = 'genome_%s' % '{:0>5}'.format(len(locus_tag_list) + 1)
+            contig_record.features.append(SeqFeature(FeatureLocation(gene_start, gene_end, strand=[1, -1][random_state.randint(2)]), type='CDS', qualifiers={'locus_tag': [locus_tag], 'transl_table': [11]}))
+            locus_tag_list.append(locus_tag)
+        contig_record_list.append(contig_record)
+    SeqIO.write(contig_record_list, pwd_gbk_file, 'genbank')
+
+    # the annotation index is built once per genome in BM, so it is not timed
+    get_genome_annotation_index(pwd_gbk_file)
+    HGT_candidate_list = [locus_tag_list[i] for i in random_state.choice(len(locus_tag_list), size=500)]
+
+    return run_get_flanking_region, [pwd_gbk_file, HGT_candidate_list, 10000], len(HGT_candidate_list), 'genes'
+
+
+def get_combine_PG_output_fixture(fixture_folder, scale, random_state):
+
+    # PG outputs of three ranks, 5000 HGTs per rank, half of them were detected at all ranks
+    HGT_num = int(5000 * scale)
+    shared_HGT_list = [['genome%s_%s' % (random_state.randint(100), '{:0>5}'.format(i + 1)), 'genome%s_%s' % (random_state.randint(100), '{:0>5}'.format(i + 1))] for i in range(HGT_num // 2)]
+    PG_output_file_list = []
+    record_num = 0
+    for detection_rank in ['p', 'c', 'o']:
+        pwd_PG_output_file = '%s/bench_%s10_HGTs_PG.txt' % (fixture_folder, detection_rank)
+        rank_HGT_list = shared_HGT_list + [['genome%s_%s%s' % (random_state.randint(100), detection_rank, i), 'genome%s_%s%s' % (random_state.randint(100), detection_rank, i)] for i in range(HGT_num - len(shared_HGT_list))]
+        with open(pwd_PG_output_file, 'w') as PG_output_handle:
+            PG_output_handle.write('Gene_1\tGene_2\tGene_1_group\tGene_2_group\tIdentity\tend_match\tfull_length_match\tDirection\n')
+            for gene_1, gene_2 in rank_HGT_list:
+                direction = ['%s-->%s' % (gene_1.split('_')[0], gene_2.split('_')[0]), '%s-->%s' % (gene_2.split('_')[0], gene_1.split('_')[0]), 'NA'][random_state.randint(3)]
+                PG_output_handle.write('%s\t%s\tA_1\tB_1\t%s\tno\tno\t%s\n' % (gene_1, gene_2, round(random_state.uniform(90, 100), 3), direction))
+        PG_output_file_list.append(pwd_PG_output_file)
+        record_num += len(rank_HGT_list)
+
+    return combine_PG_output, [PG_output_file_list, 'bench', 'pco', '%s/bench_pco_detected_HGTs.txt' % fixture_folder], record_num, 'hits'
+
+
+micro_benchmark_list = [['prodigal_parser',                     get_prodigal_parser_fixture],
+                        ['convert_hmmalign_output',             get_convert_hmmalign_output_fixture],
+                        ['get_supermatrix_array',               get_supermatrix_array_fixture],
+                        ['remove_low_cov_and_consensus_columns', get_remove_low_cov_and_consensus_columns_fixture],
+                        ['get_qualigied_blast_hits',            get_qualigied_blast_hits_fixture],
+                        ['get_best_match_donor',                get_best_match_donor_fixture],
+                        ['check_full_lenght_and_end_match',     get_check_full_lenght_and_end_match_fixture],
+                        ['remove_bidirection',                  get_remove_bidirection_fixture],
+                        ['get_flanking_region',                 get_get_flanking_region_fixture],
+                        ['combine_PG_output',                   get_combine_PG_output_fixture]]
+
+
+def run_micro_benchmark(benchmark_name, fixture_function, scale, seed, repeat):
+
+    fixture_folder = tempfile.mkdtemp(prefix='MetaCHIP_micro_benchmark_')
+    try:
+        timed_function, argument_list, unit_num, unit_name = fixture_function(fixture_folder, scale, np.random.RandomState(seed))
+        time_list = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            timed_function(*argument_list)
+            time_list.append(time.perf_counter() - start_time)
+    finally:
+        shutil.rmtree(fixture_folder, ignore_errors=True)
+
+    # throughput of the fastest run, the least disturbed by other processes
+    return {'benchmark':  benchmark_name,
+            'units':      unit_num,
+            'unit':       unit_name,
+            'time_best':  round(min(time_list), 6),
+            'time_median': round(float(np.median(time_list)), 6),
+            'throughput': round(unit_num / min(time_list), 1) if min(time_list) > 0 else None}
+
+
+def compare_with_baseline(micro_benchmark_report, baseline_report, tolerance):
+
+    # a benchmark is flagged if its throughput dropped by more than tolerance (fraction) compared to the baseline
+    baseline_result_dict = {}
+    if (baseline_report['scale'] == micro_benchmark_report['scale']) and (baseline_report['seed'] == micro_benchmark_report['seed']):
+        baseline_result_dict = {each_result['benchmark']: each_result for each_result in baseline_report['results']}
+
+    regression_list = []
+    for each_result in micro_benchmark_report['results']:
+        baseline_result = baseline_result_dict.get(each_result['benchmark'])
+        if (baseline_result is None) or (baseline_result['units'] != each_result['units']) or (not baseline_result['throughput']) or (not each_result['throughput']):
+            each_result['baseline_ratio'] = None
+            each_result['status'] = 'no baseline'
+            continue
+        each_result['baseline_ratio'] = round(each_result['throughput'] / baseline_result['throughput'], 3)
+        if each_result['baseline_ratio'] < 1 - tolerance:
+            each_result['status'] = 'SLOWER'
+            regression_list.append(each_result['benchmark'])
+        else:
+            each_result['status'] = 'ok'
+
+    return regression_list
+
+
+def micro_benchmark(args):
+
+    scale =                 args['scale']
+    seed =                  args['seed']
+    repeat =                args['repeat']
+    benchmark_str =         args['b']
+    pwd_report_file =       args['o']
+    pwd_baseline_file =     args['baseline']
+    pwd_save_baseline =     args['save_baseline']
+    tolerance =             args['tolerance']
+
+    benchmark_name_list = [each_benchmark[0] for each_benchmark in micro_benchmark_list]
+    if benchmark_str is not None:
+        selected_benchmark_list = benchmark_str.split(',')
+        unknown_benchmark_list = [i for i in selected_benchmark_list if i not in benchmark_name_list]
+        if len(unknown_benchmark_list) > 0:
+            print('Unknown benchmark(s): %s, choose from: %s' % (','.join(unknown_benchmark_list), ','.join(benchmark_name_list)))
+            exit()
+    else:
+        selected_benchmark_list = benchmark_name_list
+
+    micro_benchmark_report = {'report_version': micro_benchmark_report_version,
+                              'scale':          scale,
+                              'seed':           seed,
+                              'repeat':         repeat,
+                              'host':           {'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__},
+                              'results':        []}
+
+    for benchmark_name, fixture_function in micro_benchmark_list:
+        if benchmark_name in selected_benchmark_list:
+            micro_benchmark_report['results'].append(run_micro_benchmark(benchmark_name, fixture_function, scale, seed, repeat))
+
+    regression_list = []
+    if pwd_baseline_file is not None:
+        regression_list = compare_with_baseline(micro_benchmark_report, json.load(open(pwd_baseline_file)), tolerance)
+
+    # report
+    print('%-38s %10s %8s %12s %16s %10s %12s' % ('Benchmark', 'Units', 'Unit', 'Best_time(s)', 'Throughput(/s)', 'Baseline', 'Status'))
+    for each_result in micro_benchmark_report['results']:
+        print('%-38s %10s %8s %12.4f %16s %10s %12s' % (each_result['benchmark'], each_result['units'], each_result['unit'], each_result['time_best'], each_result['throughput'],
+                                                         each_result.get('baseline_ratio', ''), each_result.get('status', '')))
+
+    if pwd_report_file is not None:
+        with open(pwd_report_file, 'w') as report_file_handle:
+            json.dump(micro_benchmark_report, report_file_handle, indent=1)
+
+    if pwd_save_baseline is not None:
+        with open(pwd_save_baseline, 'w') as baseline_file_handle:
+            json.dump(micro_benchmark_report, baseline_file_handle, indent=1)
+
+    if len(regression_list) > 0:
+        print('Throughput dropped by more than %s%% for: %s' % (int(tolerance * 100), ','.join(regression_list)))
+
+    return regression_list
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-b',             required=False, default=None,                 help='comma separated benchmarks to run, default: all')
+    parser.add_argument('-scale',         required=False, type=float, default=1,        help='fixture size multiplier, default: 1')
+    parser.add_argument('-seed',          required=False, type=int,   default=1,        help='random seed for fixtures, default: 1')
+    parser.add_argument('-repeat',        required=False, type=int,   default=3,        help='number of timed runs per benchmark, default: 3')
+    parser.add_argument('-o',             required=False, default=None,                 help='write report (json) to this file')
+    parser.add_argument('-baseline',      required=False, default=None,                 help='baseline report (json) to compare with')
+    parser.add_argument('-save_baseline', required=False, default=None,                 help='save report as baseline to this file')
+    parser.add_argument('-tolerance',     required=False, type=float, default=0.2,      help='allowed throughput drop compared to baseline, default: 0.2')
+
+    args = vars(parser.parse_args())
+    if len(micro_benchmark(args)) > 0:
+        sys.exit(1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from Bio import SeqIO
+
+
+def read_msa_to_array(alignment_file_in):
+
+    # read in alignment (fasta format) as a 2-D uint8 array, one row per sequence
+    seq_id_list = []
+    seq_list = []
+    for each_seq in SeqIO.parse(alignment_file_in, 'fasta'):
+        seq_id_list.append(each_seq.id)
+        seq_list.append(str(each_seq.seq).encode())
+
+    if len(seq_list) == 0:
+        raise ValueError('No sequences found in %s' % alignment_file_in)
+
+    alignment_length = len(seq_list[0])
+    for each_seq in seq_list:
+        if len(each_seq) != alignment_length:
+            raise ValueError('Sequences must all be the same length: %s' % alignment_file_in)
+
+    msa_array = np.frombuffer(b''.join(seq_list), dtype=np.uint8).reshape(len(seq_list), alignment_length)
+
+    return seq_id_list, msa_array
+
+
+def get_gap_percent(msa_array):
+
+    sequence_number = msa_array.shape[0]
+    dash_number = np.count_nonzero(msa_array == ord('-'), axis=0)
+
+    return (dash_number / sequence_number) * 100
+
+
+def get_most_abundant_residue_percent(msa_array):
+
+    # gaps were also counted as a residue here
+    sequence_number = msa_array.shape[0]
+    most_abundant_residue_number = np.zeros(msa_array.shape[1], dtype=np.int64)
+    for each_residue in np.unique(msa_array):
+        each_residue_number = np.count_nonzero(msa_array == each_residue, axis=0)
+        np.maximum(most_abundant_residue_number, each_residue_number, out=most_abundant_residue_number)
+
+    return (most_abundant_residue_number / sequence_number) * 100
+
+
+def get_supermatrix_array(alignment_file_list, seq_id_list):
+
+    # concatenate alignments (fasta format) into a 2-D uint8 array, one row per id in seq_id_list, columns of
+    # alignments in the order of alignment_file_list, ids missing from an alignment are filled with gaps. Alignment
+    # lengths are read first, so that the array is allocated once.
+    alignment_length_list = []
+    for alignment_file in alignment_file_list:
+        alignment_length = 0
+        for each_seq in SeqIO.parse(alignment_file, 'fasta'):
+            alignment_length = len(each_seq.seq)
+            break
+        alignment_length_list.append(alignment_length)
+
+    seq_id_to_row_dict = {seq_id: row_index for row_index, seq_id in enumerate(seq_id_list)}
+    supermatrix_array = np.full((len(seq_id_list), sum(alignment_length_list)), ord('-'), dtype=np.uint8)
+    column_start = 0
+    for alignment_file, alignment_length in zip(alignment_file_list, alignment_length_list):
+        for each_seq in SeqIO.parse(alignment_file, 'fasta'):
+            if each_seq.id in seq_id_to_row_dict:
+                each_seq_bytes = str(each_seq.seq).encode()
+                if len(each_seq_bytes) != alignment_length:
+                    raise ValueError('Sequences must all be the same length: %s' % alignment_file)
+                supermatrix_array[seq_id_to_row_dict[each_seq.id], column_start:(column_start + alignment_length)] = np.frombuffer(each_seq_bytes, dtype=np.uint8)
+        column_start += alignment_length
+
+    return supermatrix_array
+
+
+def filter_msa_array_columns(msa_array, minimal_cov, min_consensus):
+
+    # remove columns with gap percent higher than minimal_cov
+    msa_array = msa_array[:, get_gap_percent(msa_array) <= minimal_cov]
+
+    # remove columns with the most abundant residue percent lower than min_consensus
+    msa_array = msa_array[:, get_most_abundant_residue_percent(msa_array) >= min_consensus]
+
+    return msa_array
+
+
+def write_msa_array(seq_id_list, msa_array, alignment_file_out):
+
+    alignment_file_out_handle = open(alignment_file_out, 'w')
+    for seq_id, seq_array in zip(seq_id_list, msa_array):
+        alignment_file_out_handle.write('>%s\n%s\n' % (seq_id, seq_array.tobytes().decode()))
+    alignment_file_out_handle.close()
+
+
+def remove_low_cov_and_consensus_columns(alignment_file_in, minimal_cov, min_consensus, alignment_file_out):
+
+    # read in alignment
+    seq_id_list, msa_array = read_msa_to_array(alignment_file_in)
+
+    # remove columns with low coverage and low consensus
+    msa_array = filter_msa_array_columns(msa_array, minimal_cov, min_consensus)
+
+    # write filtered alignment
+    write_msa_array(seq_id_list, msa_array, alignment_file_out)
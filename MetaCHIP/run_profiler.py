@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import glob
+import shutil
+import platform
+import resource
+import subprocess
+import numpy as np
+from datetime import datetime
+
+
+# Profiling of PI, BM, PG and combine_multiple_level_predictions runs. Every message passed to report_and_log starts
+# a new step (wall time, CPU time and peak RSS of the main process and of its largest child process in the step),
+# external tools run with profiled_system() get their own rusage and every profiled_pool_map() call records task times
+# and peak RSS of a mp.Pool. Records from pool workers are appended to one file per process, they are collected into a
+# JSON report (next to the log file) and a summary table is added to the end of the log file at the end of the run.
+# Peak RSS of a step or task is measured on Linux by resetting the high-water mark of the process (/proc/self/clear_refs)
+# at its start and reading it (VmHWM) at its end. Where this is not possible, the high-water mark since the process
+# started (ru_maxrss) is reported instead.
+
+profile_dict = {}
+
+
+def get_maxrss_mb(ru_maxrss):
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if platform.system() == 'Darwin':
+        return ru_maxrss / 1024 / 1024
+
+    return ru_maxrss / 1024
+
+
+def reset_peak_rss():
+
+    # return True if the RSS high-water mark of the process was reset to its current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs_handle:
+            clear_refs_handle.write('5')
+        return True
+    except (OSError, IOError):
+        return False
+
+
+def get_peak_rss_mb():
+
+    # RSS high-water mark of the process since its start or its last reset_peak_rss(), None if not available
+    try:
+        with open('/proc/self/status') as status_handle:
+            for each_line in status_handle:
+                if each_line.startswith('VmHWM:'):
+                    return int(each_line.split()[1]) / 1024
+    except (OSError, IOError):
+        return None
+
+    return None
+
+
+def get_rusage():
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {'wall':              time.time(),
+            'cpu_self':          self_usage.ru_utime + self_usage.ru_stime,
+            'cpu_children':      children_usage.ru_utime + children_usage.ru_stime,
+            'max_rss_self':      get_maxrss_mb(self_usage.ru_maxrss),
+            'max_rss_children':  get_maxrss_mb(children_usage.ru_maxrss)}
+
+
+def get_rusage_delta(usage_start, usage_end):
+
+    return {'wall':         round(usage_end['wall'] - usage_start['wall'], 3),
+            'cpu_self':     round(usage_end['cpu_self'] - usage_start['cpu_self'], 3),
+            'cpu_children': round(usage_end['cpu_children'] - usage_start['cpu_children'], 3)}
+
+
+def start_profiling(run_name, pwd_log_file):
+
+    profile_dict.clear()
+    profile_dict['run'] = run_name
+    profile_dict['pid'] = os.getpid()
+    profile_dict['log_file'] = pwd_log_file
+    profile_dict['record_folder'] = '%s_profile_records' % os.path.splitext(pwd_log_file)[0]
+    profile_dict['start_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    profile_dict['start_usage'] = get_rusage()
+    profile_dict['step_list'] = []
+    profile_dict['current_step'] = None
+    profile_dict['current_step_usage'] = None
+    profile_dict['current_step_peak_rss_reset'] = False
+
+    if os.path.isdir(profile_dict['record_folder']):
+        shutil.rmtree(profile_dict['record_folder'], ignore_errors=True)
+    os.makedirs(profile_dict['record_folder'])
+
+
+def profiling_in_main_process():
+
+    return (len(profile_dict) > 0) and (profile_dict['pid'] == os.getpid())
+
+
+def record_profile_step(step_name):
+
+    if not profiling_in_main_process():
+        return
+
+    current_usage = get_rusage()
+    if profile_dict['current_step'] is not None:
+        step_record = {'step': profile_dict['current_step']}
+        step_record.update(get_rusage_delta(profile_dict['current_step_usage'], current_usage))
+
+        # peak RSS of the main process in the step, the high-water mark since the process started if it was not reset
+        step_peak_rss = get_peak_rss_mb() if profile_dict['current_step_peak_rss_reset'] is True else None
+        if step_peak_rss is None:
+            step_record['peak_rss_self'] = round(current_usage['max_rss_self'], 1)
+            step_record['peak_rss_measure'] = 'max_so_far'
+        else:
+            step_record['peak_rss_self'] = round(step_peak_rss, 1)
+            step_record['peak_rss_measure'] = 'step'
+        profile_dict['step_list'].append(step_record)
+
+    profile_dict['current_step'] = step_name
+    profile_dict['current_step_index'] = len(profile_dict['step_list'])
+    profile_dict['current_step_usage'] = current_usage
+    profile_dict['current_step_peak_rss_reset'] = reset_peak_rss()
+
+
+def write_profile_record(profile_record):
+
+    if len(profile_dict) == 0:
+        return
+
+    profile_record['step'] = profile_dict['current_step']
+    profile_record['step_index'] = profile_dict.get('current_step_index')
+    with open('%s/%s.jsonl' % (profile_dict['record_folder'], os.getpid()), 'a') as profile_record_handle:
+        profile_record_handle.write('%s\n' % json.dumps(profile_record))
+
+
+def profiled_system(cmd, tool_name):
+
+    # same as os.system(cmd), rusage of the command (including processes it waited for) is recorded with os.wait4.
+    # On Linux, peak RSS of a command is at least the RSS of the calling process at the time of the fork.
+    if len(profile_dict) == 0:
+        return os.system(cmd)
+
+    start_time = time.time()
+    cmd_process = subprocess.Popen(cmd, shell=True)
+    _, wait_status, cmd_rusage = os.wait4(cmd_process.pid, 0)
+    end_time = time.time()
+    if os.WIFEXITED(wait_status):
+        cmd_process.returncode = os.WEXITSTATUS(wait_status)
+    else:
+        cmd_process.returncode = -os.WTERMSIG(wait_status)
+
+    write_profile_record({'type':        'tool',
+                          'tool':        tool_name,
+                          'wall':        round(end_time - start_time, 3),
+                          'cpu_user':    round(cmd_rusage.ru_utime, 3),
+                          'cpu_sys':     round(cmd_rusage.ru_stime, 3),
+                          'peak_rss':    round(get_maxrss_mb(cmd_rusage.ru_maxrss), 1),
+                          'exit_status': cmd_process.returncode})
+
+    return wait_status
+
+
+class ProfiledWorker(object):
+
+    # wraps a pool worker to return the start and end time and peak RSS (None if not measured) of each task with its
+    # result, worker processes run many tasks, so the RSS high-water mark is reset at the start of each task
+    def __init__(self, worker):
+        self.worker = worker
+
+    def __call__(self, argument_list):
+        peak_rss_reset = reset_peak_rss()
+        task_start = time.time()
+        task_result = self.worker(argument_list)
+        task_end = time.time()
+        task_peak_rss = get_peak_rss_mb() if peak_rss_reset is True else None
+        return task_start, task_end, os.getpid(), task_peak_rss, task_result
+
+
+def profiled_pool_map(pool, worker, argument_list):
+
+    # same as pool.map(worker, argument_list), with the distribution of task times and stragglers recorded
+    if len(profile_dict) == 0:
+        return pool.map(worker, argument_list)
+
+    map_start = time.time()
+    timed_result_list = pool.map(ProfiledWorker(worker), argument_list)
+    map_end = time.time()
+
+    pool_record = {'type':      'pool',
+                   'worker':    worker.__name__,
+                   'processes': pool._processes,
+                   'tasks':     len(argument_list),
+                   'wall':      round(map_end - map_start, 3)}
+
+    if len(timed_result_list) > 0:
+        task_time = np.array([task_end - task_start for task_start, task_end, _, _, _ in timed_result_list])
+        task_end_time = np.sort(np.array([task_end for _, task_end, _, _, _ in timed_result_list])) - map_start
+        task_peak_rss_list = [task_peak_rss for _, _, _, task_peak_rss, _ in timed_result_list if task_peak_rss is not None]
+        slowest_task_index = np.argsort(task_time)[::-1][:5]
+        time_to_90pct_tasks = task_end_time[max(int(len(task_end_time) * 0.9) - 1, 0)]
+        pool_record.update({'worker_processes_used':  len({task_pid for _, _, task_pid, _, _ in timed_result_list}),
+                            'task_time_sum':          round(float(task_time.sum()), 3),
+                            'task_time_min':          round(float(task_time.min()), 3),
+                            'task_time_median':       round(float(np.median(task_time)), 3),
+                            'task_time_p90':          round(float(np.percentile(task_time, 90)), 3),
+                            'task_time_max':          round(float(task_time.max()), 3),
+                            'utilisation':            round(float(task_time.sum() / ((map_end - map_start) * pool._processes)), 3) if map_end > map_start else None,
+                            'time_to_90pct_tasks':    round(float(time_to_90pct_tasks), 3),
+                            'straggler_wait':         round(float((map_end - map_start) - time_to_90pct_tasks), 3),
+                            'slowest_tasks':          [[int(task_index), round(float(task_time[task_index]), 3)] for task_index in slowest_task_index],
+                            'task_peak_rss_max':      round(max(task_peak_rss_list), 1) if len(task_peak_rss_list) > 0 else None})
+
+    write_profile_record(pool_record)
+
+    return [task_result for _, _, _, _, task_result in timed_result_list]
+
+
+def get_tool_summary(tool_record_list):
+
+    tool_summary_dict = {}
+    for tool_record in tool_record_list:
+        tool_name = tool_record['tool']
+        if tool_name not in tool_summary_dict:
+            tool_summary_dict[tool_name] = {'calls': 0, 'wall': 0, 'wall_max': 0, 'cpu': 0, 'peak_rss': 0, 'failed_calls': 0}
+        tool_summary = tool_summary_dict[tool_name]
+        tool_summary['calls'] += 1
+        tool_summary['wall'] += tool_record['wall']
+        tool_summary['wall_max'] = max(tool_summary['wall_max'], tool_record['wall'])
+        tool_summary['cpu'] += tool_record['cpu_user'] + tool_record['cpu_sys']
+        tool_summary['peak_rss'] = max(tool_summary['peak_rss'], tool_record['peak_rss'])
+        if tool_record['exit_status'] != 0:
+            tool_summary['failed_calls'] += 1
+
+    for tool_name in tool_summary_dict:
+        for each_key in ['wall', 'wall_max', 'cpu']:
+            tool_summary_dict[tool_name][each_key] = round(tool_summary_dict[tool_name][each_key], 3)
+
+    return tool_summary_dict
+
+
+def end_profiling():
+
+    # write JSON report and add summary table to the end of the log file
+    if not profiling_in_main_process():
+        return
+
+    record_profile_step(None)
+    end_usage = get_rusage()
+
+    tool_record_list = []
+    pool_record_list = []
+    for profile_record_file in sorted(glob.glob('%s/*.jsonl' % profile_dict['record_folder'])):
+        for each_line in open(profile_record_file):
+            profile_record = json.loads(each_line)
+            if profile_record['type'] == 'tool':
+                tool_record_list.append(profile_record)
+            elif profile_record['type'] == 'pool':
+                pool_record_list.append(profile_record)
+    shutil.rmtree(profile_dict['record_folder'], ignore_errors=True)
+
+    # peak RSS of child processes in each step is that of its largest external tool call or pool task
+    for step_index, step_record in enumerate(profile_dict['step_list']):
+        child_peak_rss_list = [i['peak_rss'] for i in tool_record_list if i.get('step_index') == step_index]
+        child_peak_rss_list += [i['task_peak_rss_max'] for i in pool_record_list if (i.get('step_index') == step_index) and (i.get('task_peak_rss_max') is not None)]
+        step_record['peak_rss_children'] = max(child_peak_rss_list) if len(child_peak_rss_list) > 0 else 0
+
+    # ru_maxrss does not cover the resets of the high-water mark, so peaks of steps are included for the run
+    total_usage = get_rusage_delta(profile_dict['start_usage'], end_usage)
+    total_usage['peak_rss_self'] = round(max([end_usage['max_rss_self']] + [i['peak_rss_self'] for i in profile_dict['step_list']]), 1)
+    total_usage['peak_rss_children'] = round(max([end_usage['max_rss_children']] + [i['peak_rss_children'] for i in profile_dict['step_list']]), 1)
+
+    profile_report = {'run':        profile_dict['run'],
+                      'start_time': profile_dict['start_time'],
+                      'total':      total_usage,
+                      'steps':      profile_dict['step_list'],
+                      'tools':      get_tool_summary(tool_record_list),
+                      'pools':      pool_record_list,
+                      'tool_calls': tool_record_list}
+
+    pwd_profile_report = '%s_profile.json' % os.path.splitext(profile_dict['log_file'])[0]
+    with open(pwd_profile_report, 'w') as profile_report_handle:
+        json.dump(profile_report, profile_report_handle, indent=1)
+
+    # summary table
+    summary_line_list = ['', 'Profiling summary of %s (time in seconds, peak RSS in MB, RSS_child: largest child process), full report: %s' % (profile_dict['run'], os.path.basename(pwd_profile_report)),
+                         '%-60s %10s %10s %10s %10s %10s' % ('Step', 'Wall', 'CPU', 'CPU_child', 'RSS', 'RSS_child')]
+    for step_record in profile_report['steps'] + [dict(step='Total', peak_rss_measure='step', **profile_report['total'])]:
+        summary_line_list.append('%-60s %10.1f %10.1f %10.1f %10.1f %10.1f%s' % (step_record['step'][:60], step_record['wall'], step_record['cpu_self'], step_record['cpu_children'], step_record['peak_rss_self'], step_record['peak_rss_children'], ' *' if step_record['peak_rss_measure'] == 'max_so_far' else ''))
+    if 'max_so_far' in [i['peak_rss_measure'] for i in profile_report['steps']]:
+        summary_line_list.append('* RSS of the step could not be measured, the high-water mark of the run at its end is given')
+
+    if len(profile_report['tools']) > 0:
+        summary_line_list.append('')
+        summary_line_list.append('%-20s %8s %10s %10s %10s %10s %8s' % ('Tool', 'Calls', 'Wall', 'Wall_max', 'CPU', 'RSS_max', 'Failed'))
+        for tool_name in sorted(profile_report['tools'], key=lambda x: profile_report['tools'][x]['wall'], reverse=True):
+            tool_summary = profile_report['tools'][tool_name]
+            summary_line_list.append('%-20s %8s %10.1f %10.1f %10.1f %10.1f %8s' % (tool_name, tool_summary['calls'], tool_summary['wall'], tool_summary['wall_max'], tool_summary['cpu'], tool_summary['peak_rss'], tool_summary['failed_calls']))
+
+    if len(pool_record_list) > 0:
+        summary_line_list.append('')
+        summary_line_list.append('%-30s %8s %6s %10s %10s %10s %10s %10s' % ('Pool worker', 'Tasks', 'Procs', 'Wall', 'Median', 'Max', 'Straggler', 'Util'))
+        for pool_record in pool_record_list:
+            if pool_record['tasks'] == 0:
+                summary_line_list.append('%-30s %8s %6s %10.1f' % (pool_record['worker'][:30], 0, pool_record['processes'], pool_record['wall']))
+            else:
+                summary_line_list.append('%-30s %8s %6s %10.1f %10.2f %10.2f %10.1f %10s' % (pool_record['worker'][:30], pool_record['tasks'], pool_record['processes'], pool_record['wall'], pool_record['task_time_median'], pool_record['task_time_max'], pool_record['straggler_wait'], pool_record['utilisation']))
+
+    with open(profile_dict['log_file'], 'a') as log_handle:
+        log_handle.write('%s\n' % '\n'.join(summary_line_list))
+
+    profile_dict.clear()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import glob
+import json
+import shutil
+import argparse
+import platform
+import subprocess
+import numpy as np
+from Bio import SeqIO
+from datetime import datetime
+from MetaCHIP.MetaCHIP_config import config_dict
+from MetaCHIP.run_profiler import get_maxrss_mb
+from MetaCHIP.synthetic_HGT_dataset import generate_synthetic_dataset
+
+
+# End-to-end scaling benchmark: a synthetic dataset (synthetic_HGT_dataset.py) is generated for each genome number,
+# "MetaCHIP PI" and "MetaCHIP BP" are run on it, time and memory of each stage are taken from the profile reports
+# written next to the log files, a power law (time = a * N^b) is fitted per stage and detected HGTs are compared to the
+# planted ones. Datasets are identified by their digest, reports of different MetaCHIP versions can be compared with
+# -baseline for datasets with the same digest.
+
+benchmark_report_version = 1
+
+
+def report_and_log(message_for_report, log_file, keep_quiet):
+
+    time_format = '[%Y-%m-%d %H:%M:%S]'
+    with open(log_file, 'a') as log_handle:
+        log_handle.write('%s %s\n' % ((datetime.now().strftime(time_format)), message_for_report))
+
+    if keep_quiet is False:
+        print('%s %s' % ((datetime.now().strftime(time_format)), message_for_report))
+
+
+def get_MetaCHIP_version():
+
+    version_file = open('%s/VERSION' % os.path.dirname(os.path.realpath(__file__)))
+
+    return version_file.readline().strip()
+
+
+def get_git_commit():
+
+    try:
+        git_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)), stderr=subprocess.DEVNULL)
+        return git_commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_command_with_rusage(cmd_list, cwd, pwd_stdout_file):
+
+    with open(pwd_stdout_file, 'w') as stdout_handle:
+        cmd_process = subprocess.Popen(cmd_list, cwd=cwd, stdout=stdout_handle, stderr=subprocess.STDOUT)
+        start_time = datetime.now()
+        _, wait_status, cmd_rusage = os.wait4(cmd_process.pid, 0)
+        wall_time = (datetime.now() - start_time).total_seconds()
+        cmd_process.returncode = os.WEXITSTATUS(wait_status) if os.WIFEXITED(wait_status) else -os.WTERMSIG(wait_status)
+
+    return {'wall':        round(wall_time, 3),
+            'cpu':         round(cmd_rusage.ru_utime + cmd_rusage.ru_stime, 3),
+            'peak_rss':    round(get_maxrss_mb(cmd_rusage.ru_maxrss), 1),
+            'exit_status': cmd_process.returncode}
+
+
+def get_stage_profiles(pwd_log_folder):
+
+    # PI, BM, PG and combine stages from the profile reports of run_profiler
+    stage_profile_dict = {}
+    for pwd_profile_report in sorted(glob.glob('%s/*_profile.json' % pwd_log_folder)):
+        profile_report = json.load(open(pwd_profile_report))
+        stage_profile_dict[profile_report['run']] = {'wall':     profile_report['total']['wall'],
+                                                     'cpu':      round(profile_report['total']['cpu_self'] + profile_report['total']['cpu_children'], 3),
+                                                     'peak_rss': max(profile_report['total']['peak_rss_self'], profile_report['total']['peak_rss_children']),
+                                                     'tools':    profile_report['tools']}
+
+    return stage_profile_dict
+
+
+def get_gene_locations(pwd_prodigal_output_folder):
+
+    gene_location_dict = {}
+    for pwd_gbk_file in glob.glob('%s/*.gbk' % pwd_prodigal_output_folder):
+        for seq_record in SeqIO.parse(pwd_gbk_file, 'genbank'):
+            for feature in seq_record.features:
+                if feature.type == 'CDS':
+                    gene_location_dict[feature.qualifiers['locus_tag'][0]] = [seq_record.id, int(feature.location.start) + 1, int(feature.location.end)]
+
+    return gene_location_dict
+
+
+def get_overlap_fraction(gene_location, planted_contig, planted_start, planted_end):
+
+    if gene_location[0] != planted_contig:
+        return 0
+
+    overlap_len = min(gene_location[2], planted_end) - max(gene_location[1], planted_start) + 1
+
+    return max(overlap_len, 0) / (planted_end - planted_start + 1)
+
+
+def get_HGT_recovery(pwd_planted_HGT_file, pwd_grouping_file, pwd_detected_HGT_file, gene_location_dict):
+
+    # a planted HGT is recovered if one gene of a detected pair covers at least half of the transferred gene in the
+    # recipient genome and the other gene is from the donor group (from the donor genome for exact recovery)
+    planted_HGT_list = []
+    for each_HGT in open(pwd_planted_HGT_file):
+        if not each_HGT.startswith('HGT_id'):
+            each_HGT_split = each_HGT.strip().split('\t')
+            planted_HGT_list.append({'id':               each_HGT_split[0],
+                                     'donor_genome':     each_HGT_split[2],
+                                     'donor_group':      each_HGT_split[3],
+                                     'donor_location':   [each_HGT_split[4], int(each_HGT_split[5]), int(each_HGT_split[6])],
+                                     'recipient_genome': each_HGT_split[8],
+                                     'recipient_location': [each_HGT_split[10], int(each_HGT_split[11]), int(each_HGT_split[12])]})
+
+    genome_to_group_dict = {}
+    for each_genome in open(pwd_grouping_file):
+        genome_to_group_dict[each_genome.strip().split(',')[1]] = each_genome.strip().split(',')[0]
+
+    detected_HGT_list = []
+    if os.path.isfile(pwd_detected_HGT_file):
+        for each_HGT in open(pwd_detected_HGT_file):
+            if not each_HGT.startswith('Gene_1'):
+                each_HGT_split = each_HGT.strip().split('\t')
+                detected_HGT_list.append([each_HGT_split[0], each_HGT_split[1], each_HGT_split[-1].split('(')[0]])
+
+    recovered_HGT_set = set()
+    recovered_exact_set = set()
+    correct_direction_set = set()
+    true_detection_num = 0
+    for gene_1, gene_2, direction in detected_HGT_list:
+        is_true_detection = False
+        for recipient_gene, donor_gene in [[gene_1, gene_2], [gene_2, gene_1]]:
+            if (recipient_gene not in gene_location_dict) or (donor_gene not in gene_location_dict):
+                continue
+            donor_gene_genome = '_'.join(donor_gene.split('_')[:-1])
+            for planted_HGT in planted_HGT_list:
+                if get_overlap_fraction(gene_location_dict[recipient_gene], *planted_HGT['recipient_location']) < 0.5:
+                    continue
+                if donor_gene_genome == planted_HGT['donor_genome']:
+                    if get_overlap_fraction(gene_location_dict[donor_gene], *planted_HGT['donor_location']) >= 0.5:
+                        recovered_exact_set.add(planted_HGT['id'])
+                elif genome_to_group_dict.get(donor_gene_genome) != planted_HGT['donor_group']:
+                    continue
+                is_true_detection = True
+                recovered_HGT_set.add(planted_HGT['id'])
+                if direction.split('-->')[-1] == planted_HGT['recipient_genome']:
+                    correct_direction_set.add(planted_HGT['id'])
+        if is_true_detection is True:
+            true_detection_num += 1
+
+    return {'planted':            len(planted_HGT_list),
+            'detected':           len(detected_HGT_list),
+            'recovered':          len(recovered_HGT_set),
+            'recovered_exact':    len(recovered_exact_set),
+            'correct_direction':  len(correct_direction_set),
+            'recall':             round(len(recovered_HGT_set) / len(planted_HGT_list), 4) if len(planted_HGT_list) > 0 else None,
+            'precision':          round(true_detection_num / len(detected_HGT_list), 4) if len(detected_HGT_list) > 0 else None}
+
+
+def fit_power_law(genome_num_list, value_list):
+
+    # least squares fit of log(value) = log(a) + b * log(N)
+    point_list = [[n, v] for n, v in zip(genome_num_list, value_list) if (v is not None) and (v > 0)]
+    if len({n for n, _ in point_list}) < 2:
+        return None
+
+    log_n = np.log([n for n, _ in point_list])
+    log_value = np.log([v for _, v in point_list])
+    exponent, log_coefficient = np.polyfit(log_n, log_value, 1)
+    residual = log_value - (log_coefficient + exponent * log_n)
+    total = log_value - log_value.mean()
+    r_squared = 1 - (residual ** 2).sum() / (total ** 2).sum() if (total ** 2).sum() > 0 else 1.0
+
+    return {'coefficient': float(np.exp(log_coefficient)), 'exponent': round(float(exponent), 4), 'r_squared': round(float(r_squared), 4)}
+
+
+def compare_with_baseline(benchmark_report, baseline_report):
+
+    summary_line_list = ['', 'Comparison with baseline (MetaCHIP %s, %s), time ratio = current / baseline' % (baseline_report['MetaCHIP_version'], baseline_report['git_commit']),
+                         '%-8s %-10s %12s %12s %10s %12s' % ('Genomes', 'Stage', 'Baseline', 'Current', 'Ratio', 'Recall_diff')]
+    baseline_run_dict = {each_run['dataset']['digest']: each_run for each_run in baseline_report['runs']}
+    for each_run in benchmark_report['runs']:
+        baseline_run = baseline_run_dict.get(each_run['dataset']['digest'])
+        if baseline_run is None:
+            summary_line_list.append('%-8s no baseline run on the same dataset' % each_run['genomes'])
+            continue
+        recall_diff = None
+        if (each_run['recovery']['recall'] is not None) and (baseline_run['recovery']['recall'] is not None):
+            recall_diff = round(each_run['recovery']['recall'] - baseline_run['recovery']['recall'], 4)
+        for stage in ['PI', 'BM', 'PG', 'combine', 'total']:
+            if (stage in each_run['stages']) and (stage in baseline_run['stages']) and (baseline_run['stages'][stage]['wall'] > 0):
+                ratio = each_run['stages'][stage]['wall'] / baseline_run['stages'][stage]['wall']
+                summary_line_list.append('%-8s %-10s %12.1f %12.1f %10.3f %12s' % (each_run['genomes'], stage, baseline_run['stages'][stage]['wall'], each_run['stages'][stage]['wall'], ratio, recall_diff))
+
+    return summary_line_list
+
+
+def scaling_benchmark(args, config_dict):
+
+    output_folder =         args['o']
+    output_prefix =         args['p']
+    genome_num_list =       [int(i) for i in args['n'].split(',')]
+    grouping_rank =         args['r']
+    num_threads =           args['t']
+    MetaCHIP_exe =          args['exe']
+    builtin_dtl =           args['builtin_dtl']
+    pwd_baseline_report =   args['baseline']
+    keep_quiet =            args['quiet']
+
+    pwd_benchmark_report =  '%s/%s_scaling_benchmark.json'  % (output_folder, output_prefix)
+    pwd_benchmark_summary = '%s/%s_scaling_benchmark.txt'   % (output_folder, output_prefix)
+    pwd_log_file =          '%s/%s_scaling_benchmark.log'   % (output_folder, output_prefix)
+
+    if shutil.which(MetaCHIP_exe) is None:
+        print('MetaCHIP executable (%s) not found, program exited!' % MetaCHIP_exe)
+        exit()
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    benchmark_report = {'report_version':   benchmark_report_version,
+                        'MetaCHIP_version': get_MetaCHIP_version(),
+                        'git_commit':       get_git_commit(),
+                        'date':             datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        'host':             {'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'python': platform.python_version()},
+                        'settings':         {'rank': grouping_rank, 'threads': num_threads, 'builtin_dtl': builtin_dtl},
+                        'runs':             []}
+
+    for genome_num in sorted(genome_num_list):
+
+        # generate dataset
+        dataset_folder = '%s_N%s' % (output_prefix, genome_num)
+        pwd_dataset_folder = '%s/%s' % (output_folder, dataset_folder)
+        if os.path.isdir(pwd_dataset_folder):
+            shutil.rmtree(pwd_dataset_folder)
+        report_and_log(('Generating synthetic dataset with %s genomes' % genome_num), pwd_log_file, keep_quiet)
+        dataset_args = {'o': pwd_dataset_folder, 'p': output_prefix, 'n': genome_num, 'groups': args['groups'], 'genes': args['genes'],
+                        'transfers': args['transfers'], 'contig_genes': args['contig_genes'], 'gd': args['gd'], 'md': args['md'],
+                        'td': args['td'], 'seed': args['seed']}
+        dataset_dict = generate_synthetic_dataset(dataset_args, config_dict)
+
+        # run PI and BP
+        PI_cmd = [MetaCHIP_exe, 'PI', '-i', dataset_dict['genome_folder'], '-taxon', dataset_dict['gtdb_file'], '-p', output_prefix, '-r', grouping_rank, '-t', str(num_threads), '-x', 'fasta', '-quiet']
+        BP_cmd = [MetaCHIP_exe, 'BP', '-p', output_prefix, '-r', grouping_rank, '-t', str(num_threads), '-quiet']
+        if builtin_dtl is True:
+            BP_cmd.append('-builtin_dtl')
+
+        report_and_log(('Running MetaCHIP PI on %s genomes' % genome_num), pwd_log_file, keep_quiet)
+        PI_usage = run_command_with_rusage(PI_cmd, pwd_dataset_folder, '%s/%s_PI_stdout.txt' % (pwd_dataset_folder, output_prefix))
+        BP_usage = None
+        if PI_usage['exit_status'] == 0:
+            report_and_log(('Running MetaCHIP BP on %s genomes' % genome_num), pwd_log_file, keep_quiet)
+            BP_usage = run_command_with_rusage(BP_cmd, pwd_dataset_folder, '%s/%s_BP_stdout.txt' % (pwd_dataset_folder, output_prefix))
+
+        # collect stage profiles and HGT recovery
+        pwd_MetaCHIP_wd = '%s/%s_MetaCHIP_wd' % (pwd_dataset_folder, output_prefix)
+        stage_profile_dict = get_stage_profiles('%s/%s_log_files' % (pwd_MetaCHIP_wd, output_prefix))
+        stage_profile_dict['total'] = {'wall':     round(PI_usage['wall'] + (BP_usage['wall'] if BP_usage else 0), 3),
+                                       'cpu':      round(PI_usage['cpu'] + (BP_usage['cpu'] if BP_usage else 0), 3),
+                                       'peak_rss': max(PI_usage['peak_rss'], BP_usage['peak_rss'] if BP_usage else 0)}
+
+        gene_location_dict = get_gene_locations('%s/%s_all_prodigal_output' % (pwd_MetaCHIP_wd, output_prefix))
+        detected_HGT_file_list = glob.glob('%s/%s_%s*_HGTs_ip*/%s_%s_detected_HGTs.txt' % (pwd_MetaCHIP_wd, output_prefix, grouping_rank, output_prefix, grouping_rank))
+        pwd_detected_HGT_file = detected_HGT_file_list[0] if len(detected_HGT_file_list) > 0 else ''
+        recovery_dict = get_HGT_recovery('%s/%s' % (pwd_dataset_folder, dataset_dict['planted_HGTs_file']), '%s/%s' % (pwd_dataset_folder, dataset_dict['grouping_file']), pwd_detected_HGT_file, gene_location_dict)
+
+        benchmark_report['runs'].append({'genomes':     genome_num,
+                                         'dataset':     dataset_dict,
+                                         'PI_process':  PI_usage,
+                                         'BP_process':  BP_usage,
+                                         'stages':      stage_profile_dict,
+                                         'recovery':    recovery_dict})
+
+        report_and_log(('N=%s, wall time: %ss, peak RSS: %sMB, recovered HGTs: %s/%s' % (genome_num, stage_profile_dict['total']['wall'], stage_profile_dict['total']['peak_rss'], recovery_dict['recovered'], recovery_dict['planted'])), pwd_log_file, keep_quiet)
+
+    # fit scaling curves
+    completed_run_list = [each_run for each_run in benchmark_report['runs'] if (each_run['BP_process'] is not None) and (each_run['BP_process']['exit_status'] == 0)]
+    benchmark_report['scaling'] = {}
+    for stage in ['PI', 'BM', 'PG', 'combine', 'total']:
+        stage_run_list = [each_run for each_run in completed_run_list if stage in each_run['stages']]
+        benchmark_report['scaling'][stage] = {'wall':     fit_power_law([each_run['genomes'] for each_run in stage_run_list], [each_run['stages'][stage]['wall'] for each_run in stage_run_list]),
+                                              'peak_rss': fit_power_law([each_run['genomes'] for each_run in stage_run_list], [each_run['stages'][stage]['peak_rss'] for each_run in stage_run_list])}
+
+    with open(pwd_benchmark_report, 'w') as benchmark_report_handle:
+        json.dump(benchmark_report, benchmark_report_handle, indent=1)
+
+    # summary table
+    summary_line_list = ['MetaCHIP %s (%s) scaling benchmark, time in seconds, peak RSS in MB' % (benchmark_report['MetaCHIP_version'], benchmark_report['git_commit']),
+                         '%-8s %-10s %12s %12s %12s' % ('Genomes', 'Stage', 'Wall', 'CPU', 'Peak_RSS')]
+    for each_run in benchmark_report['runs']:
+        for stage in ['PI', 'BM', 'PG', 'combine', 'total']:
+            if stage in each_run['stages']:
+                summary_line_list.append('%-8s %-10s %12.1f %12.1f %12.1f' % (each_run['genomes'], stage, each_run['stages'][stage]['wall'], each_run['stages'][stage]['cpu'], each_run['stages'][stage]['peak_rss']))
+
+    summary_line_list += ['', '%-10s %18s %10s %18s %10s' % ('Stage', 'Wall_exponent', 'R2', 'RSS_exponent', 'R2')]
+    for stage in benchmark_report['scaling']:
+        wall_fit = benchmark_report['scaling'][stage]['wall']
+        rss_fit = benchmark_report['scaling'][stage]['peak_rss']
+        if wall_fit is not None:
+            summary_line_list.append('%-10s %18s %10s %18s %10s' % (stage, wall_fit['exponent'], wall_fit['r_squared'], rss_fit['exponent'] if rss_fit else 'NA', rss_fit['r_squared'] if rss_fit else 'NA'))
+
+    summary_line_list += ['', '%-8s %8s %9s %10s %15s %10s %10s %10s' % ('Genomes', 'Planted', 'Detected', 'Recovered', 'Recovered_exact', 'Direction', 'Recall', 'Precision')]
+    for each_run in benchmark_report['runs']:
+        recovery_dict = each_run['recovery']
+        summary_line_list.append('%-8s %8s %9s %10s %15s %10s %10s %10s' % (each_run['genomes'], recovery_dict['planted'], recovery_dict['detected'], recovery_dict['recovered'], recovery_dict['recovered_exact'], recovery_dict['correct_direction'], recovery_dict['recall'], recovery_dict['precision']))
+
+    if pwd_baseline_report is not None:
+        summary_line_list += compare_with_baseline(benchmark_report, json.load(open(pwd_baseline_report)))
+
+    with open(pwd_benchmark_summary, 'w') as benchmark_summary_handle:
+        benchmark_summary_handle.write('%s\n' % '\n'.join(summary_line_list))
+
+    if keep_quiet is False:
+        print('\n'.join(summary_line_list))
+
+    report_and_log(('Benchmark report exported to: %s' % pwd_benchmark_report), pwd_log_file, keep_quiet)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-o',             required=True,                                help='output folder')
+    parser.add_argument('-p',             required=False, default='syn',                help='output prefix, default: syn')
+    parser.add_argument('-n',             required=False, default='10,20,40,80',        help='comma separated genome numbers, default: 10,20,40,80')
+    parser.add_argument('-groups',        required=False, type=int,   default=4,        help='number of groups, default: 4')
+    parser.add_argument('-genes',         required=False, type=int,   default=500,      help='number of genes per genome, default: 500')
+    parser.add_argument('-transfers',     required=False, type=int,   default=20,       help='number of planted HGTs, default: 20')
+    parser.add_argument('-contig_genes',  required=False, type=float, default=20,       help='mean number of genes per contig, default: 20')
+    parser.add_argument('-gd',            required=False, type=float, default=0.25,     help='codon substitution rate from root to group ancestors, default: 0.25')
+    parser.add_argument('-md',            required=False, type=float, default=0.03,     help='codon substitution rate from group ancestor to genomes, default: 0.03')
+    parser.add_argument('-td',            required=False, type=float, default=0.01,     help='codon substitution rate of transferred genes, default: 0.01')
+    parser.add_argument('-seed',          required=False, type=int,   default=1,        help='random seed, default: 1')
+    parser.add_argument('-r',             required=False, default='c',                  help='grouping rank, default: c')
+    parser.add_argument('-t',             required=False, type=int,   default=1,        help='number of threads, default: 1')
+    parser.add_argument('-exe',           required=False, default='MetaCHIP',           help='MetaCHIP executable, default: MetaCHIP')
+    parser.add_argument('-builtin_dtl',   required=False, action="store_true",          help='run BP with the built-in dated DTL engine')
+    parser.add_argument('-baseline',      required=False, default=None,                 help='benchmark report (json) of a previous version to compare with')
+    parser.add_argument('-quiet',         required=False, action="store_true",          help='not report progress')
+
+    args = vars(parser.parse_args())
+    scaling_benchmark(args, config_dict)
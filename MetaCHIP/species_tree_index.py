@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from ete3 import Tree, TreeNode
+
+
+# The full species tree is parsed once and flattened into arrays (nodes numbered in preorder), with an Euler tour and
+# a sparse table for constant time LCA queries. Subtrees induced by a genome subset are extracted from these arrays
+# and are identical to those from ete3 prune(preserve_branch_length=True).
+
+species_tree_index_dict = {}
+ranger_species_tree_dict = {}
+
+
+def get_species_tree_index(pwd_species_tree):
+
+    if pwd_species_tree in species_tree_index_dict:
+        return species_tree_index_dict[pwd_species_tree]
+
+    species_tree = Tree(pwd_species_tree, format=0)
+
+    # flatten tree, node ids are in preorder
+    node_list = list(species_tree.traverse('preorder'))
+    node_to_id_dict = {node: node_id for node_id, node in enumerate(node_list)}
+    node_parent = np.full(len(node_list), -1, dtype=np.int64)
+    node_child_index = np.zeros(len(node_list), dtype=np.int64)
+    node_subtree_end = np.zeros(len(node_list), dtype=np.int64)
+    leaf_to_id_dict = {}
+    for node_id, node in enumerate(node_list):
+        for child_index, child_node in enumerate(node.children):
+            node_parent[node_to_id_dict[child_node]] = node_id
+            node_child_index[node_to_id_dict[child_node]] = child_index
+        if node.is_leaf():
+            leaf_to_id_dict[node.name] = node_id
+    for node_id in range(len(node_list) - 1, -1, -1):
+        node_subtree_end[node_id] = max(node_subtree_end[node_id], node_id)
+        if node_parent[node_id] != -1:
+            node_subtree_end[node_parent[node_id]] = max(node_subtree_end[node_parent[node_id]], node_subtree_end[node_id])
+
+    # Euler tour with depth and first occurrence of each node
+    euler_tour = []
+    euler_depth = []
+    first_occurrence = np.zeros(len(node_list), dtype=np.int64)
+    to_visit = [(0, 0, False)]
+    while to_visit:
+        node_id, depth, revisit = to_visit.pop()
+        if not revisit:
+            first_occurrence[node_id] = len(euler_tour)
+        euler_tour.append(node_id)
+        euler_depth.append(depth)
+        if not revisit:
+            for child_node in reversed(node_list[node_id].children):
+                to_visit.append((node_id, depth, True))
+                to_visit.append((node_to_id_dict[child_node], depth + 1, False))
+    euler_tour = np.array(euler_tour, dtype=np.int64)
+    euler_depth = np.array(euler_depth, dtype=np.int64)
+
+    # sparse table of positions with the minimal depth in euler_tour[i:i + 2**level]
+    sparse_table = [np.arange(len(euler_tour), dtype=np.int64)]
+    level = 1
+    while (1 << level) <= len(euler_tour):
+        previous = sparse_table[-1]
+        half = 1 << (level - 1)
+        left = previous[:len(euler_tour) - (1 << level) + 1]
+        right = previous[half:half + len(left)]
+        sparse_table.append(np.where(euler_depth[left] <= euler_depth[right], left, right))
+        level += 1
+
+    species_tree_index = {'nodes':             node_list,
+                          'node_parent':       node_parent,
+                          'node_child_index':  node_child_index,
+                          'node_subtree_end':  node_subtree_end,
+                          'node_dist':         [node.dist for node in node_list],
+                          'leaf_to_id':        leaf_to_id_dict,
+                          'euler_tour':        euler_tour,
+                          'euler_depth':       euler_depth,
+                          'first_occurrence':  first_occurrence,
+                          'sparse_table':      sparse_table}
+    species_tree_index_dict[pwd_species_tree] = species_tree_index
+
+    return species_tree_index
+
+
+def get_lca(species_tree_index, node_id_1, node_id_2):
+
+    euler_depth = species_tree_index['euler_depth']
+    position_1 = species_tree_index['first_occurrence'][node_id_1]
+    position_2 = species_tree_index['first_occurrence'][node_id_2]
+    if position_1 > position_2:
+        position_1, position_2 = position_2, position_1
+
+    level = int(position_2 - position_1 + 1).bit_length() - 1
+    left = species_tree_index['sparse_table'][level][position_1]
+    right = species_tree_index['sparse_table'][level][position_2 - (1 << level) + 1]
+    if euler_depth[left] <= euler_depth[right]:
+        return int(species_tree_index['euler_tour'][left])
+
+    return int(species_tree_index['euler_tour'][right])
+
+
+def get_induced_subtree(species_tree_index, leaf_name_list):
+
+    leaf_to_id_dict = species_tree_index['leaf_to_id']
+    node_parent = species_tree_index['node_parent']
+    node_child_index = species_tree_index['node_child_index']
+    node_subtree_end = species_tree_index['node_subtree_end']
+    node_dist = species_tree_index['node_dist']
+    node_list = species_tree_index['nodes']
+
+    leaf_not_found = [leaf_name for leaf_name in leaf_name_list if leaf_name not in leaf_to_id_dict]
+    if len(leaf_not_found) > 0:
+        raise ValueError('Node names not found: %s' % leaf_not_found)
+
+    # kept nodes: the selected leaves, the root and the LCA of every two leaves adjacent in preorder
+    leaf_id_list = sorted({leaf_to_id_dict[leaf_name] for leaf_name in leaf_name_list})
+    kept_node_set = set(leaf_id_list)
+    kept_node_set.add(0)
+    for leaf_id_1, leaf_id_2 in zip(leaf_id_list[:-1], leaf_id_list[1:]):
+        kept_node_set.add(get_lca(species_tree_index, leaf_id_1, leaf_id_2))
+
+    # link each kept node to its nearest kept ancestor, removed nodes in between have their branch length added to the
+    # kept node (from the bottom up). As in ete3, children kept in place come first, followed by children which
+    # replaced a removed node, both in the original order.
+    new_node_dict = {}
+    kept_children_dict = {}
+    ancestor_stack = []
+    for node_id in sorted(kept_node_set):
+        new_node = TreeNode(name=node_list[node_id].name, dist=node_dist[node_id], support=node_list[node_id].support)
+        new_node_dict[node_id] = new_node
+        kept_children_dict[node_id] = []
+        while ancestor_stack and (node_subtree_end[ancestor_stack[-1]] < node_id):
+            ancestor_stack.pop()
+        if ancestor_stack:
+            kept_ancestor = ancestor_stack[-1]
+            path_node = node_id
+            while node_parent[path_node] != kept_ancestor:
+                path_node = node_parent[path_node]
+                new_node.dist += node_dist[path_node]
+            kept_children_dict[kept_ancestor].append((path_node != node_id, node_child_index[path_node], node_id))
+        ancestor_stack.append(node_id)
+
+    # ete3 also removes the LCA of all selected leaves if it is not the root, its children go to the root
+    all_leaf_lca = get_lca(species_tree_index, leaf_id_list[0], leaf_id_list[-1])
+    if (all_leaf_lca != 0) and (len(leaf_id_list) > 1):
+        kept_children_dict[0] = kept_children_dict.pop(all_leaf_lca)
+
+    for node_id in kept_children_dict:
+        for _, _, child_node_id in sorted(kept_children_dict[node_id]):
+            new_node_dict[node_id].add_child(new_node_dict[child_node_id])
+
+    return new_node_dict[0]
+
+
+def subset_tree_by_index(pwd_species_tree, leaf_node_list, tree_file_out):
+
+    # same output as subset_tree(), but the full species tree is only parsed once per process
+    species_tree_index = get_species_tree_index(pwd_species_tree)
+    get_induced_subtree(species_tree_index, leaf_node_list).write(format=0, outfile=tree_file_out)
+
+
+def get_ranger_species_tree(pwd_species_tree, genome_subset):
+
+    # Ranger-DTL ready (resolved, ultrametric, leaves renamed) species tree in newick format 5, memoised by genome subset
+    ranger_species_tree_key = (pwd_species_tree, frozenset(genome_subset))
+    if ranger_species_tree_key in ranger_species_tree_dict:
+        return ranger_species_tree_dict[ranger_species_tree_key]
+
+    # go through newick format 0, so branch lengths were rounded the same way as in species tree files
+    species_tree_index = get_species_tree_index(pwd_species_tree)
+    species_tree = Tree(get_induced_subtree(species_tree_index, genome_subset).write(format=0), format=0)
+    species_tree.resolve_polytomy(recursive=True)  # solving multifurcations
+    species_tree.convert_to_ultrametric()  # for dated mode
+
+    # replace "_" with "XXXXX", then, replace "." with "SSSSS"
+    for each_st_leaf in species_tree:
+        each_st_leaf.name = 'SSSSS'.join('XXXXX'.join(each_st_leaf.name.split('_')).split('.'))
+
+    ranger_species_tree_dict[ranger_species_tree_key] = species_tree.write(format=5)
+
+    return ranger_species_tree_dict[ranger_species_tree_key]
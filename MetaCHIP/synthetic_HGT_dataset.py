@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from Bio.Data import CodonTable
+from MetaCHIP.PI import get_group_index_list
+from MetaCHIP.MetaCHIP_config import config_dict
+
+
+# Synthetic genomes with planted HGTs. A root gene set (random genes plus one single copy gene sampled from each profile
+# in MetaCHIP_phylo.hmm, so the SCG tree can be built) evolves into group ancestors and then into genomes by codon
+# substitutions. Transfers copy a gene from a donor genome into a genome of another group. Genomes are fragmented
+# into contigs between genes. Genes are stored as arrays of sense codon indices (start and stop codons excluded).
+# numpy RandomState is used as its stream is fixed across numpy versions, the same seed always gives the same dataset.
+
+synthetic_dataset_version = 1
+hmm_alphabet = 'ACDEFGHIKLMNPQRSTVWY'
+rbs_seq = 'AGGAGG'
+
+
+def get_codon_usage(random_state):
+
+    codon_table = CodonTable.unambiguous_dna_by_id[11]
+    sense_codon_list = sorted(codon_table.forward_table)
+    sense_codon_bytes = np.array([list(codon.encode()) for codon in sense_codon_list], dtype=np.uint8)
+    codon_usage = random_state.dirichlet(np.full(len(sense_codon_list), 5.0))
+
+    # codons and their relative usage for each amino acid, used to back-translate SCGs
+    aa_to_codon_dict = {}
+    for codon_index, codon in enumerate(sense_codon_list):
+        aa = codon_table.forward_table[codon]
+        if aa not in aa_to_codon_dict:
+            aa_to_codon_dict[aa] = []
+        aa_to_codon_dict[aa].append(codon_index)
+    for aa in aa_to_codon_dict:
+        codon_index_array = np.array(aa_to_codon_dict[aa])
+        aa_to_codon_dict[aa] = (codon_index_array, codon_usage[codon_index_array] / codon_usage[codon_index_array].sum())
+
+    return {'codons': sense_codon_bytes, 'usage': codon_usage, 'aa_to_codon': aa_to_codon_dict, 'stop': sorted(codon_table.stop_codons)}
+
+
+def get_hmm_match_emissions(pwd_hmm_file):
+
+    # match state emission probabilities of each profile in a HMMER3 file
+    hmm_emission_dict = {}
+    current_hmm = None
+    match_emission_list = []
+    in_model = False
+    for each_line in open(pwd_hmm_file):
+        each_line_split = each_line.strip().split()
+        if each_line.startswith('NAME'):
+            current_hmm = each_line_split[1]
+            match_emission_list = []
+        elif each_line.startswith('HMM '):
+            in_model = True
+        elif each_line.startswith('//'):
+            match_emission = np.exp(-np.array(match_emission_list))
+            hmm_emission_dict[current_hmm] = match_emission / match_emission.sum(axis=1)[:, None]
+            in_model = False
+        elif in_model and (len(each_line_split) > 21) and each_line_split[0].isdigit():
+            match_emission_list.append([float(i) for i in each_line_split[1:21]])
+
+    return hmm_emission_dict
+
+
+def sample_scg_from_hmm(match_emission, codon_usage_dict, random_state):
+
+    codon_index_list = []
+    for position_emission in match_emission:
+        aa = hmm_alphabet[random_state.choice(len(hmm_alphabet), p=position_emission)]
+        codon_index_array, codon_p = codon_usage_dict['aa_to_codon'][aa]
+        codon_index_list.append(codon_index_array[random_state.choice(len(codon_index_array), p=codon_p)])
+
+    return np.array(codon_index_list, dtype=np.uint8)
+
+
+def evolve_gene(codon_index_array, substitution_rate, codon_usage_dict, random_state):
+
+    evolved_gene = codon_index_array.copy()
+    substituted = np.flatnonzero(random_state.random_sample(len(evolved_gene)) < substitution_rate)
+    evolved_gene[substituted] = random_state.choice(len(codon_usage_dict['usage']), size=len(substituted), p=codon_usage_dict['usage'])
+
+    return evolved_gene
+
+
+def reverse_complement(seq):
+
+    return seq.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+
+
+def get_gene_seq(codon_index_array, stop_codon, codon_usage_dict):
+
+    return 'ATG%s%s' % (codon_usage_dict['codons'][codon_index_array].tobytes().decode(), stop_codon)
+
+
+def get_random_seq(seq_len, random_state):
+
+    return np.array(list(b'ACGT'), dtype=np.uint8)[random_state.randint(0, 4, size=seq_len)].tobytes().decode()
+
+
+def layout_genome(genome, gene_list, contig_gene_num, random_state):
+
+    # gene_list: [gene_id, gene_seq, strand], contigs are cut between genes, coordinates are 1-based and inclusive
+    contig_list = []
+    gene_location_dict = {}
+    gene_index = 0
+    while gene_index < len(gene_list):
+        contig_id = '%s_c%s' % (genome, '{:0>4}'.format(len(contig_list) + 1))
+        contig_gene_list = gene_list[gene_index:gene_index + random_state.geometric(1 / contig_gene_num)]
+        contig_seq_list = []
+        contig_len = 0
+        for gene_position, (gene_id, gene_seq, strand) in enumerate(contig_gene_list):
+            spacer_seq = get_random_seq(random_state.randint(50, 251), random_state)
+            upstream_seq = '%s%s' % (rbs_seq, get_random_seq(7, random_state))
+            if strand == '+':
+                unit_seq = '%s%s%s' % (spacer_seq, upstream_seq, gene_seq)
+            else:
+                unit_seq = '%s%s%s' % (spacer_seq, reverse_complement(gene_seq), reverse_complement(upstream_seq))
+            gene_start = contig_len + len(spacer_seq) + 1 + (len(upstream_seq) if strand == '+' else 0)
+            gene_location_dict[gene_id] = {'contig':     contig_id,
+                                           'start':      gene_start,
+                                           'end':        gene_start + len(gene_seq) - 1,
+                                           'strand':     strand,
+                                           'contig_end': (gene_position == 0) or (gene_position == len(contig_gene_list) - 1)}
+            contig_seq_list.append(unit_seq)
+            contig_len += len(unit_seq)
+        contig_seq_list.append(get_random_seq(random_state.randint(50, 251), random_state))
+        contig_list.append([contig_id, ''.join(contig_seq_list)])
+        gene_index += len(contig_gene_list)
+
+    return contig_list, gene_location_dict
+
+
+def get_gene_identity(gene_seq_1, gene_seq_2):
+
+    return round(float(np.mean(np.frombuffer(gene_seq_1.encode(), dtype=np.uint8) == np.frombuffer(gene_seq_2.encode(), dtype=np.uint8))) * 100, 2)
+
+
+def generate_synthetic_dataset(args, config_dict):
+
+    output_folder =       args['o']
+    output_prefix =       args['p']
+    genome_num =          args['n']
+    group_num =           args['groups']
+    gene_num =            args['genes']
+    transfer_num =        args['transfers']
+    contig_gene_num =     args['contig_genes']
+    group_divergence =    args['gd']
+    genome_divergence =   args['md']
+    transfer_divergence = args['td']
+    seed =                args['seed']
+
+    if group_num < 2:
+        print('At least two groups are needed to plant HGTs, program exited!')
+        exit()
+
+    if genome_num < group_num:
+        print('Genome number (%s) is lower than group number (%s), program exited!' % (genome_num, group_num))
+        exit()
+
+    random_state = np.random.RandomState(seed)
+
+    genome_folder =         '%s_genomes'             % output_prefix
+    gtdb_file =             '%s_GTDB.tsv'            % output_prefix
+    grouping_file =         '%s_grouping.txt'        % output_prefix
+    planted_HGT_file =      '%s_planted_HGTs.txt'    % output_prefix
+    dataset_json =          '%s_dataset.json'        % output_prefix
+    pwd_genome_folder =     '%s/%s'                  % (output_folder, genome_folder)
+    pwd_gtdb_file =         '%s/%s'                  % (output_folder, gtdb_file)
+    pwd_grouping_file =     '%s/%s'                  % (output_folder, grouping_file)
+    pwd_planted_HGT_file =  '%s/%s'                  % (output_folder, planted_HGT_file)
+    pwd_dataset_json =      '%s/%s'                  % (output_folder, dataset_json)
+
+    os.makedirs(pwd_genome_folder, exist_ok=True)
+
+
+    ############################################## root gene set ##############################################
+
+    codon_usage_dict = get_codon_usage(random_state)
+    hmm_emission_dict = get_hmm_match_emissions(config_dict['path_to_hmm'])
+
+    root_gene_dict = {}
+    for hmm_name in sorted(hmm_emission_dict):
+        root_gene_dict['scg_%s' % hmm_name] = sample_scg_from_hmm(hmm_emission_dict[hmm_name], codon_usage_dict, random_state)
+    for family_index in range(max(gene_num - len(root_gene_dict), 0)):
+        gene_len = random_state.randint(100, 501)
+        root_gene_dict['fam%s' % '{:0>5}'.format(family_index + 1)] = random_state.choice(len(codon_usage_dict['usage']), size=gene_len, p=codon_usage_dict['usage']).astype(np.uint8)
+
+    family_list = sorted(root_gene_dict)
+    family_stop_dict = {family: codon_usage_dict['stop'][random_state.randint(len(codon_usage_dict['stop']))] for family in family_list}
+
+
+    ##################################### vertical evolution into groups and genomes #####################################
+
+    # single copy genes evolve at half the rate, so they can still be found by hmmsearch
+    genome_list = ['syn%s' % '{:0>4}'.format(genome_index + 1) for genome_index in range(genome_num)]
+    genome_to_group_dict = {genome: genome_index % group_num for genome_index, genome in enumerate(genome_list)}
+    group_gene_order_dict = {}
+    group_strand_dict = {}
+    genome_gene_dict = {}
+    for group_index in range(group_num):
+        group_gene_order_dict[group_index] = [family_list[i] for i in random_state.permutation(len(family_list))]
+        group_strand_dict[group_index] = {family: '+-'[random_state.randint(2)] for family in family_list}
+        group_ancestor_dict = {}
+        for family in family_list:
+            substitution_rate = group_divergence / 2 if family.startswith('scg_') else group_divergence
+            group_ancestor_dict[family] = evolve_gene(root_gene_dict[family], substitution_rate, codon_usage_dict, random_state)
+        for genome in genome_list:
+            if genome_to_group_dict[genome] == group_index:
+                genome_gene_dict[genome] = {}
+                for family in family_list:
+                    substitution_rate = genome_divergence / 2 if family.startswith('scg_') else genome_divergence
+                    genome_gene_dict[genome][family] = evolve_gene(group_ancestor_dict[family], substitution_rate, codon_usage_dict, random_state)
+
+
+    ############################################### plant transfers ###############################################
+
+    transferable_family_list = [family for family in family_list if not family.startswith('scg_')]
+    genome_insertion_dict = {genome: [] for genome in genome_list}
+    planted_HGT_list = []
+    for HGT_index in range(transfer_num if len(transferable_family_list) > 0 else 0):
+        HGT_id = 'HGT%s' % '{:0>4}'.format(HGT_index + 1)
+        donor_genome = genome_list[random_state.randint(genome_num)]
+        recipient_genome_list = [genome for genome in genome_list if genome_to_group_dict[genome] != genome_to_group_dict[donor_genome]]
+        recipient_genome = recipient_genome_list[random_state.randint(len(recipient_genome_list))]
+        family = transferable_family_list[random_state.randint(len(transferable_family_list))]
+        transferred_gene = evolve_gene(genome_gene_dict[donor_genome][family], transfer_divergence, codon_usage_dict, random_state)
+        insert_position = random_state.randint(len(family_list) + 1)
+        genome_insertion_dict[recipient_genome].append([insert_position, HGT_id, transferred_gene, family_stop_dict[family]])
+        planted_HGT_list.append([HGT_id, family, donor_genome, recipient_genome])
+
+
+    ########################################## write genomes and annotations ##########################################
+
+    genome_gene_location_dict = {}
+    genome_gene_seq_dict = {}
+    genome_checksum_list = []
+    for genome in genome_list:
+        group_index = genome_to_group_dict[genome]
+        gene_list = []
+        for family in group_gene_order_dict[group_index]:
+            gene_list.append([family, get_gene_seq(genome_gene_dict[genome][family], family_stop_dict[family], codon_usage_dict), group_strand_dict[group_index][family]])
+
+        # insert transferred genes, from the last insert position to the first
+        for insert_position, HGT_id, transferred_gene, stop_codon in sorted(genome_insertion_dict[genome], key=lambda x: x[0], reverse=True):
+            gene_list.insert(insert_position, [HGT_id, get_gene_seq(transferred_gene, stop_codon, codon_usage_dict), '+-'[random_state.randint(2)]])
+
+        contig_list, gene_location_dict = layout_genome(genome, gene_list, contig_gene_num, random_state)
+        genome_gene_location_dict[genome] = gene_location_dict
+        genome_gene_seq_dict[genome] = {gene_id: gene_seq for gene_id, gene_seq, _ in gene_list}
+
+        genome_file_content = ''.join(['>%s\n%s\n' % (contig_id, '\n'.join([contig_seq[i:i + 60] for i in range(0, len(contig_seq), 60)])) for contig_id, contig_seq in contig_list])
+        with open('%s/%s.fasta' % (pwd_genome_folder, genome), 'w') as genome_file_handle:
+            genome_file_handle.write(genome_file_content)
+        genome_checksum_list.append(hashlib.sha256(genome_file_content.encode()).hexdigest())
+
+    # GTDB-style taxonomy, two groups per phylum, groups are the same from class to genus level
+    gtdb_file_handle = open(pwd_gtdb_file, 'w')
+    gtdb_file_handle.write('user_genome\tclassification\n')
+    grouping_file_handle = open(pwd_grouping_file, 'w')
+    group_id_list = get_group_index_list()
+    for genome in genome_list:
+        group_index = genome_to_group_dict[genome]
+        taxon_list = ['d__Bacteria', 'p__Synthetic_p%s' % (group_index // 2 + 1)]
+        taxon_list += ['%s__Synthetic_%s%s' % (rank, rank, group_index + 1) for rank in ['c', 'o', 'f', 'g']]
+        taxon_list += ['s__Synthetic_s%s' % genome]
+        gtdb_file_handle.write('%s\t%s\n' % (genome, ';'.join(taxon_list)))
+        grouping_file_handle.write('%s,%s\n' % (group_id_list[group_index], genome))
+    gtdb_file_handle.close()
+    grouping_file_handle.close()
+
+    # truth table
+    planted_HGT_file_handle = open(pwd_planted_HGT_file, 'w')
+    planted_HGT_file_handle.write('HGT_id\tfamily\tdonor_genome\tdonor_group\tdonor_contig\tdonor_start\tdonor_end\tdonor_strand\trecipient_genome\trecipient_group\trecipient_contig\trecipient_start\trecipient_end\trecipient_strand\tidentity\tat_contig_end\n')
+    for HGT_id, family, donor_genome, recipient_genome in planted_HGT_list:
+        donor_location = genome_gene_location_dict[donor_genome][family]
+        recipient_location = genome_gene_location_dict[recipient_genome][HGT_id]
+        identity = get_gene_identity(genome_gene_seq_dict[donor_genome][family], genome_gene_seq_dict[recipient_genome][HGT_id])
+        planted_HGT_file_handle.write('%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (HGT_id, family,
+                                                                                                               donor_genome, group_id_list[genome_to_group_dict[donor_genome]], donor_location['contig'], donor_location['start'], donor_location['end'], donor_location['strand'],
+                                                                                                               recipient_genome, group_id_list[genome_to_group_dict[recipient_genome]], recipient_location['contig'], recipient_location['start'], recipient_location['end'], recipient_location['strand'],
+                                                                                                               identity, 'yes' if recipient_location['contig_end'] else 'no'))
+    planted_HGT_file_handle.close()
+
+    # dataset description, the digest identifies identical datasets across MetaCHIP versions
+    dataset_dict = {'dataset_version': synthetic_dataset_version,
+                    'parameters':      {'genomes': genome_num, 'groups': group_num, 'genes': gene_num, 'transfers': transfer_num,
+                                        'contig_genes': contig_gene_num, 'group_divergence': group_divergence,
+                                        'genome_divergence': genome_divergence, 'transfer_divergence': transfer_divergence, 'seed': seed},
+                    'scg_num':         len(hmm_emission_dict),
+                    'planted_HGTs':    len(planted_HGT_list),
+                    'digest':          hashlib.sha256(''.join(genome_checksum_list).encode()).hexdigest(),
+                    'genome_folder':   genome_folder,
+                    'gtdb_file':       gtdb_file,
+                    'grouping_file':   grouping_file,
+                    'planted_HGTs_file': planted_HGT_file}
+    with open(pwd_dataset_json, 'w') as dataset_json_handle:
+        json.dump(dataset_dict, dataset_json_handle, indent=1)
+
+    return dataset_dict
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-o',             required=True,                                help='output folder')
+    parser.add_argument('-p',             required=False, default='syn',                help='output prefix, default: syn')
+    parser.add_argument('-n',             required=True,  type=int,                     help='number of genomes')
+    parser.add_argument('-groups',        required=False, type=int,   default=4,        help='number of groups, default: 4')
+    parser.add_argument('-genes',         required=False, type=int,   default=500,      help='number of genes per genome (including 43 single copy genes), default: 500')
+    parser.add_argument('-transfers',     required=False, type=int,   default=20,       help='number of planted HGTs, default: 20')
+    parser.add_argument('-contig_genes',  required=False, type=float, default=20,       help='mean number of genes per contig, default: 20')
+    parser.add_argument('-gd',            required=False, type=float, default=0.25,     help='codon substitution rate from root to group ancestors, default: 0.25')
+    parser.add_argument('-md',            required=False, type=float, default=0.03,     help='codon substitution rate from group ancestor to genomes, default: 0.03')
+    parser.add_argument('-td',            required=False, type=float, default=0.01,     help='codon substitution rate of transferred genes, default: 0.01')
+    parser.add_argument('-seed',          required=False, type=int,   default=1,        help='random seed, default: 1')
+
+    args = vars(parser.parse_args())
+    generate_synthetic_dataset(args, config_dict)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2017, Weizhi Song, Torsten Thomas.
+# songwz03@gmail.com or t.thomas@unsw.edu.au
+
+# MetaCHIP is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# MetaCHIP is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing as mp
+
+
+# Read-only tables used by all tasks of a pool stage (e.g. genome to group dicts) are installed once per worker
+# process by the pool initializer instead of being pickled into the argument list of every task. On platforms that
+# fork worker processes, the tables are inherited from the parent without being pickled at all.
+
+worker_context_dict = {}
+
+
+def install_worker_context(context_dict):
+
+    worker_context_dict.clear()
+    worker_context_dict.update(context_dict)
+
+
+def get_worker_context_pool(num_threads, context_dict):
+
+    # same as mp.Pool(processes=num_threads), tables in context_dict are available to workers in worker_context_dict
+    return mp.Pool(processes=num_threads, initializer=install_worker_context, initargs=(context_dict,))